@@ -1,34 +1,57 @@
 #!/usr/bin/env python3
-from spadespipeline.typingclasses import GDCS, ResFinder, Resistance, Prophages, Plasmids, PlasmidExtractor, Serotype, Univec, \
-    Virulence
-from accessoryFunctions.accessoryFunctions import MetadataObject, GenObject, printtime, make_path
-from sixteenS.sixteens_full import SixteenS as SixteensFull
-import spadespipeline.metadataprinter as metadataprinter
-import spadespipeline.primer_finder_bbduk as vtyper
-import spadespipeline.GeneSeekr as GeneSeekrMethod
-import spadespipeline.runMetadata as runMetadata
-from spadespipeline.basicAssembly import Basic
-import spadespipeline.fastqmover as fastqmover
-import spadespipeline.spadesRun as spadesRun
-import spadespipeline.compress as compress
-import spadespipeline.prodigal as prodigal
-import spadespipeline.reporter as reporter
-import spadespipeline.quality as quality
-import spadespipeline.univec as univec
-import spadespipeline.depth as depth
-import spadespipeline.sistr as sistr
-from MLSTsippr.mlst import GeneSippr as MLSTSippr
-from metagenomefilter import automateCLARK
-from genesippr.genesippr import GeneSippr
-import coreGenome.core as core
-import MASHsippr.mash as mash
+from cowbat.lazyimport import LazyCallable, LazyModule
+from cowbat.version import __version__
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser
-from psutil import virtual_memory
 import multiprocessing
 from time import time
-import subprocess
+import copy
+import json
 import os
 
+# The analysis modules are only imported when the stages that use them are run, so that starting the pipeline e.g. to
+# print the version, or to validate arguments, does not import every analysis package
+MetadataObject = LazyCallable('accessoryFunctions.accessoryFunctions', 'MetadataObject')
+GenObject = LazyCallable('accessoryFunctions.accessoryFunctions', 'GenObject')
+printtime = LazyCallable('accessoryFunctions.accessoryFunctions', 'printtime')
+make_path = LazyCallable('accessoryFunctions.accessoryFunctions', 'make_path')
+typingclasses = LazyModule('spadespipeline.typingclasses')
+sixteens_full = LazyModule('sixteenS.sixteens_full')
+vtyper = LazyModule('spadespipeline.primer_finder_bbduk')
+GeneSeekrMethod = LazyModule('spadespipeline.GeneSeekr')
+runMetadata = LazyModule('spadespipeline.runMetadata')
+basicassembly = LazyModule('spadespipeline.basicAssembly')
+fastqmover = LazyModule('spadespipeline.fastqmover')
+spadesRun = LazyModule('spadespipeline.spadesRun')
+compress = LazyModule('spadespipeline.compress')
+prodigal = LazyModule('spadespipeline.prodigal')
+quality = LazyModule('spadespipeline.quality')
+univec = LazyModule('spadespipeline.univec')
+depth = LazyModule('spadespipeline.depth')
+sistr = LazyModule('spadespipeline.sistr')
+mlstsippr = LazyModule('MLSTsippr.mlst')
+automateCLARK = LazyModule('metagenomefilter.automateCLARK')
+genesippr = LazyModule('genesippr.genesippr')
+core = LazyModule('coreGenome.core')
+mash = LazyModule('MASHsippr.mash')
+alleleindex = LazyModule('cowbat.alleleindex')
+archiver = LazyModule('cowbat.archiver')
+batchmash = LazyModule('cowbat.batchmash')
+clarkserver = LazyModule('cowbat.clarkserver')
+contigfilter = LazyModule('cowbat.contigfilter')
+intermediates = LazyModule('cowbat.intermediates')
+kmerselection = LazyModule('cowbat.kmerselection')
+metadataprinter = LazyModule('cowbat.metadataprinter')
+multirun = LazyModule('cowbat.multirun')
+resultcache = LazyModule('cowbat.resultcache')
+resultsstore = LazyModule('cowbat.resultsstore')
+runwatcher = LazyModule('cowbat.runwatcher')
+samplerecord = LazyModule('cowbat.samplerecord')
+staging = LazyModule('cowbat.staging')
+streamreport = LazyModule('cowbat.streamreport')
+subsample = LazyModule('cowbat.subsample')
+psutil = LazyModule('psutil')
+
 __author__ = 'adamkoziol'
 
 
@@ -37,38 +60,165 @@ class RunSpades(object):
     def main(self):
         """
         Run the methods in the correct order
+        :return: dictionary summarising the run
+        """
+        if self.multirun:
+            # Analyse several runs together, so that the databases of the typing stages are loaded once
+            batch = multirun.MultiRun(self)
+            return batch.main()
+        if self.watch:
+            # Process the samples as the sequencer writes them - each sample is assembled as soon as its reads are
+            # complete
+            watcher = runwatcher.RunWatcher(self)
+            watcher.main()
+            groups = [self.runmetadata.samples]
+        else:
+            # Start the assembly
+            self.helper()
+            # Group the samples by priority
+            groups = self.priority_groups()
+        samples = self.runmetadata.samples
+        reportpath = self.reportpath
+        # The stage reports of each priority group are written to the folder of the group, and merged once every group
+        # is complete
+        grouppaths = [os.path.join(reportpath, 'group{}'.format(number + 1)) for number in range(len(groups))] \
+            if len(groups) > 1 else [reportpath]
+        try:
+            # Urgent samples are taken through every stage, and have partial reports created, before the rest of
+            # the samples are analysed
+            for number, group in enumerate(groups):
+                self.runmetadata.samples = group
+                self.reportpath = grouppaths[number]
+                try:
+                    self.analyse()
+                finally:
+                    self.reportpath = reportpath
+                self.sample_reports()
+                if number < len(groups) - 1:
+                    printtime('Created partial reports for {} prioritised samples'.format(len(group)), self.starttime)
+                    if self.staging:
+                        # Start copying the prioritised samples back to the run folder
+                        self.staging.copy_back(group)
+        finally:
+            self.runmetadata.samples = samples
+        if len(groups) > 1:
+            for filename in streamreport.merge_reports(grouppaths, [set(sample.name for sample in group)
+                                                                   for group in groups],
+                                                       [sample.name for sample in samples], reportpath):
+                printtime('{} cannot be merged, and is kept in the report folder of each priority group'
+                          .format(filename), self.starttime)
+        return self.finish()
+
+    def finish(self):
+        """
+        Create the reports of the run once the samples have been analysed, and compress the large files
+        :return: dictionary summarising the run
+        """
+        # Print the metadata to file
+        metadataprinter.MetadataPrinter(self)
+        # Stop after the read processing stages if only pre-processing of data is requested
+        if self.preprocess:
+            self.unstage()
+            self.preprocess_checkpoint()
+            printtime('Pre-processing complete', self.starttime)
+            return self.run_summary('preprocessed')
+        # Create the run reports from the report rows of the samples
+        report = streamreport.StreamingReporter(self)
+        report.main()
+        # Compress or remove all large, temporary files created by the pipeline
+        compress.Compress(self)
+        # Compress the remaining large files
+        self.archive()
+        # Copy the samples processed on local scratch space back to the run folder
+        self.unstage()
+        # Add the results to the cross-run results database
+        self.store_results()
+        metadataprinter.MetadataPrinter(self)
+        return self.run_summary('complete')
+
+    def analyse(self):
+        """
+        Run the read processing, assembly, and typing stages on the samples in self.runmetadata.samples
         """
-        # Start the assembly
-        self.helper()
-        # Create the quality object
-        self.create_quality_object()
-        # Run the quality analyses
-        self.quality()
+        if not self.watch:
+            # In watch mode, the samples were processed as they were completed
+            self.process_run()
         # Print the metadata to file
         metadataprinter.MetadataPrinter(self)
-        # Perform assembly
-        self.assemble()
+        if self.preprocess:
+            return
+        self.characterise()
+
+    def process_run(self):
+        """
+        Run the quality analyses, and perform assembly. The samples are processed in batches that fit within the
+        scratch space budget
+        """
+        for batch in self.intermediates.batches(self.runmetadata.samples):
+            self.process_samples(batch)
+
+    def characterise(self):
+        """
+        Run the CLARK and typing stages on the assembled samples in self.runmetadata.samples
+        """
+        # The CLARK analyses create run-level reports, and are performed once all the samples are assembled
+        self.clark()
         # Perform genus-agnostic typing
         self.agnostictyping()
         # Perform typing
         self.typing()
-        # Create a report
-        reporter.Reporter(self)
-        # Compress or remove all large, temporary files created by the pipeline
-        compress.Compress(self)
-        metadataprinter.MetadataPrinter(self)
+
+    def priority_groups(self):
+        """
+        Set the priority of each sample from the priorities supplied on the command line, or from the Priority column
+        of the sample sheet. Samples without a priority have a priority of 0
+        :return: list of lists of samples with the same priority, from the highest to the lowest priority
+        """
+        priorities = dict()
+        for sample in self.runmetadata.samples:
+            priority = sample.run.datastore.get('Priority', 'NA') if 'run' in sample.datastore else 'NA'
+            if sample.name in self.priorities:
+                priority = self.priorities[sample.name]
+            try:
+                sample.general.priority = int(priority) if priority != 'NA' else 0
+            except ValueError:
+                raise AssertionError('Invalid priority for sample {sample}: {priority!r:s}'
+                                     .format(sample=sample.name,
+                                             priority=priority))
+            priorities.setdefault(sample.general.priority, list()).append(sample)
+        for name in sorted(set(self.priorities) - set(sample.name for sample in self.runmetadata.samples)):
+            printtime('Could not find sample {} to prioritise'.format(name), self.starttime)
+        groups = [priorities[priority] for priority in sorted(priorities, reverse=True)]
+        if len(groups) > 1:
+            printtime('Analysing {num} prioritised samples ahead of the rest of the run'
+                      .format(num=sum(len(group) for group in groups[:-1])), self.starttime)
+        return groups if groups else [list()]
+
+    def sample_reports(self):
+        """
+        Write the report rows of each sample in self.runmetadata.samples to reports/samples/<sample name> once its
+        analyses are complete. The rows are merged into the run reports at the end of the run, and make the results
+        of urgent samples available before the rest of the run is complete
+        """
+        if self.preprocess:
+            return
+        report = streamreport.StreamingReporter(self)
+        report.add_samples(self.runmetadata.samples)
 
     def helper(self):
         """Helper function for file creation (if desired), manipulation, quality assessment,
         and trimming as well as the assembly"""
         # Simple assembly without requiring accessory files (SampleSheet.csv, etc).
         if self.basicassembly:
-            self.runmetadata = Basic(self)
+            self.runmetadata = basicassembly.Basic(self)
+            # Store the metadata of the samples in compact records
+            self.runmetadata.samples = samplerecord.compact(self.runmetadata.samples)
         else:
             # Populate the runmetadata object by parsing the SampleSheet.csv, GenerateFASTQRunStatistics.xml, and
             # RunInfo.xml files
             self.runinfo = os.path.join(self.path, 'RunInfo.xml')
             self.runmetadata = runMetadata.Metadata(self)
+            self.runmetadata.samples = samplerecord.compact(self.runmetadata.samples)
             # Extract the flowcell ID and the instrument name if the RunInfo.xml file was provided
             self.runmetadata.parseruninfo()
             # Populate the lack of bclcall and nohup call into the metadata sheet
@@ -81,6 +231,44 @@ class RunSpades(object):
         # Print the metadata to file
         metadataprinter.MetadataPrinter(self)
 
+    def read_processing(self):
+        """
+        Run the quality analyses on the samples. The processed reads of samples that were pre-processed by a previous
+        invocation of the pipeline are restored instead
+        """
+        samples = self.runmetadata.samples
+        unprocessed = self.restore_preprocessed()
+        if unprocessed:
+            # Only run the quality analyses on the samples that were not pre-processed
+            self.runmetadata.samples = unprocessed
+            try:
+                # Create the quality object
+                self.create_quality_object()
+                # Run the quality analyses
+                self.quality()
+            finally:
+                self.runmetadata.samples = samples
+
+    def process_samples(self, samples):
+        """
+        Run the quality analyses and assembly (unless only pre-processing is requested) on a subset of the samples.
+        Used to process batches of samples that fit within the scratch space budget, and by the watch mode to process
+        samples as they are completed by the sequencer
+        :param samples: list of metadata objects
+        """
+        if self.staging:
+            # Process the samples on the local scratch space
+            self.staging.stage(samples)
+        allsamples = self.runmetadata.samples
+        self.runmetadata.samples = samples
+        try:
+            self.read_processing()
+            if not self.preprocess:
+                # The CLARK analyses create run-level reports, and are performed once all the samples are assembled
+                self.assemble(clark=False)
+        finally:
+            self.runmetadata.samples = allsamples
+
     def create_quality_object(self):
         """
         Create the quality object
@@ -95,6 +283,8 @@ class RunSpades(object):
         # Validate that the FASTQ files are in the proper format, and that there are no issues e.g. different numbers
         # of forward and reverse reads, read length longer than quality score length, proper extension
         self.fastq_validate()
+        # Subsample the reads of samples sequenced beyond the target depth
+        self.subsample_reads()
         # Run FastQC on the unprocessed fastq files
         self.fastqc_raw()
         # Perform quality trimming and FastQC on the trimmed files
@@ -113,12 +303,94 @@ class RunSpades(object):
         self.fastqc_normalised()
         # Merge paired end reads into a single file based on overlap
         self.merge_reads()
+        # Remove the trimmed and normalised reads
+        self.intermediates.release('merge_reads')
         # Run FastQC on the merged fastq files
         self.fastqc_merged()
-        # Exit if only pre-processing of data is requested
-        if self.preprocess:
-            printtime('Pre-processing complete', starttime)
-            quit()
+
+    def preprocess_checkpoint(self):
+        """
+        Record the metadata of the pre-processed samples, so that a later invocation of the pipeline can use the
+        processed reads rather than repeating the quality analyses
+        """
+        checkpoint = self.run_summary('preprocessed')
+        checkpoint['metadata'] = {sample.name: sample.dump() for sample in self.runmetadata.samples}
+        # Record the sizes and modification times of the original reads, so that reads that are replaced with the
+        # same names e.g. by re-demultiplexing the run are processed again
+        checkpoint['fastqsignatures'] = {sample.name: self.fastq_signature(sample.general.datastore.get(
+            'rawfastqfiles', sample.general.datastore.get('fastqfiles'))) for sample in self.runmetadata.samples
+            if 'general' in sample.datastore}
+        with open(self.checkpointfile, 'w') as checkpointfile:
+            json.dump(checkpoint, checkpointfile, sort_keys=True, indent=4, separators=(',', ': '))
+
+    @staticmethod
+    def fastq_signature(fastqfiles):
+        """
+        :param fastqfiles: list of FASTQ files
+        :return: list of the size and modification time of each file. Missing files have a signature of None
+        """
+        signature = list()
+        for fastq in fastqfiles if type(fastqfiles) is list else list():
+            try:
+                stats = os.stat(fastq)
+                signature.append([stats.st_size, stats.st_mtime_ns])
+            except OSError:
+                signature.append(None)
+        return signature
+
+    def restore_preprocessed(self):
+        """
+        Restore the metadata of samples pre-processed by a previous invocation of the pipeline. Samples are only
+        restored if their FASTQ files (names, sizes, and modification times) are unchanged, and their processed reads
+        are still present
+        :return: list of samples that still require pre-processing
+        """
+        if self.preprocess or not os.path.isfile(self.checkpointfile):
+            return self.runmetadata.samples
+        with open(self.checkpointfile) as checkpointfile:
+            checkpoint = json.load(checkpointfile)
+        unprocessed = list()
+        for sample in self.runmetadata.samples:
+            try:
+                metadata = checkpoint['metadata'][sample.name]
+                # The reads of subsampled samples are compared to the original reads
+                assert metadata['general'].get('rawfastqfiles', metadata['general']['fastqfiles']) == \
+                    sample.general.fastqfiles
+                assert checkpoint['fastqsignatures'][sample.name] == self.fastq_signature(sample.general.fastqfiles)
+                assert all(os.path.isfile(fastq) for fastq in metadata['general']['trimmedcorrectedfastqfiles'])
+            except (KeyError, TypeError, AssertionError):
+                unprocessed.append(sample)
+                continue
+            if 'rawfastqfiles' in metadata['general']:
+                # Use the subsampled reads
+                sample.general.rawfastqfiles = sample.general.fastqfiles
+                sample.general.fastqfiles = metadata['general']['fastqfiles']
+            for attr, values in metadata.items():
+                if attr == 'general':
+                    # The newly-populated general attributes take precedence over the pre-processed ones
+                    for key, value in values.items():
+                        if key not in sample.general.datastore:
+                            setattr(sample.general, key, value)
+                elif attr not in sample.datastore and isinstance(values, dict):
+                    setattr(sample, attr, GenObject(values))
+        if len(unprocessed) < len(self.runmetadata.samples):
+            printtime('Using pre-processed reads for {num} of {total} samples'
+                      .format(num=len(self.runmetadata.samples) - len(unprocessed),
+                              total=len(self.runmetadata.samples)), self.starttime)
+        return unprocessed
+
+    def run_summary(self, status):
+        """
+        :param status: status of the run e.g. preprocessed, complete
+        :return: dictionary summarising the run
+        """
+        return {'status': status,
+                'path': self.path,
+                'commit': self.commit,
+                'elapsed': round(time() - self.starttime, 2),
+                'samples': [sample.name for sample in self.runmetadata.samples],
+                'metadatafiles': ['{}/{}_metadata.json'.format(sample.general.outputdirectory, sample.name)
+                                  for sample in self.runmetadata.samples]}
 
     def fastq_validate(self):
         """
@@ -127,6 +399,16 @@ class RunSpades(object):
         self.qualityobject.validate_fastq()
         metadataprinter.MetadataPrinter(self)
 
+    def subsample_reads(self):
+        """
+        Estimate the genome size and depth of each sample with mash, and subsample the reads of samples with depths
+        greater than the target depth
+        """
+        if self.targetdepth:
+            subsampler = subsample.Subsample(self)
+            subsampler.main()
+            metadataprinter.MetadataPrinter(self)
+
     def fastqc_raw(self):
         """
         Run FastQC on the unprocessed FASTQ files
@@ -197,14 +479,21 @@ class RunSpades(object):
         self.qualityobject.fastqcthreader('merged')
         metadataprinter.MetadataPrinter(self)
 
-    def assemble(self):
+    def assemble(self, clark=True):
         """
         Assemble genomes and perform some basic quality analyses
+        :param clark: boolean of whether to perform the CLARK analyses
         """
         # Run spades
         self.run_spades()
+        # Remove the merged reads, and the SPAdes working folders
+        self.intermediates.release('run_spades')
         # Calculate the depth of coverage as well as other quality metrics using Qualimap
         self.qualimap()
+        # Remove the mapping files
+        self.intermediates.release('qualimap')
+        # Remove short and low-coverage contigs from the assemblies
+        self.contig_filter()
         # Run quast assembly metrics
         self.quality_features()
         # ORF detection
@@ -212,13 +501,33 @@ class RunSpades(object):
         # Assembly quality determination
         self.genome_qaml()
         # CLARK analyses
-        self.clark()
+        if clark:
+            self.clark()
 
     def run_spades(self):
         """
-        Perform de novo assemblies with SPAdes
-        """
-        spadesRun.Spades(self)
+        Perform de novo assemblies with SPAdes. The k-mers of each sample are selected from its read length and
+        estimated depth (unless supplied), and samples with the same k-mers are assembled together. The groups are
+        assembled concurrently, and the threads are divided between the groups in proportion to their sizes
+        """
+        groups = kmerselection.kmer_groups(self.runmetadata.samples, self.kmers)
+        assemblyobjects = list()
+        for kmers, samples in sorted(groups.items()):
+            printtime('Assembling {num} samples with k-mers {kmers}'.format(num=len(samples),
+                                                                            kmers=kmers), self.starttime)
+            # Create a shallow copy of the pipeline object with the samples, k-mers, and threads of the group
+            assemblyobject = copy.copy(self)
+            assemblyobject.runmetadata = MetadataObject()
+            assemblyobject.runmetadata.samples = samples
+            assemblyobject.kmers = kmers
+            assemblyobject.cpus = max(int(int(self.cpus) * len(samples) / len(self.runmetadata.samples)), 1)
+            assemblyobjects.append(assemblyobject)
+        if assemblyobjects:
+            with ThreadPoolExecutor(max_workers=len(assemblyobjects)) as executor:
+                futures = [executor.submit(spadesRun.Spades, assemblyobject) for assemblyobject in assemblyobjects]
+                # Retrieve the results to raise any exceptions encountered in the assemblies
+                for future in futures:
+                    future.result()
         metadataprinter.MetadataPrinter(self)
 
     def qualimap(self):
@@ -229,6 +538,17 @@ class RunSpades(object):
         qual.main()
         metadataprinter.MetadataPrinter(self)
 
+    def contig_filter(self):
+        """
+        Remove the contigs shorter than the minimum length, or with less than the minimum coverage, from the best
+        assemblies used by the subsequent stages. The unfiltered assemblies and excluded contigs are kept in the
+        contigfilter folder of each sample
+        """
+        if self.mincontiglength or self.mincontigdepth:
+            contigs = contigfilter.ContigFilter(self, self.mincontiglength, self.mincontigdepth)
+            contigs.main()
+            metadataprinter.MetadataPrinter(self)
+
     def quality_features(self):
         """
         Extract features from assemblies such as total genome size, longest contig, and N50
@@ -254,16 +574,23 @@ class RunSpades(object):
 
     def clark(self):
         """
-        Run CLARK metagenome analyses on the raw reads and assemblies if the system has adequate resources
+        Run CLARK metagenome analyses on the raw reads and assemblies if the system has adequate resources. The
+        analyses are submitted to the CLARK server if one is available
         """
         # Determine the amount of physical memory in the system
-        mem = virtual_memory()
-        # If the total amount of memory is greater than 100GB (this could probably be lowered), run CLARK
-        if mem.total >= 100000000000:
+        mem = psutil.virtual_memory()
+        # If the total amount of memory is less than 100GB (this could probably be lowered), do not run CLARK. The
+        # CLARK server runs on the same host, and loads the full database for every batch
+        if mem.total < 100000000000:
+            printtime('Not enough RAM to run CLARK!', self.starttime)
+        elif self.clarksocket:
+            # The CLARK server sets up the database once, and classifies the samples of concurrent runs together
+            clark = clarkserver.ClarkClient(self)
+            clark.main()
+            metadataprinter.MetadataPrinter(self)
+        else:
             # Run CLARK typing on the .fastq and .fasta files
             automateCLARK.PipelineInit(self)
-        else:
-            printtime('Not enough RAM to run CLARK!', self.starttime)
 
     def agnostictyping(self):
         """
@@ -285,12 +612,8 @@ class RunSpades(object):
         self.plasmid_extractor()
         # Resistance finding - raw reads
         self.ressippr()
-        # Resistance finding - assemblies
-        self.resfinder()
-        # Prophage detection
-        self.prophages()
-        # Univec contamination search
-        self.univec()
+        # Resistance finding, prophage detection, and univec contamination search of the assemblies
+        self.assembly_search()
         # Virulence
         self.virulence()
 
@@ -298,21 +621,35 @@ class RunSpades(object):
         """
         Run mash to determine closest refseq genome
         """
-        mash.Mash(self, 'mash')
+        self.run_cached('mash', self.mash_search, ['mash'], 'reads')
         metadataprinter.MetadataPrinter(self)
 
+    def mash_search(self):
+        """
+        Find the closest refseq genome with mash
+        """
+        if self.batchmash:
+            # Sketch all the samples together, and compare them to the RefSeq sketch with a single call
+            batch = batchmash.BatchMash(self, 'mash')
+            batch.main()
+        else:
+            mash.Mash(self, 'mash')
+
     def rmlst(self):
         """
         Run rMLST analyses
         """
-        MLSTSippr(self, self.commit, self.starttime, self.homepath, 'rMLST', 1.0, True)
+        self.run_cached('rmlst', lambda: self.allele_typing('rMLST'), ['rMLST'], 'reads', 1.0)
         metadataprinter.MetadataPrinter(self)
 
     def sixteens(self):
         """
         Run the 16S analyses
         """
-        SixteensFull(self, self.commit, self.starttime, self.homepath, 'sixteens_full', 0.95)
+        self.run_cached('sixteens_full',
+                        lambda: sixteens_full.SixteenS(self, self.commit, self.starttime, self.homepath,
+                                                       'sixteens_full', 0.95),
+                        ['sixteens_full'], 'reads', 0.95)
         metadataprinter.MetadataPrinter(self)
 
     def run_gdcs(self):
@@ -321,28 +658,34 @@ class RunSpades(object):
         strains
         """
         # Run the GDCS analysis
-        GDCS(self)
+        self.run_cached('GDCS', lambda: typingclasses.GDCS(self), ['GDCS'], 'reads')
         metadataprinter.MetadataPrinter(self)
 
     def genesippr(self):
         """
         Find genes of interest
         """
-        GeneSippr(self, self.commit, self.starttime, self.homepath, 'genesippr', 0.95, False, False)
+        self.run_cached('genesippr',
+                        lambda: genesippr.GeneSippr(self, self.commit, self.starttime, self.homepath, 'genesippr', 0.95,
+                                                    False, False),
+                        ['genesippr'], 'reads', 0.95)
         metadataprinter.MetadataPrinter(self)
 
     def plasmids(self):
         """
         Plasmid finding
         """
-        Plasmids(self, self.commit, self.starttime, self.homepath, 'plasmidfinder', 0.8, False, True)
+        self.run_cached('plasmidfinder',
+                        lambda: typingclasses.Plasmids(self, self.commit, self.starttime, self.homepath,
+                                                       'plasmidfinder', 0.8, False, True),
+                        ['plasmidfinder'], 'reads', 0.8)
         metadataprinter.MetadataPrinter(self)
 
     def plasmid_extractor(self):
         """
         Extracts and types plasmid sequences
         """
-        plasmids = PlasmidExtractor(self)
+        plasmids = typingclasses.PlasmidExtractor(self)
         plasmids.main()
         metadataprinter.MetadataPrinter(self)
 
@@ -350,38 +693,98 @@ class RunSpades(object):
         """
         Resistance finding - raw reads
         """
-        Resistance(self, self.commit, self.starttime, self.homepath, 'resfinder', 0.8, False, True)
+        self.run_cached('resfinder',
+                        lambda: typingclasses.Resistance(self, self.commit, self.starttime, self.homepath, 'resfinder',
+                                                         0.8, False, True),
+                        ['resfinder'], 'reads', 0.8)
         metadataprinter.MetadataPrinter(self)
 
+    def assembly_search(self, prophagecutoff=90):
+        """
+        Run the resistance finding, prophage detection, and univec contamination searches of the assemblies
+        concurrently. The threads are divided between the searches, so that the total number of search threads does not
+        exceed the number of threads requested for the pipeline
+        :param prophagecutoff: cutoff value to be used in the prophage analyses
+        """
+        self.run_cached('assembly_search', lambda: self.concurrent_search(prophagecutoff),
+                        ['resfinder', 'prophages', 'univec'], 'assembly', prophagecutoff)
+        metadataprinter.MetadataPrinter(self)
+
+    def concurrent_search(self, prophagecutoff):
+        """
+        Run the resistance finding, prophage detection, and univec contamination searches concurrently
+        :param prophagecutoff: cutoff value to be used in the prophage analyses
+        """
+        searches = [(self.resfinder_search, ()),
+                    (self.prophage_search, (prophagecutoff,)),
+                    (self.univec_search, ())]
+        # Create a shallow copy of the pipeline object with the per-search number of threads. The metadata objects
+        # are shared, and each search populates its own analysis-specific attributes
+        searchobject = copy.copy(self)
+        searchobject.cpus = max(int(int(self.cpus) / len(searches)), 1)
+        with ThreadPoolExecutor(max_workers=len(searches)) as executor:
+            futures = [executor.submit(search, searchobject, *arguments) for search, arguments in searches]
+            # Retrieve the results to raise any exceptions encountered in the searches
+            for future in futures:
+                future.result()
+
     def resfinder(self):
         """
         Resistance finding - assemblies
         """
-        ResFinder(self)
+        self.run_cached('resfinder_assembled', lambda: self.resfinder_search(self), ['resfinder'], 'assembly')
         metadataprinter.MetadataPrinter(self)
 
+    @staticmethod
+    def resfinder_search(inputobject):
+        """
+        Resistance finding - assemblies
+        :param inputobject: object with the metadata, and the number of threads to use
+        """
+        typingclasses.ResFinder(inputobject)
+
     def prophages(self, cutoff=90):
         """
         Prophage detection
         :param cutoff: cutoff value to be used in the analyses
         """
-        pro = GeneSeekrMethod.PipelineInit(self, 'prophages', False, cutoff, True)
-        Prophages(pro)
+        self.run_cached('prophages', lambda: self.prophage_search(self, cutoff), ['prophages'], 'assembly', cutoff)
         metadataprinter.MetadataPrinter(self)
 
+    @staticmethod
+    def prophage_search(inputobject, cutoff):
+        """
+        Prophage detection
+        :param inputobject: object with the metadata, and the number of threads to use
+        :param cutoff: cutoff value to be used in the analyses
+        """
+        pro = GeneSeekrMethod.PipelineInit(inputobject, 'prophages', False, cutoff, True)
+        typingclasses.Prophages(pro)
+
     def univec(self):
         """
         Univec contamination search
         """
-        uni = univec.PipelineInit(self, 'univec', False, 80, True)
-        Univec(uni)
+        self.run_cached('univec', lambda: self.univec_search(self), ['univec'], 'assembly', 80)
         metadataprinter.MetadataPrinter(self)
 
+    @staticmethod
+    def univec_search(inputobject):
+        """
+        Univec contamination search
+        :param inputobject: object with the metadata, and the number of threads to use
+        """
+        uni = univec.PipelineInit(inputobject, 'univec', False, 80, True)
+        typingclasses.Univec(uni)
+
     def virulence(self):
         """
         Virulence gene detection
         """
-        Virulence(self, self.commit, self.starttime, self.homepath, 'virulence', 0.95, False, True)
+        self.run_cached('virulence',
+                        lambda: typingclasses.Virulence(self, self.commit, self.starttime, self.homepath, 'virulence',
+                                                        0.95, False, True),
+                        ['virulence'], 'reads', 0.95)
         metadataprinter.MetadataPrinter(self)
 
     def typing(self):
@@ -404,40 +807,161 @@ class RunSpades(object):
         """
          MLST analyses
         """
-        MLSTSippr(self, self.commit, self.starttime, self.homepath, 'MLST', 1.0, True)
+        self.run_cached('mlst', lambda: self.allele_typing('MLST'), ['MLST'], 'reads', 1.0)
         metadataprinter.MetadataPrinter(self)
 
+    def allele_typing(self, analysistype):
+        """
+        Sequence typing. Samples with exact matches to every allele of the scheme in their assemblies are typed using
+        the allele index created by the database setup. The remaining samples are typed with MLSTSippr
+        :param analysistype: MLST or rMLST
+        """
+        hashtyping = alleleindex.AlleleHashTyping(self, analysistype)
+        unresolved = hashtyping.main()
+        if unresolved:
+            samples = self.runmetadata.samples
+            self.runmetadata.samples = unresolved
+            try:
+                mlstsippr.GeneSippr(self, self.commit, self.starttime, self.homepath, analysistype, 1.0, True)
+            finally:
+                self.runmetadata.samples = samples
+        # Add the samples typed with the allele index to the reports
+        hashtyping.reporter(append=bool(unresolved))
+
     def serosippr(self):
         """
         Serotyping analyses
         """
-        Serotype(self, self.commit, self.starttime, self.homepath, 'serosippr', 0.95, True)
+        self.run_cached('serosippr',
+                        lambda: typingclasses.Serotype(self, self.commit, self.starttime, self.homepath, 'serosippr',
+                                                       0.95, True),
+                        ['serosippr'], 'reads', 0.95)
         metadataprinter.MetadataPrinter(self)
 
     def vtyper(self):
         """
         Virulence typing
         """
-        vtype = vtyper.PrimerFinder(self, 'vtyper')
-        vtype.main()
+        self.run_cached('vtyper', lambda: vtyper.PrimerFinder(self, 'vtyper').main(), ['vtyper'], 'reads')
         metadataprinter.MetadataPrinter(self)
 
     def coregenome(self):
+        """
+        Core genome calculation
+        """
+        self.run_cached('coregenome', self.coregenome_search, ['coregenome'], 'assembly', 70)
+        metadataprinter.MetadataPrinter(self)
+
+    def coregenome_search(self):
         """
         Core genome calculation
         """
         coregen = GeneSeekrMethod.PipelineInit(self, 'coregenome', True, 70, False)
         core.CoreGenome(coregen)
         core.AnnotatedCore(self)
-        metadataprinter.MetadataPrinter(self)
 
     def sistr(self):
         """
         Sistr
         """
-        sistr.Sistr(self, 'sistr')
+        self.run_cached('sistr', lambda: sistr.Sistr(self, 'sistr'), list(), 'assembly')
         metadataprinter.MetadataPrinter(self)
 
+    def archive(self):
+        """
+        Compress the large files remaining in the sample folders. The files are compressed concurrently, and their
+        checksums are verified before the originals are removed
+        """
+        archive = archiver.Archiver(self, self.compression)
+        archive.main()
+
+    def unstage(self):
+        """
+        Copy the samples processed on the local scratch space back to the run folder, and update their metadata
+        """
+        if not self.staging:
+            return
+        self.staging.unstage(self.runmetadata.samples)
+        metadataprinter.MetadataPrinter(self)
+
+    def store_results(self):
+        """
+        Add the typing results of the samples to the results database, which collects the results of every run, and
+        can be queried with python -m cowbat.resultsstore
+        """
+        if not self.resultsdatabase:
+            return
+        store = resultsstore.ResultsStore(self.resultsdatabase)
+        try:
+            added = store.add_samples(self.runmetadata.samples, self.path, self.commit)
+        finally:
+            store.close()
+        printtime('Added the results of {num} samples to {database}'.format(num=added,
+                                                                            database=self.resultsdatabase),
+                  self.starttime)
+
+    def run_cached(self, stage, function, databases, inputs, *parameters):
+        """
+        Run a typing stage on the samples without cached results. The metadata of samples with cached results are
+        restored from the cache, and the results of the remaining samples are added to the cache. The reports of the
+        stage are recreated with the rows of the analysed samples, and the cached rows of the remaining samples. Stages
+        with reports that cannot be divided by sample e.g. Excel reports, are run on all the samples
+        :param stage: name of the stage
+        :param function: function that runs the stage on the samples in self.runmetadata.samples
+        :param databases: list of the names of the database folders used by the stage
+        :param inputs: 'reads' or 'assembly'; the input files of the stage
+        :param parameters: parameters of the stage e.g. cutoff values
+        """
+        if not self.resultcache:
+            function()
+            return
+        samples = self.runmetadata.samples
+        keys = self.resultcache.keys(samples, stage, databases, inputs, parameters)
+        # Dictionary of sample name: report name: cached rows of the sample in the report
+        cachedreports = dict()
+        misses = self.resultcache.restore(samples, keys, cachedreports)
+        if len(misses) < len(samples):
+            printtime('Restored cached {stage} results for {hits} of {total} samples'
+                      .format(stage=stage,
+                              hits=len(samples) - len(misses),
+                              total=len(samples)), self.starttime)
+        reports = dict()
+        if misses:
+            snapshots = self.resultcache.snapshot(misses)
+            previous = self.resultcache.report_files(self.reportpath)
+            # Only run the stage on the samples without cached results
+            self.runmetadata.samples = misses
+            try:
+                function()
+            finally:
+                self.runmetadata.samples = samples
+            # Divide the reports created or updated by the stage by sample
+            current = self.resultcache.report_files(self.reportpath)
+            reports = streamreport.divide_reports(self.reportpath, set(sample.name for sample in misses),
+                                                  [filename for filename in current
+                                                   if current[filename] != previous.get(filename)])
+            if any(blocks is None for blocks in reports.values()):
+                if cachedreports:
+                    printtime('The {} reports cannot be recreated from cached results. Analysing all the samples'
+                              .format(stage), self.starttime)
+                    function()
+                return
+            self.resultcache.store(misses, keys, snapshots, reports)
+        if not cachedreports:
+            return
+        # Recreate the reports of the stage with the rows of every sample
+        make_path(self.reportpath)
+        for filename in sorted(set(reports).union(*[samplereports.keys() for samplereports in cachedreports.values()])):
+            blocks = list()
+            for sample in samples:
+                if sample.name in cachedreports:
+                    block = cachedreports[sample.name].get(filename)
+                else:
+                    block = reports.get(filename, dict()).get(sample.name)
+                if block:
+                    blocks.append(block)
+            streamreport.write_report(blocks, os.path.join(self.reportpath, filename))
+
     def __init__(self, args, pipelinecommit, startingtime, scriptpath):
         """
         :param args: list of arguments passed to the script
@@ -452,6 +976,33 @@ class RunSpades(object):
         self.numreads = args.numreads
         self.kmers = args.kmerrange
         self.preprocess = args.preprocess
+        self.batchmash = args.batchmash
+        self.clarksocket = args.clarksocket
+        self.compression = args.compression
+        self.targetdepth = args.targetdepth
+        # Contig filtering thresholds
+        self.mincontiglength = args.mincontiglength
+        self.mincontigdepth = args.mincontigdepth
+        # Optional SQLite database of the results of all runs
+        self.resultsdatabase = os.path.abspath(args.resultsdatabase) if args.resultsdatabase else None
+        # Dictionary of sample name: priority of the samples to analyse ahead of the rest of the run
+        self.priorities = dict()
+        for entry in (args.priority.split(',') if args.priority else list()):
+            name, _, priority = entry.strip().partition(':')
+            self.priorities[name] = priority if priority else 1
+        # Watch mode settings. The stable time and the timeout are supplied in seconds
+        self.watch = args.watch
+        self.stabletime = float(args.stabletime)
+        self.watchtimeout = float(args.watchtimeout)
+        # Cache of typing results. The cache size is supplied in GB
+        self.resultcache = resultcache.ResultCache(args.cachepath, int(float(args.cachesize) * 1024 ** 3),
+                                                   self.reffilepath, pipelinecommit.decode('utf-8')) \
+            if args.cachepath else None
+        # Scratch space budget of the run. The budget is supplied in GB
+        self.scratchbudget = int(float(args.scratchbudget) * 1024 ** 3) if args.scratchbudget else 0
+        if self.clarksocket:
+            assert os.path.exists(self.clarksocket), 'Cannot find CLARK server socket as specified {0!r:s}'\
+                .format(self.clarksocket)
         # Define the start time
         self.starttime = startingtime
         self.customsamplesheet = args.customsamplesheet
@@ -459,7 +1010,10 @@ class RunSpades(object):
             assert os.path.isfile(self.customsamplesheet), 'Cannot find custom sample sheet as specified {}'\
                 .format(self.customsamplesheet)
         self.basicassembly = args.basicassembly
-        if not self.customsamplesheet and not os.path.isfile(os.path.join(self.path, 'SampleSheet.csv')):
+        # Run folders to analyse together. The path is then the folder of the reports of the batch
+        self.multirun = multirun.run_directories(args.multirun) if args.multirun else list()
+        if not self.multirun and not self.customsamplesheet and \
+                not os.path.isfile(os.path.join(self.path, 'SampleSheet.csv')):
             self.basicassembly = True
             printtime('Could not find a sample sheet. Performing basic assembly (no run metadata captured)',
                       self.starttime)
@@ -474,26 +1028,34 @@ class RunSpades(object):
         self.commit = pipelinecommit.decode('utf-8')
         self.homepath = scriptpath
         self.logfile = os.path.join(self.path, 'logfile')
+        # File used to record the pre-processed samples
+        self.checkpointfile = os.path.join(self.path, 'preprocessed.json')
         self.runinfo = str()
         self.pipeline = True
         self.qualityobject = MetadataObject()
         # Initialise the metadata object
         self.runmetadata = MetadataObject()
+        # Digests of the metadata files written by the pipeline, so that unchanged metadata are not written again
+        self.metadatadigests = dict()
+        # Removes intermediate files once the stages that use them are complete
+        self.intermediates = intermediates.IntermediateTracker(self)
+        # Optional local scratch space on which the samples are processed. The outputs of samples staged by a previous
+        # run that did not finish are recovered to the run folder
+        self.staging = staging.Staging(self, args.stagingpath) if args.stagingpath else None
+        if self.staging and args.stagedatabases:
+            self.reffilepath = self.staging.stage_databases(self.reffilepath)
 
 
-# If the script is called from the command line, then call the argument parser
-if __name__ == '__main__':
-    # Get the current commit of the pipeline from git
-    # Extract the path of the current script from the full path + file name
-    homepath = os.path.split(os.path.abspath(__file__))[0]
-    # Find the commit of the script by running a command to change to the directory containing the script and run
-    # a git command to return the short version of the commit hash
-    commit = subprocess.Popen('cd {} && git tag | tail -n 1'.format(homepath),
-                              shell=True, stdout=subprocess.PIPE).communicate()[0].rstrip()
+def pipeline_parser():
+    """
+    Create the argument parser of the pipeline. The parser is also used by the pipeline job server to parse the
+    arguments of submitted runs
+    :return: ArgumentParser object
+    """
     # Parser for arguments
     parser = ArgumentParser(description='Assemble genomes from Illumina fastq files')
     parser.add_argument('-v', '--version',
-                        action='version', version='%(prog)s commit {}'.format(commit))
+                        action='version', version='%(prog)s commit {}'.format(__version__))
     parser.add_argument('path',
                         help='Specify path')
     parser.add_argument('-n', '--numreads',
@@ -507,8 +1069,10 @@ if __name__ == '__main__':
                         help='Provide the location of the folder containing the pipeline accessory files (reference '
                              'genomes, MLST data, etc.')
     parser.add_argument('-k', '--kmerrange',
-                        default='21,33,55,77,99,127',
-                        help='The range of kmers used in SPAdes assembly. Default is 21,33,55,77,99,127')
+                        help='The range of kmers used in SPAdes assembly of every sample e.g. 21,33,55,77,99,127. By '
+                             'default, the kmers of each sample are selected from its read length and (if estimated '
+                             'with --targetdepth) depth. The kmers of individual samples can also be supplied in a '
+                             'Kmers column of the sample sheet e.g. 21;33;55')
     parser.add_argument('-c', '--customsamplesheet',
                         help='Path of folder containing a custom sample sheet and name of sample sheet file '
                              'e.g. /home/name/folder/BackupSampleSheet.csv. Note that this sheet must still have the '
@@ -519,11 +1083,112 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--preprocess',
                         action='store_true',
                         help='Perform quality trimming and error correction only. Do not assemble the trimmed + '
-                             'corrected reads')
+                             'corrected reads. A later invocation of the pipeline on the same path will use the '
+                             'processed reads')
+    parser.add_argument('-bm', '--batchmash',
+                        action='store_true',
+                        help='Sketch the reads of all samples in a single batch, and compare the batch to the RefSeq '
+                             'sketch with a single mash call. Closest RefSeq genomes are looked up in an indexed copy '
+                             'of the assembly summary')
+    parser.add_argument('-cs', '--clarksocket',
+                        help='Path of the socket of a running CLARK server (cowbat/clarkserver.py). CLARK analyses are '
+                             'submitted to the server, which sets up the database once, and classifies the samples of '
+                             'concurrent runs together. As the database is still loaded for every batch, CLARK '
+                             'analyses are only performed on systems with more than 100 GB of RAM')
+    parser.add_argument('-cp', '--cachepath',
+                        help='Path of a folder in which to cache typing results. Samples with the same name, input '
+                             'reads or assemblies, databases, and analysis parameters as a previous analysis have '
+                             'their results restored from the cache rather than re-analysed')
+    parser.add_argument('-cg', '--cachesize',
+                        default=10,
+                        help='Maximum size of the typing result cache in GB. The least recently used results are '
+                             'removed when this size is exceeded. Default is 10')
+    parser.add_argument('-w', '--watch',
+                        action='store_true',
+                        help='Watch the run folder while the sequencer is writing it. Each sample is processed and '
+                             'assembled as soon as its FASTQ files are complete, and the run metadata are finalised '
+                             'once RunInfo.xml and GenerateFASTQRunStatistics.xml are available')
+    parser.add_argument('-ws', '--stabletime',
+                        default=60,
+                        help='Number of seconds that the FASTQ files of a sample must remain unchanged before the '
+                             'sample is processed in watch mode. Default is 60')
+    parser.add_argument('-wt', '--watchtimeout',
+                        default=86400,
+                        help='Maximum number of seconds to watch the run folder. Samples that are not complete by then '
+                             'are not processed. Default is 86400')
+    parser.add_argument('-pr', '--priority',
+                        help='Comma-separated list of samples to analyse ahead of the rest of the run, with optional '
+                             'priorities e.g. 2018-SEQ-0001:2,2018-SEQ-0002. Samples with higher priorities are '
+                             'analysed first, and the default priority of listed samples is 1. Priorities can also be '
+                             'supplied in a Priority column of the sample sheet. A partial report is created for each '
+                             'prioritised sample in reports/samples as soon as it is complete')
+    parser.add_argument('-sb', '--scratchbudget',
+                        help='Maximum disk space in GB to use in the sequence folder (or in the staging folder if '
+                             '--stagingpath is supplied). Samples are trimmed, corrected, and assembled in batches '
+                             'whose estimated requirements fit within the remaining space. Default is no limit')
+    parser.add_argument('-cm', '--compression',
+                        default='gzip',
+                        choices=['gzip', 'zstd', 'none'],
+                        help='Codec used to compress the large files remaining at the end of the run. Files are '
+                             'compressed concurrently, with pigz (if installed) or zstd using multiple threads per '
+                             'file, and the checksum of each file is verified before the original is removed. The '
+                             'space saved is reported in reports/compression.csv. Default is gzip')
+    parser.add_argument('-td', '--targetdepth',
+                        type=int,
+                        help='Subsample the reads of samples sequenced to a greater depth than the target depth before '
+                             'quality trimming. The genome size and depth of each sample are estimated from a mash '
+                             'sketch of its reads. Default is no subsampling')
+    parser.add_argument('-ml', '--mincontiglength',
+                        default=0,
+                        type=int,
+                        help='Minimum length of the contigs of the assemblies used by the analyses following the '
+                             'assembly. Shorter contigs are moved to the contigfilter folder of the sample. Default is '
+                             '0 (contigs are only filtered by the Qualimap stage)')
+    parser.add_argument('-md', '--mincontigdepth',
+                        default=0,
+                        type=float,
+                        help='Minimum coverage (from the SPAdes contig headers) of the contigs of the assemblies used '
+                             'by the analyses following the assembly. Default is 0')
+    parser.add_argument('-rd', '--resultsdatabase',
+                        help='Path of an SQLite database to which the typing results of the samples are added. The '
+                             'database is created if it does not exist, and collects the results of every run, which '
+                             'can be searched with python -m cowbat.resultsstore')
+    parser.add_argument('-mr', '--multirun',
+                        nargs='+',
+                        metavar='RUN',
+                        help='Run folders, or files listing one run folder per line, to analyse as a single batch. '
+                             'The reads of each run are processed and assembled in the run folder, and the typing '
+                             'stages analyse the samples of all the runs together, so that each database is loaded '
+                             'once per batch. Reports and metadata are created in each run folder. The reports of the '
+                             'individual typing stages are created in the reports folder of path, and the rows of the '
+                             'samples of each run are also written to the reports folder of the run. Reports that '
+                             'cannot be divided by sample e.g. the CLARK Excel reports, are only created in the '
+                             'reports folder of path')
+    parser.add_argument('-sp', '--stagingpath',
+                        help='Fast local scratch folder on which to process the samples. The folder of each sample is '
+                             'copied to the scratch folder before its reads are processed, and copied back to the run '
+                             'folder once the sample has been analysed. The outputs of samples staged by a run that '
+                             'did not finish are recovered by the next run of the same folder')
+    parser.add_argument('-sd', '--stagedatabases',
+                        action='store_true',
+                        help='Copy the databases to the staging folder. The copy is shared by subsequent runs, which '
+                             'only copy the files that have changed')
+    return parser
+
+
+# If the script is called from the command line, then call the argument parser
+if __name__ == '__main__':
+    # Extract the path of the current script from the full path + file name
+    homepath = os.path.split(os.path.abspath(__file__))[0]
+    # The version of the pipeline is a constant in the package, rather than the latest git tag of the repository
+    commit = __version__.encode('utf-8')
+    # Parser for arguments
+    parser = pipeline_parser()
     # Get the arguments into an object
     arguments = parser.parse_args()
     starttime = time()
     # Run the pipeline
     pipeline = RunSpades(arguments, commit, starttime, homepath)
     pipeline.main()
-    printtime('Assembly and characterisation complete', starttime)
+    if not arguments.preprocess:
+        printtime('Assembly and characterisation complete', starttime)
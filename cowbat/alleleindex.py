@@ -0,0 +1,280 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import GenObject, make_path, printtime
+from cowbat.profileindex import open_profile_index
+from Bio import SeqIO
+from glob import glob
+import hashlib
+import sqlite3
+import os
+__author__ = 'adamkoziol'
+
+
+def sequence_digest(sequence):
+    """
+    :param sequence: nucleotide sequence
+    :return: digest of the upper case sequence
+    """
+    return hashlib.sha1(sequence.upper().encode('utf-8')).hexdigest()
+
+
+def split_allele(recordid):
+    """
+    Split an allele name into the locus and allele number e.g. adk_12 becomes adk, 12 and BACT000001-34 becomes
+    BACT000001, 34
+    :param recordid: name of the allele
+    :return: locus, allele number
+    """
+    locus, allele = recordid.replace('-', '_').rsplit('_', 1)
+    return locus, allele
+
+
+def allele_files(targetpath):
+    """
+    Find the allele files of a typing scheme. Individual allele files (.tfa) are preferred, otherwise the combined
+    allele file (.fasta) is used
+    :param targetpath: folder containing the scheme
+    :return: sorted list of allele files
+    """
+    files = glob(os.path.join(targetpath, '*.tfa'))
+    if not files:
+        files = glob(os.path.join(targetpath, '*.fasta'))
+    return sorted(files)
+
+
+def allele_signature(targetpath):
+    """
+    Summarise the names, sizes, and modification times of the allele files of a scheme. The signature is stored in the
+    allele index, and used to determine whether the index is current
+    :param targetpath: folder containing the allele files of the scheme
+    :return: digest of the listing of the allele files
+    """
+    listing = list()
+    for allelefile in allele_files(targetpath):
+        stats = os.stat(allelefile)
+        listing.append('{name}_{size}_{mtime}'.format(name=os.path.basename(allelefile),
+                                                      size=stats.st_size,
+                                                      mtime=int(stats.st_mtime)))
+    return hashlib.sha1('\n'.join(listing).encode('utf-8')).hexdigest()
+
+
+def create_allele_index(targetpath, indexfile=None, anchorlength=20):
+    """
+    Create an index of the alleles of a typing scheme, keyed by the digest of each allele sequence. The first bases of
+    each allele (the anchor) are also stored, so that candidate alleles can be rapidly extracted from assemblies. The
+    index is only rebuilt if the allele files change
+    :param targetpath: folder containing the allele files of the scheme
+    :param indexfile: name and path of the index. Defaults to alleles.sqlite in the target path
+    :param anchorlength: number of bases at the start of each allele to use as an anchor
+    :return: name and path of the index
+    """
+    indexfile = indexfile if indexfile else os.path.join(targetpath, 'alleles.sqlite')
+    signature = allele_signature(targetpath)
+    if os.path.isfile(indexfile):
+        try:
+            db = sqlite3.connect(indexfile)
+            try:
+                meta = dict(db.execute('SELECT key, value FROM meta'))
+            finally:
+                db.close()
+            if meta.get('signature') == signature and meta.get('anchorlength') == str(anchorlength):
+                return indexfile
+        except sqlite3.Error:
+            pass
+    tmpfile = indexfile + '.tmp'
+    if os.path.isfile(tmpfile):
+        os.remove(tmpfile)
+    db = sqlite3.connect(tmpfile)
+    db.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+    db.execute('CREATE TABLE alleles (digest TEXT, locus TEXT, allele TEXT, length INTEGER)')
+    db.execute('CREATE TABLE anchors (anchor TEXT, length INTEGER, PRIMARY KEY (anchor, length)) WITHOUT ROWID')
+    for allelefile in allele_files(targetpath):
+        alleles = list()
+        anchors = set()
+        for record in SeqIO.parse(allelefile, 'fasta'):
+            sequence = str(record.seq).upper()
+            # Alleles with gaps or ambiguous bases cannot be matched exactly
+            if len(sequence) < anchorlength or set(sequence) - set('ACGT'):
+                continue
+            try:
+                locus, allele = split_allele(record.id)
+            except ValueError:
+                continue
+            alleles.append((sequence_digest(sequence), locus, allele, len(sequence)))
+            anchors.add((sequence[:anchorlength], len(sequence)))
+        db.executemany('INSERT INTO alleles VALUES (?, ?, ?, ?)', alleles)
+        db.executemany('INSERT OR IGNORE INTO anchors VALUES (?, ?)', sorted(anchors))
+    db.execute('CREATE INDEX digests ON alleles (digest)')
+    db.execute('INSERT INTO meta VALUES (?, ?)', ('anchorlength', str(anchorlength)))
+    db.execute('INSERT INTO meta VALUES (?, ?)', ('signature', signature))
+    db.commit()
+    db.close()
+    os.replace(tmpfile, indexfile)
+    return indexfile
+
+
+def reverse_complement(sequence):
+    """
+    :param sequence: upper case nucleotide sequence
+    :return: reverse complement of the sequence
+    """
+    return sequence.translate(str.maketrans('ACGTN', 'TGCAN'))[::-1]
+
+
+class AlleleIndex(object):
+
+    def scan(self, sequence):
+        """
+        Find all the exact allele matches in a sequence (both strands)
+        :param sequence: nucleotide sequence e.g. a contig
+        :return: dictionary of locus: set of allele numbers
+        """
+        matches = dict()
+        sequence = sequence.upper()
+        for strand in [sequence, reverse_complement(sequence)]:
+            for position in range(len(strand) - self.anchorlength + 1):
+                lengths = self.anchors.get(strand[position:position + self.anchorlength])
+                if lengths:
+                    for length in lengths:
+                        if position + length <= len(strand):
+                            for locus, allele in self.lookup(strand[position:position + length]):
+                                matches.setdefault(locus, set()).add(allele)
+        return matches
+
+    def lookup(self, sequence):
+        """
+        :param sequence: nucleotide sequence
+        :return: list of (locus, allele number) of alleles identical to the sequence
+        """
+        return self.db.execute('SELECT locus, allele FROM alleles WHERE digest = ?',
+                               (sequence_digest(sequence),)).fetchall()
+
+    def close(self):
+        self.db.close()
+
+    def __init__(self, indexfile):
+        self.indexfile = indexfile
+        self.db = sqlite3.connect('file:{}?mode=ro'.format(self.indexfile), uri=True)
+        self.anchorlength = int(self.db.execute('SELECT value FROM meta WHERE key = ?', ('anchorlength',))
+                                .fetchone()[0])
+        # Load the anchors into memory - there are far fewer anchors than alleles
+        self.anchors = dict()
+        for anchor, length in self.db.execute('SELECT anchor, length FROM anchors'):
+            self.anchors.setdefault(anchor, list()).append(length)
+        self.loci = sorted(locus for (locus,) in self.db.execute('SELECT DISTINCT locus FROM alleles'))
+
+
+class AlleleHashTyping(object):
+    """
+    Assembly-based sequence typing using exact allele matches. Samples with an exact match to every locus in the
+    scheme, and a sequence type in the profile table are typed directly. All other samples are returned, so that they
+    can be typed with the alignment-based method
+    """
+
+    def main(self):
+        """
+        Type the samples
+        :return: list of samples that could not be typed with exact allele matches
+        """
+        printtime('Performing {} allele hash typing'.format(self.analysistype), self.starttime)
+        unresolved = list()
+        for sample in self.metadata:
+            if not self.type_sample(sample):
+                unresolved.append(sample)
+        for index in self.indexes.values():
+            index.close()
+        if len(unresolved) < len(self.metadata):
+            printtime('Typed {num} of {total} samples with exact {at} allele matches'
+                      .format(num=len(self.metadata) - len(unresolved),
+                              total=len(self.metadata),
+                              at=self.analysistype), self.starttime)
+        return unresolved
+
+    def type_sample(self, sample):
+        """
+        Find the exact allele matches in the assembly of a sample, and determine the sequence type
+        :param sample: metadata object
+        :return: boolean of whether the sample was typed
+        """
+        if sample.general.bestassemblyfile == 'NA' or not os.path.isfile(sample.general.bestassemblyfile):
+            return False
+        if self.analysistype == 'rmlst':
+            targetdir = self.targetpath
+        else:
+            genus = sample.general.datastore.get('referencegenus')
+            targetdir = os.path.join(self.targetpath, str(genus))
+        indexfile = os.path.join(targetdir, 'alleles.sqlite')
+        profileindex = os.path.join(targetdir, 'profiles.npy')
+        # The indexes must be created during database setup
+        if not os.path.isfile(indexfile) or not os.path.isfile(profileindex):
+            return False
+        if targetdir not in self.indexes:
+            self.indexes[targetdir] = AlleleIndex(indexfile)
+        index = self.indexes[targetdir]
+        profile = open_profile_index(profileindex)
+        # Find the exact matches in all the contigs of the assembly
+        matches = dict()
+        for record in SeqIO.parse(sample.general.bestassemblyfile, 'fasta'):
+            for locus, alleles in index.scan(str(record.seq)).items():
+                matches.setdefault(locus, set()).update(alleles)
+        # Every locus must have a single exact match
+        if any(len(matches.get(locus, set())) != 1 for locus in profile.loci):
+            return False
+        alleles = {locus: list(matches[locus])[0] for locus in profile.loci}
+        sequencetype = profile.sequencetype(alleles)
+        if sequencetype is None:
+            return False
+        # Populate the metadata with the same attributes as MLSTSippr
+        setattr(sample, self.analysistype, GenObject())
+        sample[self.analysistype].runanalysis = True
+        sample[self.analysistype].analysistype = self.analysistype
+        sample[self.analysistype].typingmethod = 'allele_hash'
+        sample[self.analysistype].profile = profile.profilefile
+        sample[self.analysistype].combinedalleles = index.indexfile
+        sample[self.analysistype].targetpath = targetdir
+        sample[self.analysistype].alleledir = targetdir
+        sample[self.analysistype].alleles = profile.loci
+        sample[self.analysistype].allelenames = profile.loci
+        sample[self.analysistype].reportdir = os.path.join(sample.general.outputdirectory, self.analysistype)
+        sample[self.analysistype].results = {'{}_{}'.format(locus, allele): '100.00'
+                                             for locus, allele in alleles.items()}
+        sample[self.analysistype].profilealleles = alleles
+        sample[self.analysistype].sequencetype = sequencetype
+        sample[self.analysistype].matches = len(profile.loci)
+        sample[self.analysistype].matchestosequencetype = len(profile.loci)
+        self.typed.append(sample)
+        return True
+
+    def reporter(self, append=True):
+        """
+        Create the reports of the typed samples in the same format as the MLSTSippr reports. The rows are appended to
+        the combined report, so this method must be run after the alignment-based typing of the remaining samples
+        :param append: boolean of whether to append to the combined report created by the alignment-based typing
+        """
+        make_path(self.reportpath)
+        combinedrow = str()
+        for sample in self.typed:
+            make_path(sample[self.analysistype].reportdir)
+            loci = sample[self.analysistype].allelenames
+            row = 'Strain,Genus,SequenceType,Matches,{},\n'.format(','.join(loci))
+            row += '{},{},{},{},'.format(sample.name, sample.general.referencegenus,
+                                         sample[self.analysistype].sequencetype, sample[self.analysistype].matches)
+            row += ''.join('{},'.format(sample[self.analysistype].profilealleles[locus]) for locus in loci)
+            row += '\n'
+            with open(os.path.join(sample[self.analysistype].reportdir,
+                                   '{}_{}.csv'.format(sample.name, self.analysistype)), 'w') as report:
+                report.write(row)
+            combinedrow += row
+        if combinedrow:
+            with open(os.path.join(self.reportpath, '{}.csv'.format(self.analysistype)),
+                      'a' if append else 'w') as combinedreport:
+                combinedreport.write(combinedrow)
+
+    def __init__(self, inputobject, analysistype):
+        self.metadata = inputobject.runmetadata.samples
+        self.starttime = inputobject.starttime
+        self.reportpath = inputobject.reportpath
+        self.analysistype = analysistype.lower()
+        self.targetpath = os.path.join(inputobject.reffilepath, analysistype)
+        # Dictionary of target folder: allele index. Each index is only opened once
+        self.indexes = dict()
+        self.typed = list()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import printtime, make_path
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import DEVNULL, PIPE, Popen
+from shutil import which
+import hashlib
+import gzip
+import csv
+import os
+__author__ = 'adamkoziol'
+
+# Extensions of the uncompressed text files created by the analyses e.g. CLARK classifications, SAM files, and
+# baited reads, which are worth compressing
+COMPRESSIBLE = ('.fastq', '.fq', '.fasta', '.fa', '.fna', '.ffn', '.sam', '.csv', '.tsv', '.txt', '.tab', '.fastg',
+                '.gfa', '.xml')
+# Size of the blocks read when hashing files
+BLOCKSIZE = 4 * 1024 ** 2
+
+
+def file_digest(stream):
+    """
+    :param stream: file object opened in binary mode
+    :return: SHA-256 hex digest of the contents of the stream
+    """
+    sha = hashlib.sha256()
+    for block in iter(lambda: stream.read(BLOCKSIZE), b''):
+        sha.update(block)
+    return sha.hexdigest()
+
+
+class Archiver(object):
+    """
+    Compresses the large files that remain in the sample folders once the temporary files have been removed. Files are
+    compressed concurrently, and large files are compressed with multiple threads by pigz or zstd. Each compressed file
+    is decompressed, and its checksum compared to the original before the original is removed
+    """
+
+    def main(self):
+        """
+        Find and compress the files, and report the space saved
+        """
+        if self.codec == 'none':
+            return
+        files = self.find_files()
+        if not files:
+            return
+        printtime('Compressing {num} files with {codec}'.format(num=len(files),
+                                                                 codec=self.command), self.starttime)
+        # Divide the threads between the files. Each file is compressed with at least one thread
+        workers = min(len(files), self.cpus)
+        threads = max(int(self.cpus / workers), 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda filename: self.compress(filename, threads), files))
+        self.reporter(results)
+
+    def find_files(self):
+        """
+        Find the uncompressed files in the sample folders that are larger than the minimum size. Assemblies are not
+        compressed, as they are used by the reports and subsequent analyses
+        :return: list of files sorted from largest to smallest, so that the largest files start first
+        """
+        keep = set()
+        for sample in self.metadata:
+            for attr in ['bestassemblyfile', 'filteredfile']:
+                filename = sample.general.datastore.get(attr, 'NA')
+                if filename != 'NA':
+                    keep.add(os.path.abspath(filename))
+        files = list()
+        for sample in self.metadata:
+            for path, dirs, filenames in os.walk(sample.general.outputdirectory):
+                for filename in filenames:
+                    filepath = os.path.abspath(os.path.join(path, filename))
+                    if not filename.endswith(COMPRESSIBLE) or filepath in keep or os.path.islink(filepath):
+                        continue
+                    if filename == '{}_metadata.json'.format(sample.name):
+                        continue
+                    if os.path.getsize(filepath) >= self.minsize:
+                        files.append(filepath)
+        return sorted(set(files), key=os.path.getsize, reverse=True)
+
+    def compress(self, filename, threads):
+        """
+        Compress a file, verify the checksum of the decompressed output, and remove the original
+        :param filename: name and path of the file
+        :param threads: number of threads used to compress the file
+        :return: dictionary of the file name, the original and compressed sizes, the checksum, and the status
+        """
+        output = filename + self.extension
+        temporary = output + '.tmp'
+        result = {'file': filename,
+                  'codec': self.command,
+                  'original': os.path.getsize(filename),
+                  'compressed': 0,
+                  'sha256': str(),
+                  'status': 'failed'}
+        try:
+            with open(filename, 'rb') as original:
+                result['sha256'] = file_digest(original)
+            if self.command == 'gzip (python)':
+                with open(filename, 'rb') as original, gzip.open(temporary, 'wb', compresslevel=6) as compressed:
+                    for block in iter(lambda: original.read(BLOCKSIZE), b''):
+                        compressed.write(block)
+            else:
+                with open(temporary, 'wb') as compressed:
+                    process = Popen(self.compress_command(threads) + [filename], stdout=compressed, stderr=PIPE)
+                    err = process.communicate()[1]
+                assert process.returncode == 0, 'Could not compress {0!r:s}: {1}'\
+                    .format(filename, err.decode('utf-8', 'replace'))
+            # Verify the compressed file before removing the original
+            if self.decompressed_digest(temporary) != result['sha256']:
+                result['status'] = 'checksum mismatch'
+                os.remove(temporary)
+                return result
+            os.replace(temporary, output)
+            os.remove(filename)
+            result['compressed'] = os.path.getsize(output)
+            result['status'] = 'compressed'
+        except (AssertionError, IOError, OSError) as error:
+            result['status'] = 'failed: {}'.format(error)
+            if os.path.isfile(temporary):
+                os.remove(temporary)
+        return result
+
+    def compress_command(self, threads):
+        """
+        :param threads: number of threads to use
+        :return: command that writes the compressed contents of a file to stdout
+        """
+        if self.command == 'pigz':
+            return ['pigz', '-c', '-p', str(threads)]
+        if self.command == 'zstd':
+            return ['zstd', '-c', '-q', '-T{}'.format(threads)]
+        return ['gzip', '-c']
+
+    def decompressed_digest(self, filename):
+        """
+        :param filename: name and path of a compressed file
+        :return: SHA-256 hex digest of the decompressed contents of the file
+        """
+        if self.command == 'gzip (python)':
+            with gzip.open(filename, 'rb') as compressed:
+                return file_digest(compressed)
+        process = Popen([self.command, '-d', '-c', filename], stdout=PIPE, stderr=DEVNULL)
+        digest = file_digest(process.stdout)
+        process.stdout.close()
+        process.wait()
+        return digest if process.returncode == 0 else str()
+
+    def reporter(self, results):
+        """
+        Write the outcome of the compression of each file to reports/compression.csv, and print the space saved
+        :param results: list of the dictionaries returned by compress
+        """
+        make_path(self.reportpath)
+        with open(os.path.join(self.reportpath, 'compression.csv'), 'w') as report:
+            writer = csv.writer(report)
+            writer.writerow(['File', 'Codec', 'OriginalSize', 'CompressedSize', 'SHA256', 'Status'])
+            for result in results:
+                writer.writerow([result['file'], result['codec'], result['original'], result['compressed'],
+                                 result['sha256'], result['status']])
+        compressed = [result for result in results if result['status'] == 'compressed']
+        self.saved = sum(result['original'] - result['compressed'] for result in compressed)
+        failed = len(results) - len(compressed)
+        printtime('Compressed {num} files, saving {size:.2f} GB{failed}'
+                  .format(num=len(compressed),
+                          size=self.saved / 1024 ** 3,
+                          failed='. {} files could not be compressed'.format(failed) if failed else str()),
+                  self.starttime)
+
+    def __init__(self, inputobject, codec='gzip', minsize=1024 ** 2):
+        """
+        :param inputobject: RunSpades object
+        :param codec: gzip, zstd, or none
+        :param minsize: minimum size in bytes of files to compress
+        """
+        self.metadata = inputobject.runmetadata.samples
+        self.starttime = inputobject.starttime
+        self.cpus = int(inputobject.cpus)
+        self.reportpath = inputobject.reportpath
+        self.codec = codec
+        self.minsize = minsize
+        self.saved = 0
+        if self.codec == 'zstd':
+            assert which('zstd'), 'Cannot find zstd. Install zstd, or use the gzip codec'
+            self.command = 'zstd'
+            self.extension = '.zst'
+        else:
+            # Use the multithreaded pigz if it is installed. The output is gzip-compatible either way
+            self.command = 'pigz' if which('pigz') else 'gzip' if which('gzip') else 'gzip (python)'
+            self.extension = '.gz'
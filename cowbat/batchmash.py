@@ -0,0 +1,160 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import printtime, make_path, write_to_logfile, GenObject
+from cowbat.refseqindex import create_refseq_index, RefSeqIndex
+from biotools import mash
+import os
+__author__ = 'adamkoziol'
+
+
+class BatchMash(object):
+
+    def main(self):
+        """
+        Sketch the reads of all the samples in a single batch, compare the batch to the RefSeq sketch with a single
+        mash dist call, and determine the closest RefSeq genome of each sample
+        """
+        self.sketching()
+        self.mashing()
+        self.parse()
+        self.reporter()
+
+    def sketching(self):
+        """
+        Create a single sketch file containing the trimmed, corrected reads of every sample
+        """
+        printtime('Indexing files for {} analysis'.format(self.analysistype), self.starttime)
+        make_path(self.batchpath)
+        for sample in self.metadata:
+            # Create the analysis type-specific GenObject
+            setattr(sample, self.analysistype, GenObject())
+            # Set attributes
+            sample[self.analysistype].reportdir = os.path.join(sample.general.outputdirectory, self.analysistype)
+            make_path(sample[self.analysistype].reportdir)
+            sample[self.analysistype].targetpath = self.targetpath
+            sample[self.analysistype].refseqsketch = self.refseqsketch
+            sample[self.analysistype].sketchfile = self.sketchfile
+            sample[self.analysistype].mashresults = os.path.join(sample[self.analysistype].reportdir,
+                                                                 '{}.tab'.format(sample.name))
+            # Link each of the FASTQ files of the sample to the sample, as the query name in the mash outputs is
+            # the name of the file
+            if type(sample.general.trimmedcorrectedfastqfiles) is list:
+                for fastq in sample.general.trimmedcorrectedfastqfiles:
+                    self.querydict[fastq] = sample
+        # Record the FASTQ files included in the batch
+        with open(self.filelist, 'w') as filelist:
+            filelist.write('\n'.join(sorted(self.querydict)))
+        # Sketch all the files with a single call - each file is sketched independently, so this is equivalent to
+        # sketching the samples one at a time
+        if self.querydict:
+            out, err, cmd = mash.sketch(*sorted(self.querydict),
+                                        output_sketch=self.sketchfilenoext,
+                                        threads=self.cpus,
+                                        returncmd=True,
+                                        m=2)
+            write_to_logfile(out, err, self.logfile)
+            for sample in self.metadata:
+                sample.commands.sketch = cmd
+
+    def mashing(self):
+        """
+        Compare the batch sketch to the RefSeq sketch. As all the samples are contained in a single sketch, the RefSeq
+        sketch only has to be loaded once per run
+        """
+        printtime('Performing {} analyses'.format(self.analysistype), self.starttime)
+        if self.querydict:
+            out, err, cmd = mash.dist(self.refseqsketch, self.sketchfile,
+                                      output_file=self.mashresults,
+                                      threads=self.cpus,
+                                      returncmd=True)
+            write_to_logfile(out, err, self.logfile)
+            for sample in self.metadata:
+                sample.commands.mash = cmd
+
+    def parse(self):
+        """
+        Find the closest RefSeq genome of each sample in the batch outputs, and look up its name in the indexed RefSeq
+        assembly summary
+        """
+        printtime('Determining closest refseq genome', self.starttime)
+        # Dictionary of sample name: best (lowest distance) line of the mash outputs
+        besthits = dict()
+        if os.path.isfile(self.mashresults):
+            # Stream through the outputs, as every query is compared to every RefSeq genome
+            with open(self.mashresults) as results:
+                for line in results:
+                    data = line.rstrip().split('\t')
+                    try:
+                        sample = self.querydict[data[1]]
+                        distance = float(data[2])
+                    except (KeyError, IndexError, ValueError):
+                        continue
+                    if sample.name not in besthits or distance < besthits[sample.name][0]:
+                        besthits[sample.name] = (distance, data)
+        # Create the index of the assembly summary as required. As the index is stored in the database folder, it is
+        # only created the first time that it is required
+        refseq = RefSeqIndex(create_refseq_index(self.summaryfile))
+        for sample in self.metadata:
+            try:
+                distance, data = besthits[sample.name]
+                # Write the best hit to the sample-specific outputs
+                with open(sample[self.analysistype].mashresults, 'w') as mashresults:
+                    mashresults.write('\t'.join(data) + '\n')
+                referenceid, queryid, sample[self.analysistype].mashdistance, sample[self.analysistype]. \
+                    pvalue, sample[self.analysistype].nummatches = data
+                # Find the genus and species of the sample using the index of the refseq summaries
+                sample[self.analysistype].closestrefseq = refseq.lookup(referenceid)
+                sample[self.analysistype].closestrefseqgenus = sample[self.analysistype].closestrefseq.split()[0]
+                sample[self.analysistype].closestrefseqspecies = sample[self.analysistype].closestrefseq.split()[1]
+            except (KeyError, ValueError, IndexError):
+                sample[self.analysistype].closestrefseq = 'NA'
+                sample[self.analysistype].closestrefseqgenus = 'NA'
+                sample[self.analysistype].closestrefseqspecies = 'NA'
+                sample[self.analysistype].mashdistance = 'NA'
+                sample[self.analysistype].pvalue = 'NA'
+                sample[self.analysistype].nummatches = 'NA'
+            # Set the closest refseq genus - will be used for all typing that requires the genus to be known
+            sample.general.referencegenus = sample[self.analysistype].closestrefseqgenus
+        refseq.close()
+
+    def reporter(self):
+        """
+        Create the mash report. The format is identical to the report created by MASHsippr
+        """
+        make_path(self.reportpath)
+        header = 'Strain,ReferenceGenus,ReferenceFile,ReferenceGenomeMashDistance,Pvalue,NumMatchingHashes\n'
+        data = ''
+        for sample in self.metadata:
+            try:
+                data += '{},{},{},{},{},{}\n'.format(sample.name,
+                                                     sample[self.analysistype].closestrefseqgenus,
+                                                     sample[self.analysistype].closestrefseq,
+                                                     sample[self.analysistype].mashdistance,
+                                                     sample[self.analysistype].pvalue,
+                                                     sample[self.analysistype].nummatches)
+            except AttributeError:
+                data += '{}\n'.format(sample.name)
+        # Create the report file
+        reportfile = os.path.join(self.reportpath, 'mash.csv')
+        with open(reportfile, 'w') as report:
+            report.write(header)
+            report.write(data)
+
+    def __init__(self, inputobject, analysistype):
+        self.metadata = inputobject.runmetadata.samples
+        self.referencefilepath = inputobject.reffilepath
+        self.starttime = inputobject.starttime
+        self.reportpath = inputobject.reportpath
+        self.logfile = inputobject.logfile
+        self.cpus = inputobject.cpus
+        self.analysistype = analysistype
+        self.targetpath = os.path.join(self.referencefilepath, self.analysistype)
+        self.refseqsketch = os.path.join(self.targetpath, 'RefSeqSketchesDefaults.msh')
+        self.summaryfile = os.path.join(self.targetpath, 'assembly_summary_refseq.txt')
+        # Run-level outputs are stored in a folder in the sequence path
+        self.batchpath = os.path.join(inputobject.path, self.analysistype)
+        self.filelist = os.path.join(self.batchpath, 'fastqfiles.txt')
+        self.sketchfilenoext = os.path.join(self.batchpath, 'batch')
+        self.sketchfile = self.sketchfilenoext + '.msh'
+        self.mashresults = os.path.join(self.batchpath, 'batch.tab')
+        # Dictionary of FASTQ file: sample
+        self.querydict = dict()
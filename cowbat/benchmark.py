@@ -0,0 +1,594 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import printtime, make_path, MetadataObject
+from cowbat.lazyimport import LazyModule
+from argparse import ArgumentParser
+from Bio import SeqIO
+from glob import glob
+from time import time
+import multiprocessing
+import tracemalloc
+import subprocess
+import resource
+import shutil
+import numpy
+import gzip
+import json
+import sys
+import os
+__author__ = 'adamkoziol'
+
+# The pipeline and database set-up scripts are imported from the root of the repository once the benchmark starts
+assembly_pipeline = LazyModule('assembly_pipeline')
+database_setup = LazyModule('database_setup')
+get_mlst = LazyModule('get.get_mlst')
+get_rmlst = LazyModule('get.get_rmlst')
+
+# Synthetic datasets: number of samples, sequencing depth, and number of alleles per locus of the synthetic scheme
+SCALES = {'small': {'samples': 1, 'depth': 20, 'alleles': 50},
+          'medium': {'samples': 16, 'depth': 50, 'alleles': 200},
+          'large': {'samples': 96, 'depth': 100, 'alleles': 1000}}
+# Stages of the pipeline, in the order in which they are benchmarked
+PIPELINESTAGES = ['helper', 'read_processing', 'run_spades', 'qualimap', 'contig_filter', 'quality_features',
+                  'prodigal', 'genome_qaml', 'clark', 'mash', 'rmlst', 'sixteens', 'run_gdcs', 'genesippr', 'plasmids',
+                  'plasmid_extractor', 'ressippr', 'assembly_search', 'virulence', 'typing', 'sample_reports',
+                  'finish']
+# Database download and set-up stages, which are run against local copies of synthetic databases
+DATABASESTAGES = ['get_mlst', 'combinealleles', 'scheme_indexes', 'database_download', 'combinetargets']
+# Measurements compared to the baseline, and the differences below which changes are ignored as noise
+METRICS = {'walltime': 1.0,
+           'cputime': 1.0,
+           'childcputime': 1.0,
+           'maxrss': 64 * 1024 ** 2,
+           'childmaxrss': 64 * 1024 ** 2,
+           'pythonpeak': 16 * 1024 ** 2}
+# Genus of the synthetic MLST scheme
+SPECIES = 'Benchmarkia synthetica'
+BASES = numpy.frombuffer(b'ACGT', dtype=numpy.uint8)
+# Lookup table of the complement of each base
+COMPLEMENT = numpy.arange(256, dtype=numpy.uint8)
+COMPLEMENT[[ord(base) for base in 'ACGT']] = [ord(base) for base in 'TGCA']
+
+
+def random_genome(length, seed, inserts=None):
+    """
+    Create a random genome
+    :param length: length of the genome
+    :param seed: seed of the random number generator, so that every benchmark uses the same genome
+    :param inserts: optional list of sequences to insert at regular intervals, so that the typing stages find targets.
+    Sequences that do not fit in the genome are not inserted
+    :return: genome as a numpy array of bytes
+    """
+    state = numpy.random.RandomState(seed)
+    genome = BASES[state.randint(0, 4, length)]
+    inserts = inserts if inserts else list()
+    spacing = length // (len(inserts) + 1)
+    for number, sequence in enumerate(inserts):
+        start = spacing * (number + 1)
+        if start + len(sequence) <= length:
+            genome[start:start + len(sequence)] = numpy.frombuffer(sequence.encode('ascii'), dtype=numpy.uint8)
+    return genome
+
+
+def simulate_reads(genome, depth, forward, reverse, name, seed, readlength=150, insertsize=350, errorrate=0.002):
+    """
+    Simulate paired-end Illumina reads from a genome, and write them to gzip-compressed FASTQ files
+    :param genome: numpy array of bytes created by random_genome
+    :param depth: sequencing depth
+    :param forward: name and path of the forward FASTQ file
+    :param reverse: name and path of the reverse FASTQ file
+    :param name: name used in the read headers
+    :param seed: seed of the random number generator
+    :param readlength: length of the reads
+    :param insertsize: mean insert size
+    :param errorrate: proportion of bases with substitution errors
+    :return: number of bases in the reads
+    """
+    state = numpy.random.RandomState(seed)
+    assert len(genome) >= readlength, 'Genome {0!r:s} is shorter than the reads'.format(name)
+    # Number of read pairs required to reach the depth
+    pairs = max(int(len(genome) * depth / (2 * readlength)), 1)
+    inserts = numpy.clip(state.normal(insertsize, insertsize / 10, pairs).astype(int), readlength, len(genome))
+    starts = (state.random_sample(pairs) * (len(genome) - inserts + 1)).astype(int)
+    offsets = numpy.arange(readlength)
+    forwardreads = genome[starts[:, None] + offsets]
+    # Reverse reads are the reverse complement of the other end of the insert
+    reverseends = starts + inserts - readlength
+    reversereads = numpy.ascontiguousarray(COMPLEMENT[genome[reverseends[:, None] + offsets]][:, ::-1])
+    for reads, fastq, direction in [(forwardreads, forward, 1), (reversereads, reverse, 2)]:
+        errors = state.random_sample(reads.shape) < errorrate
+        reads[errors] = BASES[state.randint(0, 4, int(errors.sum()))]
+        qualities = (state.randint(25, 41, reads.shape) + 33).astype(numpy.uint8)
+        # A fast compression level, as the files are only read by the benchmarks
+        with gzip.open(fastq, 'wb', compresslevel=1) as fastqfile:
+            for number in range(pairs):
+                fastqfile.write('@{name}:{number} {direction}:N:0:1\n'.format(name=name,
+                                                                            number=number + 1,
+                                                                            direction=direction).encode('ascii'))
+                fastqfile.write(reads[number].tobytes() + b'\n+\n' + qualities[number].tobytes() + b'\n')
+    return 2 * pairs * readlength
+
+
+def simulate_assembly(genome, assemblyfile, depth, seed, contiglength=20000):
+    """
+    Split a genome into contigs with SPAdes-formatted headers
+    :param genome: numpy array of bytes created by random_genome
+    :param assemblyfile: name and path of the FASTA file to create
+    :param depth: coverage included in the contig headers
+    :param seed: seed of the random number generator
+    :param contiglength: mean contig length
+    :return: number of contigs
+    """
+    state = numpy.random.RandomState(seed)
+    contigs = list()
+    start = 0
+    while start < len(genome):
+        end = min(start + max(int(state.exponential(contiglength)), 500), len(genome))
+        contigs.append(genome[start:end])
+        start = end
+    # SPAdes sorts the contigs from the longest to the shortest
+    contigs.sort(key=len, reverse=True)
+    with open(assemblyfile, 'w') as assembly:
+        for number, contig in enumerate(contigs):
+            sequence = contig.tobytes().decode('ascii')
+            assembly.write('>NODE_{number}_length_{length}_cov_{cov:.6f}\n'.format(number=number + 1,
+                                                                                 length=len(sequence),
+                                                                                 cov=state.normal(depth, depth / 10)))
+            for position in range(0, len(sequence), 60):
+                assembly.write(sequence[position:position + 60] + '\n')
+    return len(contigs)
+
+
+def planted_sequences(referencepath):
+    """
+    Find sequences from the typing databases to insert into the synthetic genomes. The first allele of each MLST
+    locus, and the first target of each genesippr genus, are used
+    :param referencepath: path of the databases
+    :return: list of sequences
+    """
+    sequences = list()
+    for fasta in sorted(glob(os.path.join(referencepath, 'MLST', '*', '*.tfa'))) + \
+            sorted(glob(os.path.join(referencepath, 'genesippr', '*.tfa'))):
+        for record in SeqIO.parse(fasta, 'fasta'):
+            sequence = str(record.seq).upper()
+            # Sequences with gaps or ambiguous bases are skipped
+            if sequence and not set(sequence) - set('ACGT'):
+                sequences.append(sequence)
+            break
+    return sequences
+
+
+def synthetic_scheme(schemepath, alleles, seed, loci=53, length=500, profiles=5000):
+    """
+    Create a synthetic rMLST-like typing scheme. The alleles of each locus are point mutants of a random sequence
+    :param schemepath: folder in which to create the allele files and profile table
+    :param alleles: number of alleles per locus
+    :param seed: seed of the random number generator
+    :param loci: number of loci
+    :param length: length of the alleles
+    :param profiles: number of profiles in the profile table
+    :return: list of the names of the loci
+    """
+    state = numpy.random.RandomState(seed)
+    make_path(schemepath)
+    names = ['BACT{:06d}'.format(number + 1) for number in range(loci)]
+    for locus in names:
+        reference = BASES[state.randint(0, 4, length)]
+        with open(os.path.join(schemepath, '{}.tfa'.format(locus)), 'w') as allelefile:
+            for allele in range(alleles):
+                sequence = reference.copy()
+                sequence[state.randint(0, length, 3)] = BASES[state.randint(0, 4, 3)]
+                allelefile.write('>{locus}_{allele}\n{sequence}\n'.format(locus=locus,
+                                                                         allele=allele + 1,
+                                                                         sequence=sequence.tobytes().decode('ascii')))
+    with open(os.path.join(schemepath, 'profile.txt'), 'w') as profile:
+        profile.write('\t'.join(['ST'] + names) + '\n')
+        for sequencetype in range(profiles):
+            profile.write('\t'.join([str(sequencetype + 1)] +
+                                    [str(allele) for allele in state.randint(1, alleles + 1, loci)]) + '\n')
+    return names
+
+
+def synthetic_repository(schemepath, loci, repositorypath):
+    """
+    Create the pubmlst.org XML listing of the synthetic scheme with file:// URLs, so that it can be downloaded by
+    get_mlst, and a git repository of the alleles in the format of the CGE databases, so that it can be cloned by the
+    database set-up
+    :param schemepath: folder containing the synthetic scheme
+    :param loci: list of the names of the loci of the scheme
+    :param repositorypath: folder of the git repository
+    :return: name and path of the XML listing
+    """
+    listing = os.path.join(schemepath, 'dbases.xml')
+    with open(listing, 'w') as xml:
+        xml.write('<data>\n<species>{species}\n<mlst>\n<database>\n<url>file://{path}</url>\n'
+                  '<retrieved>2018-01-01</retrieved>\n<profiles>\n<count>0</count>\n<url>file://{profile}</url>\n'
+                  '</profiles>\n<loci>\n'.format(species=SPECIES,
+                                                path=schemepath,
+                                                profile=os.path.join(schemepath, 'profile.txt')))
+        for locus in loci:
+            xml.write('<locus>{locus}\n<url>file://{path}</url>\n</locus>\n'
+                      .format(locus=locus,
+                              path=os.path.join(schemepath, '{}.tfa'.format(locus))))
+        xml.write('</loci>\n</database>\n</mlst>\n</species>\n</data>\n')
+    if os.path.isdir(repositorypath):
+        shutil.rmtree(repositorypath)
+    make_path(repositorypath)
+    for locus in loci:
+        shutil.copyfile(os.path.join(schemepath, '{}.tfa'.format(locus)),
+                        os.path.join(repositorypath, '{}.fsa'.format(locus)))
+    for command in [['git', 'init', '-q'],
+                    ['git', 'add', '.'],
+                    ['git', '-c', 'user.name=benchmark', '-c', 'user.email=benchmark@localhost', 'commit', '-q', '-m',
+                     'Synthetic database']]:
+        subprocess.check_call(command, cwd=repositorypath)
+    return listing
+
+
+def measure(function, pythonmemory=True):
+    """
+    Run a function, and measure its run time and memory use. Exceptions are recorded rather than raised, so that the
+    remaining stages are still benchmarked
+    :param function: function to run
+    :param pythonmemory: boolean of whether to trace the peak memory allocated by Python in the stage, which slows down
+    the stage
+    :return: dictionary of the measurements
+    """
+    selfbefore = resource.getrusage(resource.RUSAGE_SELF)
+    childbefore = resource.getrusage(resource.RUSAGE_CHILDREN)
+    if pythonmemory:
+        tracemalloc.start()
+    status = 'complete'
+    error = None
+    start = time()
+    try:
+        function()
+    except Exception as exception:
+        status = 'failed'
+        error = '{name}: {error}'.format(name=type(exception).__name__,
+                                         error=exception)
+    walltime = time() - start
+    pythonpeak = None
+    if pythonmemory:
+        pythonpeak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    selfafter = resource.getrusage(resource.RUSAGE_SELF)
+    childafter = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # The maximum resident set size is the high-water mark of the process (or its largest child) over its lifetime, and
+    # is reported in kilobytes. It is only attributed to the stage if the stage raised it; otherwise the peak was set
+    # by an earlier stage, and is not recorded
+    maxrss = selfafter.ru_maxrss * 1024 if selfafter.ru_maxrss > selfbefore.ru_maxrss else None
+    childmaxrss = childafter.ru_maxrss * 1024 if childafter.ru_maxrss > childbefore.ru_maxrss else None
+    return {'status': status,
+            'error': error,
+            'walltime': walltime,
+            'cputime': selfafter.ru_utime + selfafter.ru_stime - selfbefore.ru_utime - selfbefore.ru_stime,
+            'childcputime': childafter.ru_utime + childafter.ru_stime - childbefore.ru_utime - childbefore.ru_stime,
+            'maxrss': maxrss,
+            'childmaxrss': childmaxrss,
+            'pythonpeak': pythonpeak}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Find the stages that failed, or that are slower or use more memory than in the baseline
+    :param results: dictionary of stage name: measurements of the benchmark
+    :param baseline: dictionary of stage name: measurements of the baseline
+    :param tolerance: proportion by which a measurement may exceed the baseline
+    :return: list of descriptions of the regressions
+    """
+    regressions = list()
+    for stage, measurements in sorted(results.items()):
+        reference = baseline.get(stage)
+        # Stages that were not benchmarked, or failed, in the baseline are not compared
+        if not reference or reference['status'] != 'complete':
+            continue
+        if measurements['status'] != 'complete':
+            regressions.append('{stage}: {error}'.format(stage=stage,
+                                                         error=measurements['error']))
+            continue
+        for metric, noise in sorted(METRICS.items()):
+            if measurements.get(metric) is None or reference.get(metric) is None:
+                continue
+            if measurements[metric] > reference[metric] * (1 + tolerance) and \
+                    measurements[metric] - reference[metric] > noise:
+                regressions.append('{stage}: {metric} increased from {reference:.2f} to {value:.2f}'
+                                   .format(stage=stage,
+                                           metric=metric,
+                                           reference=reference[metric],
+                                           value=measurements[metric]))
+    return regressions
+
+
+class Benchmark(object):
+    """
+    Benchmarks the stages of the pipeline, and the database set-up, on synthetic datasets. Synthetic reads (and
+    optionally assemblies) are created for the samples of the chosen scale, and each stage of the pipeline is run in
+    turn on a fresh copy of the run. The database download and set-up stages are run against a synthetic typing scheme
+    served from the local file system. The run time, CPU time, and memory use of each stage are compared to a stored
+    baseline to detect regressions
+    """
+
+    def main(self):
+        """
+        Run the benchmarks
+        :return: list of the regressions compared to the baseline
+        """
+        self.synthetic_data()
+        stages = dict()
+        if any(stage in self.stages for stage in PIPELINESTAGES):
+            stages.update(self.pipeline_stages())
+        if any(stage in self.stages for stage in DATABASESTAGES):
+            stages.update(self.database_stages())
+        results = {'scale': self.scale,
+                   'settings': self.settings,
+                   'commit': assembly_pipeline.__version__,
+                   'date': time(),
+                   'stages': stages}
+        with open(self.resultsfile, 'w') as resultsfile:
+            json.dump(results, resultsfile, sort_keys=True, indent=4)
+        printtime('Results written to {}'.format(self.resultsfile), self.starttime)
+        regressions = list()
+        if os.path.isfile(self.baselinefile):
+            with open(self.baselinefile, 'r') as baselinefile:
+                baseline = json.load(baselinefile)
+            assert baseline['settings'] == self.settings, 'Baseline {0!r:s} was created with different settings'\
+                .format(self.baselinefile)
+            regressions = compare(stages, baseline['stages'], self.tolerance)
+            for regression in regressions:
+                printtime('Regression: {}'.format(regression), self.starttime, '\033[1;91m')
+        if self.updatebaseline:
+            make_path(os.path.dirname(self.baselinefile))
+            shutil.copyfile(self.resultsfile, self.baselinefile)
+            printtime('Baseline updated', self.starttime)
+        return regressions
+
+    def synthetic_data(self):
+        """
+        Create the synthetic reads, assemblies, and typing scheme of the scale. The data are reused by later benchmarks
+        with the same settings
+        """
+        settingsfile = os.path.join(self.datapath, 'synthetic.json')
+        try:
+            with open(settingsfile, 'r') as settings:
+                if json.load(settings) == self.settings:
+                    return
+        except (IOError, ValueError):
+            pass
+        printtime('Creating synthetic data for {num} samples at a depth of {depth}X'
+                  .format(num=self.settings['samples'],
+                          depth=self.settings['depth']), self.starttime)
+        if os.path.isdir(self.datapath):
+            shutil.rmtree(self.datapath)
+        make_path(self.datapath)
+        inserts = planted_sequences(self.reffilepath)
+        for number, name in enumerate(self.samples):
+            seed = self.settings['seed'] + number
+            genome = random_genome(self.settings['genomesize'], seed, inserts)
+            simulate_reads(genome, self.settings['depth'],
+                           os.path.join(self.datapath, '{name}_S{num}_L001_R1_001.fastq.gz'.format(name=name,
+                                                                                                   num=number + 1)),
+                           os.path.join(self.datapath, '{name}_S{num}_L001_R2_001.fastq.gz'.format(name=name,
+                                                                                                   num=number + 1)),
+                           name, seed)
+            simulate_assembly(genome, os.path.join(self.datapath, '{}.fasta'.format(name)), self.settings['depth'],
+                              seed)
+        loci = synthetic_scheme(self.schemepath, self.settings['alleles'], self.settings['seed'])
+        synthetic_repository(self.schemepath, loci, self.repositorypath)
+        with open(settingsfile, 'w') as settings:
+            json.dump(self.settings, settings, sort_keys=True, indent=4)
+
+    def prepare_run(self):
+        """
+        Create a fresh run folder from the synthetic data, so that no stage reuses the outputs of a previous benchmark
+        :return: path of the run folder
+        """
+        runpath = os.path.join(self.path, 'runs', self.scale)
+        if os.path.isdir(runpath):
+            shutil.rmtree(runpath)
+        make_path(runpath)
+        for fastq in glob(os.path.join(self.datapath, '*.fastq.gz')):
+            os.symlink(fastq, os.path.join(runpath, os.path.basename(fastq)))
+        if self.assemblies:
+            # SPAdes is not run for samples that already have an assembly, so the typing stages analyse the synthetic
+            # assemblies
+            for name in self.samples:
+                spadesoutput = os.path.join(runpath, name, 'spades_output')
+                make_path(spadesoutput)
+                shutil.copyfile(os.path.join(self.datapath, '{}.fasta'.format(name)),
+                                os.path.join(spadesoutput, 'contigs.fasta'))
+        return runpath
+
+    def pipeline_stages(self):
+        """
+        Run each stage of the pipeline on the synthetic run
+        :return: dictionary of stage name: measurements
+        """
+        runpath = self.prepare_run()
+        parser = assembly_pipeline.pipeline_parser()
+        arguments = parser.parse_args([runpath, '-r', self.reffilepath, '-t', str(self.cpus)] + self.arguments)
+        pipeline = assembly_pipeline.RunSpades(arguments, assembly_pipeline.__version__.encode('utf-8'),
+                                               self.starttime, self.homepath)
+        stages = dict()
+        for stage in PIPELINESTAGES:
+            if stage in self.stages:
+                stages[stage] = self.run_stage(stage, getattr(pipeline, stage))
+        return stages
+
+    def database_stages(self):
+        """
+        Run the database download and set-up stages against the synthetic scheme
+        :return: dictionary of stage name: measurements
+        """
+        databasepath = os.path.join(self.path, 'databases', self.scale)
+        if os.path.isdir(databasepath):
+            shutil.rmtree(databasepath)
+        make_path(databasepath)
+        mlstpath = os.path.join(databasepath, 'MLST', SPECIES.split()[0])
+        clonepath = os.path.join(databasepath, 'resfinder')
+        # Stages that are not benchmarked are replaced by copies of their outputs
+        if 'get_mlst' not in self.stages:
+            shutil.copytree(self.schemepath, mlstpath)
+        if 'database_download' not in self.stages:
+            shutil.copytree(self.repositorypath, clonepath, ignore=shutil.ignore_patterns('.git'))
+        arguments = MetadataObject()
+        arguments.databasepath = databasepath
+        arguments.start = self.starttime
+        arguments.timeout = None
+        arguments.mirrorpath = None
+        arguments.olcurl = database_setup.OLCURL
+        arguments.cgeurl = database_setup.CGEURL
+
+        def get_scheme():
+            # Create an object to pass to the get_mlst script, as in DatabaseSetup.mlst
+            args = MetadataObject()
+            args.species = SPECIES.split()[0]
+            args.genus = SPECIES
+            args.repository_url = 'file://{}'.format(os.path.join(self.schemepath, 'dbases.xml'))
+            args.force_scheme_name = False
+            args.path = mlstpath
+            get_mlst.main(args)
+
+        def combine_alleles():
+            # The rMLST alleles are downloaded with authentication, so only the combining of the alleles is run
+            rmlst = get_rmlst.Get.__new__(get_rmlst.Get)
+            rmlst.start = self.starttime
+            rmlst.combinealleles(mlstpath, glob(os.path.join(mlstpath, '*.tfa')))
+
+        def download():
+            setup = database_setup.DatabaseSetup(arguments)
+            setup.database_download('git clone {repository} {path}'.format(repository=self.repositorypath,
+                                                                           path=clonepath), clonepath)
+            assert os.path.isfile(os.path.join(clonepath, 'complete')), 'Could not clone {0!r:s}'\
+                .format(self.repositorypath)
+
+        functions = {'get_mlst': get_scheme,
+                     'combinealleles': combine_alleles,
+                     'scheme_indexes': lambda: database_setup.DatabaseSetup(arguments).scheme_indexes(mlstpath),
+                     'database_download': download,
+                     'combinetargets': lambda: database_setup.combinetargets(glob(os.path.join(clonepath, '*.fsa')),
+                                                                             clonepath)}
+        stages = dict()
+        for stage in DATABASESTAGES:
+            if stage in self.stages:
+                stages[stage] = self.run_stage(stage, functions[stage])
+        return stages
+
+    def run_stage(self, stage, function):
+        """
+        Benchmark a stage, and calculate its throughput
+        :param stage: name of the stage
+        :param function: function that runs the stage
+        :return: dictionary of measurements
+        """
+        printtime('Benchmarking {}'.format(stage), self.starttime, '\033[1;94m')
+        measurements = measure(function, self.pythonmemory)
+        walltime = max(measurements['walltime'], 1e-6)
+        measurements['samplespersecond'] = self.settings['samples'] / walltime
+        measurements['basespersecond'] = self.bases / walltime
+        printtime('{stage} {status} in {time:.2f} seconds'.format(stage=stage,
+                                                                  status=measurements['status'],
+                                                                  time=measurements['walltime']), self.starttime)
+        if measurements['error']:
+            printtime(measurements['error'], self.starttime)
+        return measurements
+
+    def __init__(self, args, scale):
+        """
+        :param args: command line arguments
+        :param scale: name of the scale of the synthetic datasets
+        """
+        assert scale in SCALES, 'Unknown scale {0!r:s}'.format(scale)
+        self.starttime = args.start
+        self.scale = scale
+        self.path = os.path.abspath(args.path)
+        # The pipeline script is imported from the root of the repository
+        self.homepath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        if self.homepath not in sys.path:
+            sys.path.append(self.homepath)
+        # The test databases are used unless other databases are supplied
+        self.reffilepath = os.path.abspath(args.referencefilepath) if args.referencefilepath \
+            else os.path.join(self.homepath, 'tests', 'testdata', 'databases')
+        assert os.path.isdir(self.reffilepath), 'Reference file path is not a valid directory {0!r:s}'\
+            .format(self.reffilepath)
+        self.settings = dict(SCALES[scale])
+        self.settings['genomesize'] = int(args.genomesize)
+        self.settings['seed'] = int(args.seed)
+        self.samples = ['SYNTH-{:04d}'.format(number + 1) for number in range(self.settings['samples'])]
+        # Number of bases in the synthetic reads of all the samples
+        self.bases = self.settings['samples'] * 2 * 150 * max(int(self.settings['genomesize'] *
+                                                                  self.settings['depth'] / 300), 1)
+        self.assemblies = args.assemblies
+        self.stages = args.stages.split(',') if args.stages else PIPELINESTAGES + DATABASESTAGES
+        for stage in self.stages:
+            assert stage in PIPELINESTAGES + DATABASESTAGES, 'Unknown stage {0!r:s}'.format(stage)
+        self.arguments = list(args.arguments)
+        self.cpus = args.threads if args.threads else multiprocessing.cpu_count()
+        self.pythonmemory = not args.nopythonmemory
+        self.tolerance = float(args.tolerance)
+        self.updatebaseline = args.updatebaseline
+        self.datapath = os.path.join(self.path, 'data', scale)
+        self.schemepath = os.path.join(self.datapath, 'scheme')
+        self.repositorypath = os.path.join(self.datapath, 'repository')
+        make_path(os.path.join(self.path, 'results'))
+        self.resultsfile = os.path.join(self.path, 'results', '{scale}_{time}.json'.format(scale=scale,
+                                                                                          time=int(time())))
+        # Baselines are specific to the system on which they were measured, and are stored with the benchmarks
+        self.baselinefile = os.path.join(args.baselinepath if args.baselinepath
+                                         else os.path.join(self.path, 'baselines'), '{}.json'.format(scale))
+
+
+# If the script is called from the command line, then call the argument parser
+if __name__ == '__main__':
+    # Parser for arguments
+    parser = ArgumentParser(description='Benchmark the stages of the pipeline and the database set-up on synthetic '
+                                        'datasets, and compare the results to a stored baseline. Exits with a '
+                                        'non-zero status if a stage regressed')
+    parser.add_argument('path',
+                        help='Path of the folder in which to create the synthetic data, runs, and results')
+    parser.add_argument('-r', '--referencefilepath',
+                        help='Path of the databases used by the pipeline stages. Default is the test databases of '
+                             'the repository')
+    parser.add_argument('-s', '--scale',
+                        default='small',
+                        help='Comma-separated list of the scales to benchmark: small (1 sample), medium (16 '
+                             'samples), or large (96 samples). Default is small')
+    parser.add_argument('-g', '--genomesize',
+                        default=100000,
+                        help='Size of the synthetic genomes. Default is 100000')
+    parser.add_argument('-sd', '--seed',
+                        default=1,
+                        help='Seed of the random number generator used to create the synthetic data. Default is 1')
+    parser.add_argument('-a', '--assemblies',
+                        action='store_true',
+                        help='Use synthetic assemblies rather than assembling the reads with SPAdes')
+    parser.add_argument('-st', '--stages',
+                        help='Comma-separated list of the stages to benchmark. Default is every stage: {}'
+                        .format(','.join(PIPELINESTAGES + DATABASESTAGES)))
+    parser.add_argument('-t', '--threads',
+                        help='Number of threads. Default is the number of cores in the system')
+    parser.add_argument('-nm', '--nopythonmemory',
+                        action='store_true',
+                        help='Do not trace the peak memory allocated by Python in each stage. Tracing slows down the '
+                             'stages, but is the only per-stage measure of the memory of the pipeline process, as its '
+                             'maximum resident set size is only recorded for the stages that raise it')
+    parser.add_argument('-b', '--baselinepath',
+                        help='Path of the folder of the baselines. Default is the baselines folder of path')
+    parser.add_argument('-u', '--updatebaseline',
+                        action='store_true',
+                        help='Store the results as the new baseline')
+    parser.add_argument('-tl', '--tolerance',
+                        default=0.25,
+                        help='Proportion by which a measurement may exceed the baseline before it is reported as a '
+                             'regression. Default is 0.25')
+    parser.add_argument('arguments',
+                        nargs='*',
+                        help='Additional pipeline arguments. Separate them from the benchmark arguments with --, '
+                             'e.g. /path/to/benchmarks -- -bm')
+    # Get the arguments into an object
+    arguments = parser.parse_args()
+    arguments.start = time()
+    regressed = False
+    for benchmarkscale in arguments.scale.split(','):
+        benchmark = Benchmark(arguments, benchmarkscale)
+        regressed = bool(benchmark.main()) or regressed
+    sys.exit(1 if regressed else 0)
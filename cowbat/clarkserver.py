@@ -0,0 +1,391 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import GenObject, make_path, printtime
+from cowbat.commandrunner import CommandRunner
+import spadespipeline.fileprep as fileprep
+from metagenomefilter import automateCLARK
+from argparse import ArgumentParser
+from threading import Thread, Event
+from queue import Queue, Empty
+from shutil import which
+from time import time
+import socketserver
+import psutil
+import multiprocessing
+import socket
+import json
+import os
+__author__ = 'adamkoziol'
+
+# Minimum amount of physical memory in the system required to load the CLARK database, as in the pipeline
+MINIMUMMEMORY = 100000000000
+
+
+class ClarkServer(object):
+    """
+    Persistent CLARK classification service. The targets are set, and the database files are read into the page cache
+    once at start-up. Classification requests from pipeline runs on the same host are received over a Unix socket, and
+    requests that arrive close together are combined into a single classify_metagenome.sh call, so that the database is
+    loaded once per batch rather than once per run
+    """
+
+    def main(self):
+        """
+        Set up the database, and start serving requests
+        """
+        self.settargets()
+        self.warm()
+        # Start the thread that performs the classifications
+        worker = Thread(target=self.batcher, args=())
+        worker.setDaemon(True)
+        worker.start()
+        # Remove a socket left behind by a previous server
+        if os.path.exists(self.socketpath):
+            os.remove(self.socketpath)
+        server = socketserver.ThreadingUnixStreamServer(self.socketpath, ClarkRequestHandler)
+        server.daemon_threads = True
+        # Allow the request handlers to access the server
+        server.clarkserver = self
+        printtime('CLARK server listening on {}'.format(self.socketpath), self.start)
+        try:
+            server.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            printtime('Received keyboard interrupt, shutting down CLARK server', self.start)
+        finally:
+            server.server_close()
+            if os.path.exists(self.socketpath):
+                os.remove(self.socketpath)
+
+    def settargets(self):
+        """
+        Set the targets (database, and taxonomic rank) used in all the classifications performed by the server
+        """
+        printtime('Setting up database', self.start)
+        self.targetcall = 'cd {clarkpath} && ./set_targets.sh {dbpath} {db} --{rank}'\
+            .format(clarkpath=self.clarkpath,
+                    dbpath=self.databasepath,
+                    db=self.database,
+                    rank=self.rank)
+        result = self.runner.run(self.targetcall, 'set_targets')
+        assert result['returncode'] == 0, 'Could not set the CLARK targets. See {0!r:s}'.format(result['stderr'])
+
+    def warm(self):
+        """
+        Read the database files once, so that they are resident in the page cache when CLARK loads them
+        """
+        printtime('Loading database files into memory', self.start)
+        # Use a large buffer to read the files in chunks
+        buffer = bytearray(16 * 1024 * 1024)
+        for root, dirs, files in os.walk(self.databasepath):
+            for databasefile in files:
+                with open(os.path.join(root, databasefile), 'rb') as database:
+                    while database.readinto(buffer):
+                        pass
+
+    def submit(self, samples):
+        """
+        Add a classification request to the queue, and wait for it to be processed
+        :param samples: list of dictionaries of sample name, input file, classification report, and abundance report
+        :return: dictionary of the results of the request
+        """
+        job = {'samples': samples,
+               'event': Event(),
+               'response': dict()}
+        self.queue.put(job)
+        job['event'].wait()
+        return job['response']
+
+    def status(self):
+        """
+        :return: dictionary of the settings and usage statistics of the server
+        """
+        return {'status': 'running',
+                'database': self.databasepath,
+                'rank': self.rank,
+                'uptime': int(time() - self.start),
+                'batches': self.batches,
+                'samples': self.samplecount,
+                'queued': self.queue.qsize()}
+
+    def batcher(self):
+        """
+        Collect all the requests that arrive within the batch window, and classify them together
+        """
+        while True:
+            batch = [self.queue.get()]
+            deadline = time() + self.batchwindow
+            while True:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time(), 0)))
+                except Empty:
+                    break
+            try:
+                self.classify(batch)
+            except Exception as error:
+                for job in batch:
+                    job['response'] = {'status': 'error',
+                                       'message': str(error)}
+            finally:
+                for job in batch:
+                    job['event'].set()
+                    self.queue.task_done()
+
+    def classify(self, batch):
+        """
+        Run classify_metagenome.sh on every sample in the batch, and estimate the abundance of the taxonomic groups in
+        each sample
+        :param batch: list of queued requests
+        """
+        self.batches += 1
+        samples = [sample for job in batch for sample in job['samples']]
+        # classify_metagenome.sh loads the full database for every batch, so refuse to classify on systems that
+        # cannot hold it
+        memory = psutil.virtual_memory().total
+        assert memory >= MINIMUMMEMORY, 'Not enough RAM to run CLARK: {memory} bytes available, {minimum} required'\
+            .format(memory=memory,
+                    minimum=MINIMUMMEMORY)
+        printtime('Classifying batch {batch} ({num} samples)'.format(batch=self.batches,
+                                                                     num=len(samples)), self.start)
+        # Prepare the lists to be used to classify the metagenomes
+        filelist = os.path.join(self.workpath, 'sampleList_{}.txt'.format(self.batches))
+        reportlist = os.path.join(self.workpath, 'reportList_{}.txt'.format(self.batches))
+        with open(filelist, 'w') as files:
+            with open(reportlist, 'w') as reports:
+                for sample in samples:
+                    files.write(sample['input'] + '\n')
+                    # CLARK adds the .csv extension to the report name
+                    reports.write(os.path.splitext(sample['classification'])[0] + '\n')
+        classifycall = 'cd {clarkpath} && ./classify_metagenome.sh -O {files} -R {reports} -n {threads}'\
+            .format(clarkpath=self.clarkpath,
+                    files=filelist,
+                    reports=reportlist,
+                    threads=self.cpus)
+        self.runner.run(classifycall, 'classify_{}'.format(self.batches))
+        # Estimate the abundance for each classified sample. The estimates are independent, so they are run
+        # concurrently
+        results = dict()
+        classified = [sample for sample in samples if os.path.isfile(sample['classification'])]
+        abundancecalls = ['cd {clarkpath} && ./estimate_abundance.sh -D {dbpath} -F {classification} > {abundance}'
+                          .format(clarkpath=self.clarkpath,
+                                  dbpath=self.databasepath,
+                                  classification=sample['classification'],
+                                  abundance=sample['abundance']) for sample in classified]
+        estimates = self.runner.run_all([(abundancecall, 'abundance_{}'.format(self.batches))
+                                         for abundancecall in abundancecalls], self.cpus)
+        for sample, abundancecall, estimate in zip(classified, abundancecalls, estimates):
+            if estimate['returncode'] == 0:
+                results[sample['name']] = {'status': 'complete',
+                                           'classification': sample['classification'],
+                                           'abundance': sample['abundance'],
+                                           'classifycall': classifycall,
+                                           'abundancecall': abundancecall}
+            else:
+                results[sample['name']] = {'status': 'error',
+                                           'message': 'estimate_abundance.sh failed with exit status {status}. See '
+                                                      '{log}'.format(status=estimate['returncode'],
+                                                                     log=estimate['stderr'])}
+        for sample in samples:
+            if sample['name'] not in results:
+                results[sample['name']] = {'status': 'error',
+                                           'message': 'CLARK did not create {}'.format(sample['classification'])}
+        self.samplecount += len(samples)
+        # Populate the response of every request in the batch with the results of its samples
+        for job in batch:
+            job['response'] = {'status': 'complete',
+                               'samples': {sample['name']: results[sample['name']] for sample in job['samples']}}
+        for listfile in [filelist, reportlist]:
+            os.remove(listfile)
+
+    def __init__(self, args):
+        self.start = args.start
+        self.socketpath = os.path.abspath(args.socket)
+        self.databasepath = os.path.join(os.path.abspath(args.databasepath), '')
+        assert os.path.isdir(self.databasepath), 'Supplied database path is not a valid directory {0!r:s}'\
+            .format(self.databasepath)
+        self.clarkpath = args.clarkpath if args.clarkpath else os.path.join(os.path.dirname(which('CLARK')), '..',
+                                                                            'opt', 'clark')
+        self.database = args.database
+        self.rank = args.rank
+        self.cpus = int(args.threads if args.threads else multiprocessing.cpu_count())
+        self.batchwindow = args.batchwindow
+        # Store the sample and report lists, and the logs in a folder beside the socket
+        self.workpath = os.path.join(os.path.dirname(self.socketpath), 'clarkserver')
+        make_path(self.workpath)
+        # Stream the output of the CLARK scripts to log files in the logs folder of the work path
+        self.runner = CommandRunner(os.path.join(self.workpath, 'logs'))
+        self.targetcall = str()
+        self.queue = Queue()
+        self.batches = 0
+        self.samplecount = 0
+
+
+class ClarkRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Reads a single JSON-formatted request from the socket, and writes the JSON-formatted response
+    """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            if request.get('command') == 'status':
+                response = self.server.clarkserver.status()
+            else:
+                response = self.server.clarkserver.submit(request['samples'])
+        except (ValueError, KeyError, TypeError) as error:
+            response = {'status': 'error',
+                        'message': 'Invalid request: {}'.format(error)}
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+def request_classification(socketpath, request):
+    """
+    Send a request to a running CLARK server, and wait for the response
+    :param socketpath: path of the Unix socket of the server
+    :param request: dictionary of the request
+    :return: dictionary of the response
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socketpath)
+    try:
+        client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        # Read until the newline marking the end of the response
+        response = bytes()
+        while not response.endswith(b'\n'):
+            data = client.recv(65536)
+            if not data:
+                break
+            response += data
+    finally:
+        client.close()
+    return json.loads(response.decode('utf-8'))
+
+
+class ClarkClient(object):
+    """
+    Performs the CLARK analyses of the pipeline using a running CLARK server. The outputs and metadata are the same as
+    those created by automateCLARK
+    """
+
+    def main(self):
+        for extension in ['fastq', 'fasta']:
+            self.runmetadata.extension = extension
+            # Create the name of the final report
+            self.report = os.path.join(self.reportpath, 'abundance{}.xlsx'.format(extension))
+            # Only re-run the CLARK analyses if the CLARK report doesn't exist
+            if not os.path.isfile(self.report):
+                printtime('Performing CLARK analysis on {} files'.format(extension), self.start)
+                self.prepare()
+                self.classify()
+                self.reports()
+
+    def prepare(self):
+        """
+        Decompress and combine the .fastq files, or set the best assembly as the file to classify
+        """
+        if self.runmetadata.extension == 'fastq':
+            fileprep.Fileprep(self)
+        else:
+            for sample in self.runmetadata.samples:
+                sample.general.combined = sample.general.bestassemblyfile
+
+    def classify(self):
+        """
+        Send the samples to the CLARK server, and populate the metadata with the results
+        """
+        clarkextension = 'clark{}'.format(self.runmetadata.extension)
+        samples = list()
+        for sample in self.runmetadata.samples:
+            # Create a GenObject to store metadata
+            setattr(sample, clarkextension, GenObject())
+            # Create a folder to store all the CLARK files
+            sample[clarkextension].outputpath = os.path.abspath(os.path.join(sample.general.outputdirectory,
+                                                                             'CLARK'))
+            make_path(sample[clarkextension].outputpath)
+            if sample.general.combined != 'NA' and os.path.isfile(sample.general.combined):
+                sample[clarkextension].combined = os.path.abspath(sample.general.combined)
+                filename = os.path.join(sample[clarkextension].outputpath,
+                                        os.path.basename(sample.general.combined).split('.')[0])
+                sample[clarkextension].classification = filename + '.csv'
+                sample[clarkextension].abundance = filename + '_abundance.csv'
+                samples.append({'name': sample.name,
+                                'input': sample[clarkextension].combined,
+                                'classification': sample[clarkextension].classification,
+                                'abundance': sample[clarkextension].abundance})
+        response = request_classification(self.socketpath, {'samples': samples}) if samples else dict()
+        assert response.get('status', 'complete') == 'complete', 'CLARK server error: {}'\
+            .format(response.get('message'))
+        for sample in self.runmetadata.samples:
+            result = response.get('samples', dict()).get(sample.name, dict())
+            if result.get('status') == 'complete':
+                sample.commands.target = 'NA'
+                sample.commands.classify = result['classifycall']
+                sample.commands.abundancecall = result['abundancecall']
+                # The report creation method of automateCLARK uses the .general attributes
+                sample.general.abundance = result['abundance']
+                sample.general.classification = result['classification']
+            else:
+                sample[clarkextension].abundance = 'NA'
+                sample[clarkextension].classification = 'NA'
+            if self.runmetadata.extension == 'fastq':
+                # Remove the combined .fastq files
+                try:
+                    os.remove(sample.general.combined)
+                except OSError:
+                    pass
+
+    def reports(self):
+        """
+        Create the abundance report with the report method of automateCLARK
+        """
+        make_path(self.reportpath)
+        samples = self.runmetadata.samples
+        # Only samples that were classified can be included in the report
+        self.runmetadata.samples = [sample for sample in samples
+                                    if sample['clark{}'.format(self.runmetadata.extension)].abundance != 'NA']
+        try:
+            automateCLARK.CLARK.reports(self)
+        finally:
+            self.runmetadata.samples = samples
+
+    def __init__(self, inputobject):
+        self.runmetadata = inputobject.runmetadata
+        self.start = inputobject.starttime
+        self.cpus = int(inputobject.cpus)
+        self.reportpath = inputobject.reportpath
+        self.socketpath = inputobject.clarksocket
+        # Use the same cutoff as the pipeline implementation of automateCLARK
+        self.cutoff = 0.005 * 100
+        self.report = str()
+
+
+# If the script is called from the command line, then call the argument parser
+if __name__ == '__main__':
+    # Parser for arguments
+    parser = ArgumentParser(description='Persistent CLARK classification server. Pipeline runs on the same host '
+                                        'submit their CLARK analyses to the server with the --clarksocket argument')
+    parser.add_argument('-s', '--socket',
+                        required=True,
+                        help='Path of the Unix socket on which to accept requests')
+    parser.add_argument('-d', '--databasepath',
+                        required=True,
+                        help='Path of CLARK database files to use')
+    parser.add_argument('-C', '--clarkpath',
+                        help='Path to the CLARK scripts. Default is the opt/clark folder of the CLARK installation')
+    parser.add_argument('-r', '--rank',
+                        default='species',
+                        help='Taxonomic rank to use in the analyses. Default is species')
+    parser.add_argument('-D', '--database',
+                        default='bacteria',
+                        help='Database to use in the analyses. Default is bacteria')
+    parser.add_argument('-t', '--threads',
+                        help='Number of threads. Default is the number of cores in the system')
+    parser.add_argument('-w', '--batchwindow',
+                        default=5,
+                        type=float,
+                        help='Number of seconds to wait for additional requests before classifying a batch. '
+                             'Default is 5')
+    # Get the arguments into an object
+    arguments = parser.parse_args()
+    arguments.start = time()
+    # Run the server
+    clarkserver = ClarkServer(arguments)
+    clarkserver.main()
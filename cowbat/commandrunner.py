@@ -0,0 +1,247 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import make_path
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+from collections import deque
+from threading import Thread, Lock
+import subprocess
+import signal
+import time
+import json
+import os
+__author__ = 'adamkoziol'
+
+# Size of the blocks in which the output of a command is read
+CHUNKSIZE = 64 * 1024
+# Number of seconds a command that has timed out has to exit after SIGTERM before it is killed
+GRACEPERIOD = 10
+
+
+def stream_output(pipe, logfile, limit):
+    """
+    Write the output of a command to its log file as it is produced, keeping at most the first and last limit bytes,
+    so that the memory and disk used by very verbose tools are bounded
+    :param pipe: file object of the stdout or stderr pipe of the command
+    :param logfile: path of the log file
+    :param limit: number of bytes to keep from the start and the end of the output
+    """
+    tail = deque()
+    tailsize = 0
+    written = 0
+    omitted = 0
+    with open(logfile, 'wb') as log:
+        for chunk in iter(lambda: pipe.read(CHUNKSIZE), b''):
+            # Write the start of the output directly
+            if written < limit:
+                head = chunk[:limit - written]
+                log.write(head)
+                log.flush()
+                written += len(head)
+                chunk = chunk[len(head):]
+            if not chunk:
+                continue
+            # Keep the latest limit bytes of the remainder in memory
+            tail.append(chunk)
+            tailsize += len(chunk)
+            while tailsize - len(tail[0]) >= limit:
+                discarded = tail.popleft()
+                tailsize -= len(discarded)
+                omitted += len(discarded)
+        if tailsize > limit:
+            tail[0] = tail[0][tailsize - limit:]
+            omitted += tailsize - limit
+        if omitted:
+            log.write('\n[{} bytes of output omitted]\n'.format(omitted).encode('utf-8'))
+        for chunk in tail:
+            log.write(chunk)
+    pipe.close()
+
+
+def wait(process, timeout=None):
+    """
+    Wait for a command to finish, and collect its resource usage. Commands that run for longer than the timeout are
+    sent SIGTERM, and SIGKILL if they have not exited after the grace period. The signals are sent to the process group
+    of the command, so that the programs started by shell scripts are stopped as well
+    :param process: Popen object of the command, started in a new session
+    :param timeout: maximum number of seconds the command may run
+    :return: exit status (the negative signal number if the command was killed), resource usage, and whether the
+    command timed out
+    """
+    deadline = time.time() + timeout if timeout else None
+    killtime = None
+    timedout = False
+    delay = 0.01
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        now = time.time()
+        if deadline and now > deadline and not timedout:
+            timedout = True
+            killtime = now + GRACEPERIOD
+            signal_group(process, signal.SIGTERM)
+        elif killtime and now > killtime:
+            killtime = None
+            signal_group(process, signal.SIGKILL)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+    returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    # Record the exit status, so that the Popen object does not try to wait for the process again
+    process.returncode = returncode
+    return returncode, usage, timedout
+
+
+def signal_group(process, signalnumber):
+    """
+    Send a signal to the process group of a command
+    :param process: Popen object of the command
+    :param signalnumber: signal to send
+    """
+    try:
+        os.killpg(process.pid, signalnumber)
+    except OSError:
+        # The command has already exited
+        pass
+
+
+def run_command(command, logprefix, timeout=None, limit=None, cwd=None):
+    """
+    Run a shell command, and stream its stdout and stderr to log files rather than buffering them in memory
+    :param command: shell command to run
+    :param logprefix: path and prefix of the log files: the output is written to <prefix>_out.txt and <prefix>_err.txt
+    :param timeout: maximum number of seconds the command may run. Default is no limit
+    :param limit: number of bytes to keep from the start and end of each stream. Default is to keep all the output
+    :param cwd: folder in which to run the command
+    :return: dictionary of the command, exit status, run time, resource usage, and log files
+    """
+    stdout = '{}_out.txt'.format(logprefix)
+    stderr = '{}_err.txt'.format(logprefix)
+    start = time.time()
+    if not limit:
+        # Without a limit, the output is redirected to the log files without passing through the pipeline
+        with open(stdout, 'wb') as out, open(stderr, 'wb') as err:
+            process = subprocess.Popen(command, shell=True, stdin=subprocess.DEVNULL, stdout=out, stderr=err, cwd=cwd,
+                                       start_new_session=True)
+            returncode, usage, timedout = wait(process, timeout)
+    else:
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, cwd=cwd, bufsize=0, start_new_session=True)
+        readers = [Thread(target=stream_output, args=(pipe, logfile, limit), daemon=True)
+                   for pipe, logfile in [(process.stdout, stdout), (process.stderr, stderr)]]
+        for reader in readers:
+            reader.start()
+        returncode, usage, timedout = wait(process, timeout)
+        for reader in readers:
+            reader.join()
+    return {'command': command,
+            'returncode': returncode,
+            'walltime': time.time() - start,
+            'usertime': usage.ru_utime,
+            'systemtime': usage.ru_stime,
+            # The maximum resident set size is reported in kB on Linux
+            'maxrss': usage.ru_maxrss * 1024,
+            'timedout': timedout,
+            'stdout': stdout,
+            'stderr': stderr}
+
+
+def tail(logfile, size=2000):
+    """
+    Read the end of a log file e.g. to report why a command failed
+    :param logfile: path of the log file
+    :param size: maximum number of bytes to read
+    :return: decoded end of the file
+    """
+    with open(logfile, 'rb') as log:
+        log.seek(max(0, os.path.getsize(logfile) - size))
+        return log.read().decode('utf-8', 'replace')
+
+
+class CommandRunner(object):
+    """
+    Runs the external tools of the pipeline and database set-up with streamed logging. Each command has its own log
+    files in the log folder, and its exit status, run time, and resource usage are appended to commands.jsonl. The
+    names of the log files include the identifier of the runner, so that runners sharing a log folder (e.g. repeated
+    database set-ups) do not overwrite the logs referenced by earlier records
+    """
+
+    def run(self, command, name, timeout=None, cwd=None):
+        """
+        Run a command
+        :param command: shell command to run
+        :param name: name of the command, used to name its log files
+        :param timeout: maximum number of seconds the command may run. Default is the timeout of the runner
+        :param cwd: folder in which to run the command
+        :return: dictionary of the results of the command
+        """
+        with self.lock:
+            # Commands with the same name are numbered, so that their logs are kept
+            self.names[name] = self.names.get(name, 0) + 1
+            if self.names[name] > 1:
+                name = '{}_{}'.format(name, self.names[name])
+        result = run_command(command, os.path.join(self.logpath, '{name}_{runid}'.format(name=name,
+                                                                                       runid=self.runid)),
+                             timeout if timeout else self.timeout, self.limit, cwd)
+        result['name'] = name
+        result['runid'] = self.runid
+        with self.lock:
+            with open(self.recordfile, 'a') as record:
+                record.write(json.dumps(result, sort_keys=True) + '\n')
+        return result
+
+    def run_all(self, jobs, workers):
+        """
+        Run several commands concurrently
+        :param jobs: list of (command, name) tuples
+        :param workers: maximum number of commands to run at once
+        :return: list of the results of the commands, in the order of the jobs
+        """
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            return list(executor.map(lambda job: self.run(*job), jobs))
+
+    def __init__(self, logpath, timeout=None, limit=None):
+        """
+        :param logpath: path of the folder in which to write the logs
+        :param timeout: default maximum number of seconds a command may run
+        :param limit: number of bytes to keep from the start and end of the output of each command
+        """
+        self.logpath = logpath
+        make_path(self.logpath)
+        self.timeout = timeout
+        self.limit = limit
+        self.recordfile = os.path.join(self.logpath, 'commands.jsonl')
+        self.names = dict()
+        self.lock = Lock()
+        # Identifier of the runner: the time (to the microsecond) it was created, and the process
+        created = time.time()
+        self.runid = '{time}.{microseconds:06d}_{pid}'.format(time=time.strftime('%Y%m%d-%H%M%S',
+                                                                                 time.localtime(created)),
+                                                              microseconds=int(created % 1 * 1000000),
+                                                              pid=os.getpid())
+
+
+# If the script is called from the command line, then call the argument parser
+if __name__ == '__main__':
+    # Parser for arguments
+    parser = ArgumentParser(description='Run a command with its output streamed to log files, and report its exit '
+                                        'status, run time, and resource usage')
+    parser.add_argument('logpath',
+                        help='Path of the folder in which to write the logs')
+    parser.add_argument('command',
+                        help='Shell command to run')
+    parser.add_argument('-n', '--name',
+                        default='command',
+                        help='Name of the command, used to name its log files. Default is command')
+    parser.add_argument('-t', '--timeout',
+                        type=float,
+                        help='Maximum number of seconds the command may run. Default is no limit')
+    parser.add_argument('-l', '--limit',
+                        type=int,
+                        help='Number of bytes to keep from the start and end of the output of the command. Default '
+                             'is to keep all the output')
+    # Get the arguments into an object
+    arguments = parser.parse_args()
+    commandresult = CommandRunner(arguments.logpath, arguments.timeout, arguments.limit)\
+        .run(arguments.command, arguments.name)
+    print(json.dumps(commandresult, indent=4, sort_keys=True))
+    raise SystemExit(0 if commandresult['returncode'] == 0 else 1)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import printtime, make_path, GenObject
+from Bio import SeqIO
+import shutil
+import re
+import os
+__author__ = 'adamkoziol'
+
+
+def contig_depth(record):
+    """
+    Extract the k-mer coverage of a contig from its SPAdes header e.g. NODE_1_length_705814_cov_37.107_ID_4231
+    :param record: SeqRecord of the contig
+    :return: coverage as a float, or None if the header does not contain a coverage
+    """
+    match = re.search(r'_cov_([0-9]+(?:\.[0-9]+)?)', record.id)
+    return float(match.group(1)) if match else None
+
+
+def filter_contigs(assembly, filtered, excluded, minlength=0, mindepth=0):
+    """
+    Split the contigs of an assembly into the contigs that pass the length and depth thresholds, and the contigs that
+    do not. Contigs without a coverage in their headers are not filtered on depth
+    :param assembly: name and path of the assembly
+    :param filtered: name and path of the file of contigs passing the thresholds
+    :param excluded: name and path of the file of excluded contigs
+    :param minlength: minimum contig length
+    :param mindepth: minimum contig coverage
+    :return: dictionary of the number of contigs, and bases kept and excluded
+    """
+    summary = {'keptcontigs': 0, 'keptbases': 0, 'excludedcontigs': 0, 'excludedbases': 0}
+    with open(filtered, 'w') as keep, open(excluded, 'w') as exclude:
+        for record in SeqIO.parse(assembly, 'fasta'):
+            depth = contig_depth(record)
+            if len(record.seq) >= minlength and (depth is None or depth >= mindepth):
+                SeqIO.write(record, keep, 'fasta')
+                summary['keptcontigs'] += 1
+                summary['keptbases'] += len(record.seq)
+            else:
+                SeqIO.write(record, exclude, 'fasta')
+                summary['excludedcontigs'] += 1
+                summary['excludedbases'] += len(record.seq)
+    return summary
+
+
+class ContigFilter(object):
+    """
+    Removes short and low-coverage contigs from the best assemblies, so that the downstream searches only consider
+    the contigs that pass the thresholds. The unfiltered assembly, and the excluded contigs, are kept for auditing
+    """
+
+    def main(self):
+        """
+        Filter the assembly of each sample
+        """
+        printtime('Filtering contigs shorter than {length} bp, or with coverage less than {depth}X'
+                  .format(length=self.minlength,
+                          depth=self.mindepth), self.starttime)
+        for sample in self.metadata:
+            if sample.general.datastore.get('bestassemblyfile', 'NA') == 'NA':
+                continue
+            self.filter(sample)
+
+    def filter(self, sample):
+        """
+        Filter the contigs of a sample. The filtered contigs replace the best assembly, and the unfiltered assembly is
+        copied to the contigfilter folder of the sample
+        :param sample: metadata object
+        """
+        setattr(sample, self.analysistype, GenObject())
+        sample[self.analysistype].outputdir = os.path.join(sample.general.outputdirectory, self.analysistype)
+        make_path(sample[self.analysistype].outputdir)
+        sample[self.analysistype].rawassembly = os.path.join(sample[self.analysistype].outputdir,
+                                                             '{}_raw.fasta'.format(sample.name))
+        sample[self.analysistype].excludedcontigs = os.path.join(sample[self.analysistype].outputdir,
+                                                                 '{}_excluded.fasta'.format(sample.name))
+        sample[self.analysistype].mincontiglength = self.minlength
+        sample[self.analysistype].mincontigdepth = self.mindepth
+        # Keep the unfiltered assembly. If the sample was filtered by a previous run, filter the unfiltered assembly
+        # again rather than the already filtered one
+        if not os.path.isfile(sample[self.analysistype].rawassembly):
+            shutil.copyfile(sample.general.bestassemblyfile, sample[self.analysistype].rawassembly)
+        temporary = sample.general.bestassemblyfile + '.tmp'
+        summary = filter_contigs(sample[self.analysistype].rawassembly, temporary,
+                                 sample[self.analysistype].excludedcontigs, self.minlength, self.mindepth)
+        for key, value in summary.items():
+            setattr(sample[self.analysistype], key, value)
+        if summary['keptcontigs']:
+            os.replace(temporary, sample.general.bestassemblyfile)
+        else:
+            # Keep the unfiltered assembly if no contigs pass the thresholds
+            os.remove(temporary)
+            printtime('No contigs in the assembly of {} pass the thresholds. Using the unfiltered assembly'
+                      .format(sample.name), self.starttime)
+
+    def __init__(self, inputobject, minlength=0, mindepth=0):
+        """
+        :param inputobject: RunSpades object
+        :param minlength: minimum contig length
+        :param mindepth: minimum contig coverage
+        """
+        self.metadata = inputobject.runmetadata.samples
+        self.starttime = inputobject.starttime
+        self.minlength = minlength
+        self.mindepth = mindepth
+        self.analysistype = 'contigfilter'
@@ -0,0 +1,150 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import printtime, make_path
+from cowbat.commandrunner import tail
+import subprocess
+import shutil
+import json
+import os
+__author__ = 'adamkoziol'
+
+# Name of the file in each database folder that records the repository and commit it was synchronised to. The file
+# also marks the database as complete, as the complete file written by DatabaseSetup.database_download does
+STATEFILE = 'complete'
+
+
+def git(mirror, *arguments):
+    """
+    Run a git command that queries a mirror
+    :param mirror: path of the mirror
+    :param arguments: arguments of the git command
+    :return: stdout of the command
+    """
+    return subprocess.check_output(['git', '-C', mirror] + list(arguments), stderr=subprocess.DEVNULL)\
+        .decode('utf-8')
+
+
+def read_state(targetpath):
+    """
+    Read the commit a database folder was synchronised to
+    :param targetpath: path of the database folder
+    :return: dictionary of the url and commit of the repository. Empty if the folder was not synchronised from a
+    mirror e.g. it was cloned, or it has not been set up
+    """
+    try:
+        with open(os.path.join(targetpath, STATEFILE), 'r') as state:
+            return json.load(state).get('repository', dict())
+    except (OSError, ValueError, AttributeError):
+        return dict()
+
+
+class GitMirror(object):
+    """
+    Persistent shallow clones of the git repositories of the databases. Each refresh fetches only the latest commit of
+    a repository into its mirror, and the files that changed since the database folder was last synchronised are
+    copied to the folder, so that refreshing a database with a handful of changed alleles takes seconds
+    """
+
+    def refresh(self, url, name):
+        """
+        Update the mirror of a repository to the latest commit. The mirror is created with a shallow clone if it does
+        not exist
+        :param url: url of the repository
+        :param name: name of the mirror
+        :return: the commit of the mirror
+        """
+        mirror = os.path.join(self.mirrorpath, name)
+        if os.path.isdir(os.path.join(mirror, '.git')):
+            printtime('Fetching {} into the mirror'.format(url), self.start)
+            # The url is supplied directly rather than through a remote, so that changes to the url take effect
+            call = 'git -C {mirror} fetch --depth 1 {url} && git -C {mirror} reset --hard FETCH_HEAD'\
+                .format(mirror=mirror,
+                        url=url)
+        else:
+            printtime('Creating a mirror of {}'.format(url), self.start)
+            # Remove any partial clone left by a previous attempt
+            shutil.rmtree(mirror, ignore_errors=True)
+            call = 'git clone --depth 1 {url} {mirror}'.format(url=url,
+                                                                mirror=mirror)
+        result = self.runner.run(call, name)
+        assert result['returncode'] == 0, 'Could not update the mirror of {url}: {err}'\
+            .format(url=url,
+                    err=tail(result['stderr']))
+        return git(mirror, 'rev-parse', 'HEAD').strip()
+
+    def changes(self, name, previous, commit):
+        """
+        Find the files that differ between two commits of a mirror
+        :param name: name of the mirror
+        :param previous: commit the database folder was synchronised to, or None
+        :param commit: current commit of the mirror
+        :return: lists of the changed (including added), and removed files, relative to the repository
+        """
+        mirror = os.path.join(self.mirrorpath, name)
+        try:
+            # The previous commit is only available if it is still in the object store of the mirror
+            git(mirror, 'cat-file', '-e', '{}^{{commit}}'.format(previous))
+            diff = git(mirror, 'diff', '--name-status', '--no-renames', '-z', previous, commit)
+        except (subprocess.CalledProcessError, TypeError):
+            # Without the previous commit, every file of the repository is treated as changed
+            return [path for path in git(mirror, 'ls-tree', '-r', '-z', '--name-only', commit).split('\0') if path], \
+                list()
+        changed = list()
+        removed = list()
+        fields = diff.split('\0')
+        for status, path in zip(fields[0::2], fields[1::2]):
+            if status == 'D':
+                removed.append(path)
+            else:
+                changed.append(path)
+        return changed, removed
+
+    def sync(self, url, name, targetpath, extensions=None):
+        """
+        Refresh the mirror of a repository, and copy the files that changed since the previous synchronisation to a
+        database folder
+        :param url: url of the repository
+        :param name: name of the mirror
+        :param targetpath: path of the database folder
+        :param extensions: dictionary of file extensions to rename e.g. {'.fsa': '.tfa'}
+        :return: lists of the paths of the changed (including added), and removed files in the database folder
+        """
+        extensions = extensions if extensions else dict()
+        commit = self.refresh(url, name)
+        state = read_state(targetpath)
+        if state.get('commit') == commit and os.path.isdir(targetpath):
+            printtime('{} is up to date'.format(targetpath), self.start)
+            return list(), list()
+        changed, removed = self.changes(name, state.get('commit'), commit)
+        printtime('Updating {changed} files, and removing {removed} files in {path}'
+                  .format(changed=len(changed),
+                          removed=len(removed),
+                          path=targetpath), self.start)
+
+        def target(path):
+            filename, extension = os.path.splitext(os.path.join(targetpath, path))
+            return filename + extensions.get(extension, extension)
+        mirror = os.path.join(self.mirrorpath, name)
+        for path in changed:
+            targetfile = target(path)
+            make_path(os.path.dirname(targetfile))
+            # Copy to a temporary file first, so that an interrupted refresh does not leave a truncated file
+            shutil.copyfile(os.path.join(mirror, path), targetfile + '.tmp')
+            os.replace(targetfile + '.tmp', targetfile)
+        for path in removed:
+            if os.path.isfile(target(path)):
+                os.remove(target(path))
+        with open(os.path.join(targetpath, STATEFILE), 'w') as statefile:
+            json.dump({'repository': {'url': url, 'commit': commit}}, statefile, indent=4, sort_keys=True)
+        return [target(path) for path in changed], [target(path) for path in removed]
+
+    def __init__(self, mirrorpath, runner, start):
+        """
+        :param mirrorpath: path of the folder in which to keep the mirrors. The folder is shared by every version of
+        the databases
+        :param runner: CommandRunner object used to run the clones and fetches
+        :param start: start time of the analyses
+        """
+        self.mirrorpath = mirrorpath
+        make_path(self.mirrorpath)
+        self.runner = runner
+        self.start = start
@@ -0,0 +1,217 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import printtime
+from glob import glob
+import shutil
+import os
+__author__ = 'adamkoziol'
+
+# Stages that consume intermediate files, in the order in which they are run
+STAGES = ['merge_reads', 'run_spades', 'qualimap']
+# Approximate peak scratch space used by a sample during read processing and assembly, as a multiple of the size of
+# its raw (compressed) FASTQ files: trimmed, corrected, normalised, and merged reads, SPAdes working folders, and
+# mapping files
+FOOTPRINT_FACTOR = 8
+
+
+def read_files(value):
+    """
+    :param value: file name, list of file names, or 'NA'
+    :return: list of file names
+    """
+    if isinstance(value, str):
+        return [value] if value != 'NA' else list()
+    return list(value) if value else list()
+
+
+def trimmed_reads(sample):
+    """
+    :return: list of the quality trimmed reads of the sample
+    """
+    return read_files(sample.general.datastore.get('trimmedfastqfiles'))
+
+
+def normalised_reads(sample):
+    """
+    :return: list of the normalised reads of the sample
+    """
+    return read_files(sample.general.datastore.get('normalisedreads'))
+
+
+def merged_reads(sample):
+    """
+    :return: list of the merged, and unmerged reads of the sample
+    """
+    return [fastq for attr in ['mergedreads', 'unmergedforward', 'unmergedreverse']
+            for fastq in read_files(sample.general.datastore.get(attr))]
+
+
+def spades_folders(sample):
+    """
+    :return: list of the SPAdes working folders of the sample. The assembly itself is kept
+    """
+    spadesoutput = sample.general.datastore.get('spadesoutput', 'NA')
+    if spadesoutput == 'NA':
+        return list()
+    return glob(os.path.join(spadesoutput, 'K*')) + [os.path.join(spadesoutput, 'misc'),
+                                                     os.path.join(spadesoutput, 'tmp')]
+
+
+def mapping_files(sample):
+    """
+    :return: list of the sorted BAM files, and bowtie2 indexes created by the Qualimap stage
+    """
+    results = sample.general.datastore.get('QualimapResults', 'NA')
+    if results == 'NA':
+        return list()
+    return [filename for extension in ['*.bam', '*.bai', '*.bt2']
+            for filename in glob(os.path.join(results, extension))]
+
+
+def protected_files(sample):
+    """
+    :return: set of the files that are used by the typing stages, or to resume pre-processed runs, and are never
+    removed before the end of the run
+    """
+    return set(fastq for attr in ['fastqfiles', 'trimmedcorrectedfastqfiles']
+               for fastq in read_files(sample.general.datastore.get(attr)))
+
+
+# Intermediate files of each sample: description, the last stage that uses the files, and a function that returns
+# the files (or folders) of a sample. The trimmed reads are used in place of the normalised reads if normalisation
+# fails, so they are kept until the reads are merged
+INTERMEDIATES = [('trimmed reads', 'merge_reads', trimmed_reads),
+                 ('normalised reads', 'merge_reads', normalised_reads),
+                 ('merged reads', 'run_spades', merged_reads),
+                 ('SPAdes working folders', 'run_spades', spades_folders),
+                 ('mapping files', 'qualimap', mapping_files)]
+
+
+def path_size(path):
+    """
+    :param path: file or folder. Symbolic links are not followed
+    :return: total size in bytes
+    """
+    if os.path.islink(path) or not os.path.isdir(path):
+        try:
+            return os.lstat(path).st_size
+        except OSError:
+            return 0
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            try:
+                total += os.lstat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class IntermediateTracker(object):
+    """
+    Removes the intermediate files of samples as soon as the last stage that uses them is complete, rather than
+    waiting for the compression stage at the end of the run. Also divides the samples into batches that fit within
+    the scratch space budget of the run
+    """
+
+    def release(self, stage):
+        """
+        Remove the intermediate files that are not used by any stage after the supplied stage. Files that are still
+        referenced by later intermediates, or protected e.g. the error corrected reads used as the merged reads of
+        single-end samples, are kept
+        :param stage: name of the completed stage
+        """
+        finished = STAGES.index(stage)
+        removed = 0
+        for sample in self.pipeline.runmetadata.samples:
+            if 'general' not in sample.datastore:
+                continue
+            dead = list()
+            live = protected_files(sample)
+            for description, consumer, function in INTERMEDIATES:
+                if STAGES.index(consumer) <= finished:
+                    dead.extend(function(sample))
+                else:
+                    live.update(function(sample))
+            for path in dead:
+                if path in live or not os.path.lexists(path):
+                    continue
+                size = path_size(path)
+                try:
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                    removed += size
+                except OSError:
+                    pass
+        self.removed += removed
+        if removed:
+            printtime('Removed {size:.2f} GB of intermediate files no longer required after {stage}'
+                      .format(size=removed / 1024 ** 3,
+                              stage=stage), self.starttime)
+
+    def batches(self, samples):
+        """
+        Divide the samples into batches whose estimated scratch space requirements fit within the remaining budget.
+        The remaining budget is measured before each batch, so that the space freed by the previous batch is used
+        :param samples: list of metadata objects
+        :return: generator of lists of metadata objects
+        """
+        if not self.budget:
+            yield samples
+            return
+        remaining = list(samples)
+        while remaining:
+            available = self.available()
+            batch = list()
+            required = 0
+            for sample in remaining:
+                footprint = self.footprint(sample)
+                # Always process at least one sample, so that the run can progress
+                if batch and required + footprint > available:
+                    break
+                batch.append(sample)
+                required += footprint
+            remaining = remaining[len(batch):]
+            if remaining:
+                printtime('Scratch space budget allows {num} samples to be processed at once. {left} samples are '
+                          'waiting'.format(num=len(batch),
+                                           left=len(remaining)), self.starttime)
+            yield batch
+
+    @staticmethod
+    def footprint(sample):
+        """
+        :param sample: metadata object
+        :return: estimated peak scratch space in bytes used by the sample during read processing and assembly
+        """
+        fastqfiles = read_files(sample.general.datastore.get('fastqfiles')) if 'general' in sample.datastore \
+            else list()
+        return FOOTPRINT_FACTOR * sum(os.path.getsize(fastq) for fastq in fastqfiles if os.path.isfile(fastq))
+
+    def available(self):
+        """
+        :return: scratch space in bytes that can still be used by the run - the smaller of the remaining budget and
+        the free space on the disk. When the samples are staged, the space used in, and free on the disk of, the
+        scratch folder of the run are measured, as the samples are processed there
+        """
+        staging = getattr(self.pipeline, 'staging', None)
+        path = staging.scratchpath if staging else self.path
+        # The scratch folder is only created once the first samples are staged
+        existing = path
+        while not os.path.isdir(existing) and os.path.dirname(existing) != existing:
+            existing = os.path.dirname(existing)
+        free = shutil.disk_usage(existing).free
+        return max(min(self.budget - path_size(path), free), 0)
+
+    def __init__(self, inputobject):
+        """
+        :param inputobject: RunSpades object
+        """
+        self.pipeline = inputobject
+        self.path = inputobject.path
+        self.starttime = inputobject.starttime
+        # Scratch space budget in bytes. A budget of 0 disables the batching of samples
+        self.budget = inputobject.scratchbudget
+        # Total number of bytes removed
+        self.removed = 0
@@ -0,0 +1,349 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import make_path, printtime
+from cowbat.profileindex import open_profile_index
+from cowbat.resultcache import ResultCache
+from cowbat.lazyimport import LazyModule
+from argparse import ArgumentParser
+from threading import Thread, Lock
+from queue import PriorityQueue
+from itertools import count
+from glob import glob
+from time import time
+import multiprocessing
+import socketserver
+import traceback
+import socket
+import json
+import sys
+import os
+__author__ = 'adamkoziol'
+
+# The pipeline script is only imported once the server starts
+assembly_pipeline = LazyModule('assembly_pipeline')
+
+
+class PipelineServer(object):
+    """
+    Persistent pipeline service. The analysis modules are imported, and the commonly used databases are loaded once at
+    start-up. Runs are submitted over a Unix socket, queued by priority, and processed with shared resources (threads,
+    result cache, and profile indexes). The status of every run is available from the server, and is also written to a
+    JSON file beside the socket
+    """
+
+    def main(self):
+        """
+        Warm the modules and databases, start the workers, and serve requests
+        """
+        self.warm()
+        for worker in range(self.workers):
+            thread = Thread(target=self.worker, args=())
+            thread.setDaemon(True)
+            thread.start()
+        # Remove a socket left behind by a previous server
+        if os.path.exists(self.socketpath):
+            os.remove(self.socketpath)
+        server = socketserver.ThreadingUnixStreamServer(self.socketpath, PipelineRequestHandler)
+        server.daemon_threads = True
+        # Allow the request handlers to access the server
+        server.pipelineserver = self
+        printtime('Pipeline server listening on {}'.format(self.socketpath), self.start)
+        try:
+            server.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            printtime('Received keyboard interrupt, shutting down pipeline server', self.start)
+        finally:
+            server.server_close()
+            if os.path.exists(self.socketpath):
+                os.remove(self.socketpath)
+
+    def warm(self):
+        """
+        Import the analysis modules of the pipeline, open the MLST and rMLST profile indexes, and read the files of
+        the commonly used databases into the page cache, so that runs do not pay these costs
+        """
+        printtime('Importing pipeline modules', self.start)
+        for module in vars(assembly_pipeline.load()).values():
+            if isinstance(module, LazyModule):
+                module.load()
+        printtime('Loading databases', self.start)
+        # The profile indexes are kept open by the profile index module for the lifetime of the server
+        for profileindex in glob(os.path.join(self.reffilepath, 'rMLST', 'profiles.npy')) + \
+                glob(os.path.join(self.reffilepath, 'MLST', '*', 'profiles.npy')):
+            open_profile_index(profileindex)
+        # Use a large buffer to read the files in chunks
+        buffer = bytearray(16 * 1024 * 1024)
+        for database in self.warmdatabases:
+            for root, dirs, files in os.walk(os.path.join(self.reffilepath, database)):
+                for databasefile in files:
+                    with open(os.path.join(root, databasefile), 'rb') as data:
+                        while data.readinto(buffer):
+                            pass
+
+    def submit(self, path, arguments, priority):
+        """
+        Add a run to the queue
+        :param path: path of the sequencing run
+        :param arguments: list of additional command line arguments of the pipeline e.g. ['-bm']
+        :param priority: priority of the run. Runs with higher priorities are processed first
+        :return: dictionary of the status of the run
+        """
+        # Parse the arguments now, so that invalid requests are rejected rather than failing in the queue
+        pipelineargs = self.parse(path, arguments)
+        with self.lock:
+            order = next(self.counter)
+            runid = '{}_{}'.format(os.path.basename(os.path.normpath(pipelineargs.path)), order)
+            self.runs[runid] = {'run': runid,
+                                'path': pipelineargs.path,
+                                'arguments': list(arguments),
+                                'priority': priority,
+                                'status': 'queued',
+                                'submitted': time()}
+            self.write_status()
+        # The queue returns the lowest item first, so the priority is negated. The submission order breaks ties
+        self.queue.put((-priority, order, runid, pipelineargs))
+        printtime('Queued run {run} with priority {priority}'.format(run=runid,
+                                                                     priority=priority), self.start)
+        return dict(self.runs[runid])
+
+    def parse(self, path, arguments):
+        """
+        Parse the arguments of a run with the pipeline parser. The reference file path of the server is used unless
+        the run specifies its own, and the threads are divided between the workers
+        :param path: path of the sequencing run
+        :param arguments: list of additional command line arguments of the pipeline
+        :return: parsed arguments
+        """
+        parser = assembly_pipeline.pipeline_parser()
+        try:
+            pipelineargs = parser.parse_args([path] + list(arguments))
+        except SystemExit:
+            raise ValueError('Invalid pipeline arguments: {}'.format(' '.join([path] + list(arguments))))
+        pipelineargs.path = os.path.abspath(pipelineargs.path)
+        pipelineargs.referencefilepath = pipelineargs.referencefilepath if pipelineargs.referencefilepath \
+            else self.reffilepath
+        pipelineargs.threads = pipelineargs.threads if pipelineargs.threads else self.cpus
+        return pipelineargs
+
+    def cancel(self, runid):
+        """
+        Cancel a queued run. Runs that have started cannot be cancelled
+        :param runid: name of the run
+        :return: dictionary of the status of the run
+        """
+        with self.lock:
+            if self.runs[runid]['status'] == 'queued':
+                self.runs[runid]['status'] = 'cancelled'
+                self.write_status()
+            return dict(self.runs[runid])
+
+    def status(self, runid=None):
+        """
+        :param runid: optional name of a run
+        :return: dictionary of the status of the run, or of the server and all its runs
+        """
+        with self.lock:
+            if runid:
+                return dict(self.runs[runid])
+            return {'status': 'running',
+                    'referencefilepath': self.reffilepath,
+                    'uptime': int(time() - self.start),
+                    'workers': self.workers,
+                    'queued': sum(1 for run in self.runs.values() if run['status'] == 'queued'),
+                    'runs': [dict(run) for run in sorted(self.runs.values(), key=lambda run: run['submitted'])]}
+
+    def worker(self):
+        """
+        Process queued runs in order of priority
+        """
+        while True:
+            priority, order, runid, pipelineargs = self.queue.get()
+            with self.lock:
+                if self.runs[runid]['status'] == 'cancelled':
+                    self.queue.task_done()
+                    continue
+                self.runs[runid]['status'] = 'running'
+                self.runs[runid]['started'] = time()
+                self.write_status()
+            try:
+                summary = self.run(pipelineargs)
+                update = {'status': 'complete',
+                          'summary': summary}
+            except BaseException as error:
+                # The stages of the pipeline call quit() on errors, which must not stop the worker
+                printtime('Run {run} failed: {error!r}'.format(run=runid,
+                                                              error=error), self.start)
+                update = {'status': 'failed',
+                          'message': repr(error),
+                          'traceback': traceback.format_exc()}
+            with self.lock:
+                self.runs[runid].update(update)
+                self.runs[runid]['finished'] = time()
+                self.write_status()
+            self.queue.task_done()
+
+    def run(self, pipelineargs):
+        """
+        Run the pipeline on a sequencing run
+        :param pipelineargs: parsed arguments of the run
+        :return: dictionary summarising the run
+        """
+        pipeline = assembly_pipeline.RunSpades(pipelineargs, self.commit, time(), self.homepath)
+        # Use the result cache of the server, so that the file digests and database versions are only calculated once
+        if self.resultcache and not pipelineargs.cachepath:
+            pipeline.resultcache = self.resultcache
+        return pipeline.main()
+
+    def write_status(self):
+        """
+        Write the status of all runs to file. Must be called while holding the lock
+        """
+        with open(self.statusfile + '.tmp', 'w') as status:
+            json.dump(self.runs, status, sort_keys=True, indent=4, default=str)
+        os.replace(self.statusfile + '.tmp', self.statusfile)
+
+    def __init__(self, args):
+        self.start = args.start
+        self.socketpath = os.path.abspath(args.socket)
+        self.reffilepath = os.path.abspath(args.referencefilepath)
+        assert os.path.isdir(self.reffilepath), 'Reference file path is not a valid directory {0!r:s}'\
+            .format(self.reffilepath)
+        self.workers = int(args.workers)
+        # Divide the threads between the workers
+        self.cpus = max(int(int(args.threads if args.threads else multiprocessing.cpu_count()) / self.workers), 1)
+        self.warmdatabases = [database for database in args.warm.split(',') if database] if args.warm else list()
+        # The pipeline script is imported from the root of the repository
+        self.homepath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        if self.homepath not in sys.path:
+            sys.path.append(self.homepath)
+        self.commit = assembly_pipeline.__version__.encode('utf-8')
+        # A result cache shared by all runs
+        self.resultcache = ResultCache(args.cachepath, int(float(args.cachesize) * 1024 ** 3), self.reffilepath,
+                                       self.commit.decode('utf-8')) if args.cachepath else None
+        # Store the status of the runs in a folder beside the socket
+        self.workpath = os.path.join(os.path.dirname(self.socketpath), 'pipelineserver')
+        make_path(self.workpath)
+        self.statusfile = os.path.join(self.workpath, 'runs.json')
+        self.queue = PriorityQueue()
+        self.lock = Lock()
+        self.counter = count(1)
+        # Dictionary of run name: status
+        self.runs = dict()
+
+
+class PipelineRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Reads a single JSON-formatted request from the socket, and writes the JSON-formatted response
+    """
+
+    def handle(self):
+        server = self.server.pipelineserver
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            command = request.get('command', 'submit')
+            if command == 'submit':
+                response = server.submit(request['path'], request.get('arguments', list()),
+                                         int(request.get('priority', 0)))
+            elif command == 'cancel':
+                response = server.cancel(request['run'])
+            elif command == 'status':
+                response = server.status(request.get('run'))
+            else:
+                raise ValueError('unknown command {}'.format(command))
+        except (ValueError, KeyError, TypeError) as error:
+            response = {'status': 'error',
+                        'message': 'Invalid request: {}'.format(error)}
+        self.wfile.write((json.dumps(response, default=str) + '\n').encode('utf-8'))
+
+
+def send_request(socketpath, request):
+    """
+    Send a request to a running pipeline server, and return the response
+    :param socketpath: path of the Unix socket of the server
+    :param request: dictionary of the request
+    :return: dictionary of the response
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socketpath)
+    try:
+        client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        # Read until the newline marking the end of the response
+        response = bytes()
+        while not response.endswith(b'\n'):
+            data = client.recv(65536)
+            if not data:
+                break
+            response += data
+    finally:
+        client.close()
+    return json.loads(response.decode('utf-8'))
+
+
+# If the script is called from the command line, then call the argument parser
+if __name__ == '__main__':
+    # Parser for arguments
+    parser = ArgumentParser(description='Persistent pipeline server. Runs are submitted to the server, which keeps '
+                                        'the pipeline modules and databases loaded between runs')
+    parser.add_argument('-s', '--socket',
+                        required=True,
+                        help='Path of the Unix socket of the server')
+    subparsers = parser.add_subparsers(dest='command')
+    serve = subparsers.add_parser('serve',
+                                  help='Start the server')
+    serve.add_argument('-r', '--referencefilepath',
+                       required=True,
+                       help='Provide the location of the folder containing the pipeline accessory files. Runs use '
+                            'this folder unless they specify their own')
+    serve.add_argument('-t', '--threads',
+                       help='Number of threads. Default is the number of cores in the system')
+    serve.add_argument('-w', '--workers',
+                       default=1,
+                       type=int,
+                       help='Number of runs to process at once. The threads are divided between the runs. Default '
+                            'is 1')
+    serve.add_argument('-W', '--warm',
+                       default='mash,rMLST,MLST',
+                       help='Comma-separated list of the database folders to load into memory at start-up. Default '
+                            'is mash,rMLST,MLST')
+    serve.add_argument('-cp', '--cachepath',
+                       help='Path of a folder in which to cache typing results for all runs')
+    serve.add_argument('-cg', '--cachesize',
+                       default=10,
+                       help='Maximum size of the typing result cache in GB. Default is 10')
+    submit = subparsers.add_parser('submit',
+                                   help='Submit a run to the server')
+    submit.add_argument('path',
+                        help='Path of the sequencing run')
+    submit.add_argument('-p', '--priority',
+                        default=0,
+                        type=int,
+                        help='Priority of the run. Runs with higher priorities are processed first. Default is 0')
+    submit.add_argument('arguments',
+                        nargs='*',
+                        help='Additional pipeline arguments. Separate them from the server arguments with --, '
+                             'e.g. submit /path/to/run -- -bm')
+    status = subparsers.add_parser('status',
+                                   help='Print the status of the server, or of a run')
+    status.add_argument('run',
+                        nargs='?',
+                        help='Name of the run')
+    cancel = subparsers.add_parser('cancel',
+                                   help='Cancel a queued run')
+    cancel.add_argument('run',
+                        help='Name of the run')
+    # Get the arguments into an object
+    arguments = parser.parse_args()
+    arguments.start = time()
+    if arguments.command == 'serve':
+        # Run the server
+        pipelineserver = PipelineServer(arguments)
+        pipelineserver.main()
+    elif arguments.command == 'submit':
+        print(json.dumps(send_request(arguments.socket, {'command': 'submit',
+                                                         'path': os.path.abspath(arguments.path),
+                                                         'arguments': arguments.arguments,
+                                                         'priority': arguments.priority}), indent=4))
+    elif arguments.command in ['status', 'cancel']:
+        print(json.dumps(send_request(arguments.socket, {'command': arguments.command,
+                                                         'run': arguments.run}), indent=4))
+    else:
+        parser.print_help()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python 3
+__author__ = 'adamkoziol'
+
+# Pool of k-mer sizes from which the k-mers of each sample are selected
+DEFAULT_KMERS = [21, 33, 55, 77, 99, 127]
+# The largest k-mer used for a sample is at most this fraction of its read length. This reproduces the SPAdes
+# recommendations e.g. 21-77 for 150 bp reads, and 21-127 for 250 bp reads
+MAXFRACTION = 0.55
+# Maximum k-mer size for samples with low estimated depths: depth, maximum k-mer. Large k-mers fragment the
+# assembly graphs of samples with insufficient coverage
+DEPTHLIMITS = [(20, 55), (40, 77)]
+
+
+def parse_kmers(kmerstring):
+    """
+    :param kmerstring: k-mers separated by commas, semicolons, or spaces e.g. 21,33,55
+    :return: sorted list of the k-mers as integers
+    """
+    return sorted(set(int(kmer) for kmer in kmerstring.replace(';', ',').replace(' ', ',').split(',') if kmer))
+
+
+def automatic_kmers(readlength, depth=None, kmerpool=None):
+    """
+    Select the k-mers to use in the assembly of a sample from its read length and estimated depth
+    :param readlength: length of the forward reads
+    :param depth: optional estimated sequencing depth
+    :param kmerpool: list of the k-mers from which to select. Defaults to DEFAULT_KMERS
+    :return: sorted list of the selected k-mers. The smallest k-mer of the pool is always selected
+    """
+    kmerpool = sorted(kmerpool if kmerpool else DEFAULT_KMERS)
+    maximum = readlength * MAXFRACTION
+    if depth:
+        for limit, kmer in DEPTHLIMITS:
+            if depth < limit:
+                maximum = min(maximum, kmer)
+                break
+    return [kmer for kmer in kmerpool if kmer <= maximum] or kmerpool[:1]
+
+
+def select_kmers(sample, kmerrange=None):
+    """
+    Select the k-mers of a sample, and record the k-mers, and how they were selected, in the metadata of the sample.
+    A k-mer range supplied on the command line is used for every sample, while a Kmers column in the sample sheet
+    overrides the k-mers of individual samples. Otherwise, the k-mers are selected automatically
+    :param sample: metadata object
+    :param kmerrange: optional comma-separated k-mers supplied on the command line
+    :return: comma-separated string of the selected k-mers
+    """
+    try:
+        readlength = int(sample.run.forwardlength)
+    except (KeyError, TypeError, ValueError):
+        readlength = 0
+    sheetkmers = sample.run.datastore.get('Kmers', 'NA') if 'run' in sample.datastore else 'NA'
+    if sheetkmers != 'NA':
+        kmers = parse_kmers(sheetkmers)
+        method = 'sample sheet'
+    elif kmerrange:
+        kmers = parse_kmers(kmerrange)
+        method = 'command line'
+    elif readlength:
+        depth = sample.subsample.datastore.get('depth') if 'subsample' in sample.datastore else None
+        kmers = automatic_kmers(readlength, depth)
+        method = 'automatic'
+    else:
+        kmers = list(DEFAULT_KMERS)
+        method = 'default'
+    # K-mers must be shorter than the reads
+    if readlength:
+        kmers = [kmer for kmer in kmers if kmer <= readlength] or kmers[:1]
+    sample.general.kmers = ','.join(str(kmer) for kmer in kmers)
+    sample.general.kmerselection = method
+    return sample.general.kmers
+
+
+def kmer_groups(samples, kmerrange=None):
+    """
+    Group the samples by their selected k-mers, so that each group can be assembled with a single k-mer range
+    :param samples: list of metadata objects
+    :param kmerrange: optional comma-separated k-mers supplied on the command line
+    :return: dictionary of comma-separated k-mers: list of samples
+    """
+    groups = dict()
+    for sample in samples:
+        groups.setdefault(select_kmers(sample, kmerrange), list()).append(sample)
+    return groups
@@ -0,0 +1,51 @@
+#!/usr/bin/env python 3
+import importlib
+__author__ = 'adamkoziol'
+
+
+class LazyModule(object):
+    """
+    Stand-in for a module that is only imported when one of its attributes is first accessed. The analysis modules
+    (and the Biopython, numpy, etc. imports that they pull in) are therefore only imported by the stages that use them
+    """
+
+    def load(self):
+        """
+        :return: the imported module
+        """
+        if self.__dict__['module'] is None:
+            self.__dict__['module'] = importlib.import_module(self.__dict__['name'])
+        return self.__dict__['module']
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def __repr__(self):
+        return '<lazy module {}>'.format(self.__dict__['name'])
+
+    def __init__(self, name):
+        """
+        :param name: full name of the module e.g. spadespipeline.metadataprinter
+        """
+        self.__dict__['name'] = name
+        self.__dict__['module'] = None
+
+
+class LazyCallable(object):
+    """
+    Stand-in for a function or class of a module that is only imported when it is first called
+    """
+
+    def __call__(self, *args, **kwargs):
+        if self.target is None:
+            self.target = getattr(importlib.import_module(self.name), self.attribute)
+        return self.target(*args, **kwargs)
+
+    def __init__(self, name, attribute):
+        """
+        :param name: full name of the module e.g. accessoryFunctions.accessoryFunctions
+        :param attribute: name of the function or class in the module e.g. printtime
+        """
+        self.name = name
+        self.attribute = attribute
+        self.target = None
@@ -0,0 +1,45 @@
+#!/usr/bin/env python 3
+from cowbat.samplerecord import to_json
+from threading import Lock
+import hashlib
+import os
+__author__ = 'adamkoziol'
+
+# The digests of the pipeline are updated by the concurrent stages of the pipeline
+WRITTENLOCK = Lock()
+
+
+class MetadataPrinter(object):
+    """
+    Writes the metadata of each sample to <sample name>_metadata.json in its output directory. The files are identical
+    to those written by spadespipeline.metadataprinter, but files whose contents have not changed since they were last
+    written by the pipeline are not written again. The digests of the written files are kept on the pipeline object,
+    so that each run (e.g. each run of the job server) starts with none
+    """
+
+    def printmetadata(self):
+        """
+        Write the metadata of the samples with FASTQ files
+        """
+        for sample in self.metadata:
+            if type(sample.general.fastqfiles) is not list:
+                continue
+            jsonfile = os.path.join(sample.general.outputdirectory, '{}_metadata.json'.format(sample.name))
+            contents = to_json(sample)
+            digest = hashlib.sha1(contents.encode('utf-8')).hexdigest()
+            with WRITTENLOCK:
+                if self.written.get(jsonfile) == digest and os.path.isfile(jsonfile):
+                    continue
+            with open(jsonfile, 'w') as metadatafile:
+                metadatafile.write(contents)
+            with WRITTENLOCK:
+                self.written[jsonfile] = digest
+
+    def __init__(self, inputobject):
+        """
+        :param inputobject: pipeline object with the samples in runmetadata.samples, and the dictionary of metadata
+        file: digest of the contents last written to the file in metadatadigests
+        """
+        self.written = inputobject.metadatadigests
+        self.metadata = inputobject.runmetadata.samples
+        self.printmetadata()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import printtime, make_path, MetadataObject
+from cowbat.streamreport import divide_reports, write_report
+import copy
+import os
+__author__ = 'adamkoziol'
+
+
+def run_directories(entries):
+    """
+    Find the run folders to analyse together
+    :param entries: list of run folders, or of manifest files listing one run folder per line. Empty lines, and lines
+    starting with # are ignored. Relative paths in manifests are relative to the manifest
+    :return: list of the absolute paths of the run folders, in the order supplied
+    """
+    runs = list()
+    for entry in entries:
+        if os.path.isfile(entry):
+            with open(entry, 'r') as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        runs.append(os.path.join(os.path.dirname(os.path.abspath(entry)), line))
+        else:
+            runs.append(entry)
+    directories = list()
+    for run in runs:
+        run = os.path.abspath(run)
+        assert os.path.isdir(run), 'Supplied run folder is not a valid directory {0!r:s}'.format(run)
+        if run not in directories:
+            directories.append(run)
+    return directories
+
+
+def run_rounds(pipelines):
+    """
+    Group runs so that no sample name occurs twice in a group, as the typing stages and their reports identify
+    samples by name. Most batches consist of a single group
+    :param pipelines: list of pipeline objects of the runs, with populated metadata
+    :return: list of lists of pipeline objects
+    """
+    rounds = list()
+    for pipeline in pipelines:
+        names = set(sample.name for sample in pipeline.runmetadata.samples)
+        for runround, roundnames in rounds:
+            if not names & roundnames:
+                runround.append(pipeline)
+                roundnames.update(names)
+                break
+        else:
+            rounds.append(([pipeline], names))
+    return [runround for runround, roundnames in rounds]
+
+
+def split_reports(reportpath, runs):
+    """
+    Create the reports of the typing stages of each run from the reports of the batch. The reports are divided by
+    sample, and each run receives the rows of its own samples. Reports that cannot be divided by sample e.g. the CLARK
+    Excel reports, are only kept in the reports folder of the batch
+    :param reportpath: path of the reports of the batch
+    :param runs: list of the list of the names of the samples, and the path of the reports of each run
+    :return: sorted list of the names of the reports that could not be divided
+    """
+    allnames = set(name for names, runreportpath in runs for name in names)
+    # A run with the reports folder of the batch already has its reports
+    runs = [(names, runreportpath) for names, runreportpath in runs
+            if os.path.abspath(runreportpath) != os.path.abspath(reportpath)]
+    undivided = list()
+    if not runs:
+        return undivided
+    for filename, blocks in sorted(divide_reports(reportpath, allnames).items()):
+        if blocks is None:
+            undivided.append(filename)
+            continue
+        for names, runreportpath in runs:
+            make_path(runreportpath)
+            write_report([blocks[name] for name in names], os.path.join(runreportpath, filename))
+    return undivided
+
+
+class MultiRun(object):
+    """
+    Analyses several sequencing runs as a single batch. The reads of each run are processed and assembled in the run
+    folder, and the CLARK and typing stages then analyse the samples of all the runs together, so that each database
+    and index is loaded once per batch rather than once per run. The combined reports and metadata are created in each
+    run folder. The reports of the individual typing stages of the batch are created in the reports folder of the path
+    supplied to the pipeline, and the rows of the samples of each run are written to the reports folder of the run.
+    Reports that cannot be divided by sample are only created in the reports folder of the batch
+    """
+
+    def main(self):
+        """
+        Analyse the runs
+        :return: dictionary summarising the batch
+        """
+        printtime('Analysing {} runs as a single batch'.format(len(self.runs)), self.starttime)
+        pipelines = [self.run_pipeline(run) for run in self.runs]
+        for pipeline in pipelines:
+            # Populate the metadata of the samples of the run
+            pipeline.helper()
+        rounds = run_rounds(pipelines)
+        if len(rounds) > 1:
+            printtime('Sample names are shared between runs. The runs will be typed in {} groups'.format(len(rounds)),
+                      self.starttime)
+        summaries = list()
+        for number, runround in enumerate(rounds):
+            for pipeline in runround:
+                printtime('Processing the reads of {}'.format(pipeline.path), self.starttime)
+                pipeline.process_run()
+            if not self.pipeline.preprocess:
+                self.characterise(runround, number if len(rounds) > 1 else None)
+            for pipeline in runround:
+                pipeline.sample_reports()
+                summaries.append(pipeline.finish())
+        return {'status': 'preprocessed' if self.pipeline.preprocess else 'complete',
+                'path': self.pipeline.path,
+                'commit': self.pipeline.commit,
+                'runs': summaries}
+
+    def run_pipeline(self, run):
+        """
+        Create the pipeline object of a run, with the same settings as the batch
+        :param run: path of the run folder
+        :return: pipeline object
+        """
+        arguments = copy.copy(self.pipeline.args)
+        arguments.path = run
+        arguments.multirun = None
+        # Each run uses its own sample sheet
+        arguments.customsamplesheet = None
+        # The databases are staged once for the batch
+        arguments.stagedatabases = False
+        pipeline = self.pipeline.__class__(arguments, self.pipeline.commit.encode('utf-8'), self.starttime,
+                                           self.pipeline.homepath)
+        pipeline.reffilepath = self.pipeline.reffilepath
+        return pipeline
+
+    def characterise(self, pipelines, number=None):
+        """
+        Run the CLARK and typing stages on the samples of several runs at once
+        :param pipelines: list of pipeline objects of the runs
+        :param number: number of the group of runs if the batch is typed in several groups
+        """
+        batch = copy.copy(self.pipeline)
+        batch.runmetadata = MetadataObject()
+        batch.runmetadata.samples = [sample for pipeline in pipelines for sample in pipeline.runmetadata.samples]
+        if number is not None:
+            batch.reportpath = os.path.join(self.pipeline.reportpath, 'group{}'.format(number + 1))
+        make_path(batch.reportpath)
+        printtime('Typing {num} samples from {runs} runs'.format(num=len(batch.runmetadata.samples),
+                                                                runs=len(pipelines)), self.starttime)
+        batch.characterise()
+        # Each run keeps the typing reports of its own samples
+        for filename in split_reports(batch.reportpath, [([sample.name for sample in pipeline.runmetadata.samples],
+                                                          pipeline.reportpath) for pipeline in pipelines]):
+            printtime('{file} cannot be divided by run, and is only available in {path}'
+                      .format(file=filename,
+                              path=batch.reportpath), self.starttime)
+
+    def __init__(self, inputobject):
+        """
+        :param inputobject: RunSpades object of the batch
+        """
+        self.pipeline = inputobject
+        self.runs = inputobject.multirun
+        self.starttime = inputobject.starttime
+        assert not inputobject.watch, 'Watch mode cannot be used to analyse multiple runs'
@@ -0,0 +1,185 @@
+#!/usr/bin/env python 3
+from csv import DictReader
+import numpy as np
+import json
+import os
+__author__ = 'adamkoziol'
+
+# Encoded allele values. Integer alleles are stored as the allele number plus two, so that the lowest values are
+# available for unknown alleles, and for alleles of 'N' (allowed for certain rMLST genes), which match any allele
+UNKNOWN = 0
+WILDCARD = 1
+# Number of profiles to compare at once in closest profile queries - limits the memory used to search large schemes
+CHUNKSIZE = 65536
+# Dictionary of index file: opened index. Each index is only opened once per run
+OPENED = dict()
+
+
+def encode_allele(allele):
+    """
+    :param allele: allele number as a string e.g. '12', 'N', or ''
+    :return: encoded integer value of the allele
+    """
+    if allele is None:
+        return UNKNOWN
+    allele = allele.strip()
+    if allele == 'N':
+        return WILDCARD
+    try:
+        return int(allele) + 2
+    except ValueError:
+        return UNKNOWN
+
+
+def profile_loci(fieldnames, rows, stcolumn):
+    """
+    Determine the loci of a profile table. Locus columns only contain allele numbers (or 'N'), while additional
+    columns e.g. clonal_complex, genus, and species do not
+    :param fieldnames: list of the column names of the table
+    :param rows: list of the rows of the table
+    :param stcolumn: name of the sequence type column
+    :return: list of the locus columns in table order
+    """
+    loci = list()
+    for column in fieldnames:
+        if column == stcolumn:
+            continue
+        values = [row[column].strip() for row in rows if row.get(column)]
+        if values and all(value.isdigit() or value == 'N' for value in values):
+            loci.append(column)
+    return loci
+
+
+def create_profile_index(profilefile, indexfile=None, loci=None):
+    """
+    Compile a profile table into a matrix of encoded allele numbers sorted by allele profile. The sequence type of each
+    profile is stored in the first column. The matrix is saved as a .npy file, so it can be memory-mapped rather than
+    parsed, and the names of the loci are stored in a JSON header. The index is only rebuilt if the table changes
+    :param profilefile: name and path of the tab-delimited profile table
+    :param indexfile: name and path of the index. Defaults to profiles.npy in the folder of the profile table
+    :param loci: optional list of the loci of the scheme. Defaults to the locus columns of the table
+    :return: name and path of the index
+    """
+    indexfile = indexfile if indexfile else os.path.join(os.path.dirname(profilefile), 'profiles.npy')
+    headerfile = os.path.splitext(indexfile)[0] + '.json'
+    stats = os.stat(profilefile)
+    signature = '{size}_{mtime}'.format(size=stats.st_size,
+                                        mtime=int(stats.st_mtime))
+    try:
+        with open(headerfile) as header:
+            if json.load(header)['signature'] == signature and os.path.isfile(indexfile):
+                return indexfile
+    except (IOError, ValueError, KeyError):
+        pass
+    with open(profilefile) as profile:
+        reader = DictReader(profile, dialect='excel-tab')
+        # The sequence type column is ST for MLST, and rST for rMLST
+        stcolumn = 'ST' if 'ST' in reader.fieldnames else 'rST'
+        rows = [row for row in reader if row[stcolumn] and row[stcolumn].strip().isdigit()]
+        fieldnames = reader.fieldnames
+    if loci:
+        loci = [locus for locus in loci if locus in fieldnames]
+    else:
+        loci = profile_loci(fieldnames, rows, stcolumn)
+    matrix = np.zeros((len(rows), len(loci) + 1), dtype=np.uint32)
+    for index, row in enumerate(rows):
+        matrix[index, 0] = int(row[stcolumn])
+        matrix[index, 1:] = [encode_allele(row.get(locus)) for locus in loci]
+    # Sort the profiles by allele profile - np.lexsort uses the last key as the primary key
+    if len(rows):
+        matrix = matrix[np.lexsort(matrix[:, :0:-1].T)]
+    # Write the index and header to temporary files, and rename them once complete
+    np.save(indexfile + '.tmp.npy', matrix)
+    with open(headerfile + '.tmp', 'w') as header:
+        json.dump({'signature': signature,
+                   'profilefile': os.path.abspath(profilefile),
+                   'stcolumn': stcolumn,
+                   'loci': loci}, header)
+    os.replace(indexfile + '.tmp.npy', indexfile)
+    os.replace(headerfile + '.tmp', headerfile)
+    return indexfile
+
+
+def open_profile_index(indexfile):
+    """
+    Open a profile index. Indexes are kept open, so that subsequent calls with the same index are free
+    :param indexfile: name and path of the index
+    :return: ProfileIndex object
+    """
+    if indexfile not in OPENED:
+        OPENED[indexfile] = ProfileIndex(indexfile)
+    return OPENED[indexfile]
+
+
+class ProfileIndex(object):
+    """
+    Resolves allele profiles to sequence types using a profile index created with create_profile_index
+    """
+
+    def encode(self, alleles):
+        """
+        :param alleles: dictionary of locus: allele number
+        :return: list of the encoded allele numbers in the order of the loci of the index
+        """
+        return [encode_allele(alleles.get(locus)) for locus in self.loci]
+
+    def sequencetype(self, alleles):
+        """
+        Find the sequence type of a profile
+        :param alleles: dictionary of locus: allele number
+        :return: sequence type of the profile as a string, or None if the profile is not in the index
+        """
+        query = self.encode(alleles)
+        if UNKNOWN in query:
+            return None
+        # Binary search of the sorted profiles
+        low, high = 0, len(self.profiles)
+        while low < high:
+            middle = (low + high) // 2
+            if self.profiles[middle, 1:].tolist() < query:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.profiles) and self.profiles[low, 1:].tolist() == query:
+            return str(self.profiles[low, 0])
+        # Profiles with alleles of 'N' are not found by the binary search - they match any allele at those loci
+        if self.wildcards:
+            sequencetypes, mismatches = self.closest(alleles)
+            if mismatches == 0:
+                return sequencetypes[0]
+        return None
+
+    def closest(self, alleles, limit=None):
+        """
+        Find the profiles with the fewest mismatches to the supplied alleles. Alleles of 'N' in the profiles match
+        any allele, while loci without an allele in the query are always mismatches
+        :param alleles: dictionary of locus: allele number
+        :param limit: optional maximum number of mismatches
+        :return: list of the sequence types of the closest profiles (sorted), number of mismatches
+        """
+        query = np.array(self.encode(alleles), dtype=np.uint32)
+        unknown = query == UNKNOWN
+        best = len(self.loci) + 1
+        sequencetypes = list()
+        for start in range(0, len(self.profiles), CHUNKSIZE):
+            chunk = self.profiles[start:start + CHUNKSIZE]
+            mismatches = (((chunk[:, 1:] != query) & (chunk[:, 1:] != WILDCARD)) | unknown).sum(axis=1)
+            chunkbest = int(mismatches.min())
+            if chunkbest < best:
+                best = chunkbest
+                sequencetypes = list()
+            if chunkbest == best:
+                sequencetypes.extend(chunk[mismatches == best, 0].tolist())
+        if not sequencetypes or (limit is not None and best > limit):
+            return list(), None
+        return [str(sequencetype) for sequencetype in sorted(sequencetypes)], best
+
+    def __init__(self, indexfile):
+        self.indexfile = indexfile
+        with open(os.path.splitext(indexfile)[0] + '.json') as header:
+            self.header = json.load(header)
+        self.loci = self.header['loci']
+        self.profilefile = self.header['profilefile']
+        # Memory-map the profiles; only the rows required by each query are read from disk
+        self.profiles = np.load(indexfile, mmap_mode='r')
+        self.wildcards = bool(len(self.profiles)) and bool((self.profiles[:, 1:] == WILDCARD).any())
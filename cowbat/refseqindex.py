@@ -0,0 +1,86 @@
+#!/usr/bin/env python 3
+import sqlite3
+import os
+__author__ = 'adamkoziol'
+
+
+def create_refseq_index(summaryfile, indexfile=None):
+    """
+    Create an SQLite-backed index of the RefSeq assembly summary, so that the organism name of a RefSeq assembly can
+    be retrieved without parsing the entire summary file for every run. The size and modification time of the summary
+    file are stored in the index, and the index is only rebuilt if the summary file changes
+    :param summaryfile: name and path of the assembly_summary_refseq.txt file
+    :param indexfile: name and path of the index to create. Defaults to the summary file with a .sqlite extension
+    :return: name and path of the index
+    """
+    if not indexfile:
+        indexfile = os.path.splitext(summaryfile)[0] + '.sqlite'
+    # Use the size and modification time of the summary file to determine if an existing index is current
+    stats = os.stat(summaryfile)
+    signature = '{size}_{mtime}'.format(size=stats.st_size,
+                                        mtime=int(stats.st_mtime))
+    if os.path.isfile(indexfile):
+        try:
+            db = sqlite3.connect(indexfile)
+            current = db.execute('SELECT value FROM meta WHERE key = ?', ('signature',)).fetchone()
+            db.close()
+            if current and current[0] == signature:
+                return indexfile
+        except sqlite3.DatabaseError:
+            pass
+    # Build the index in a temporary file, and move it into place once complete, so that an interrupted build never
+    # leaves a partial index behind
+    tmpfile = indexfile + '.tmp'
+    if os.path.isfile(tmpfile):
+        os.remove(tmpfile)
+    db = sqlite3.connect(tmpfile)
+    db.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+    db.execute('CREATE TABLE refseq (accession TEXT PRIMARY KEY, organism TEXT) WITHOUT ROWID')
+    with open(summaryfile) as summary:
+        db.executemany('INSERT OR REPLACE INTO refseq VALUES (?, ?)', summary_entries(summary))
+    db.execute('INSERT INTO meta VALUES (?, ?)', ('signature', signature))
+    db.commit()
+    db.close()
+    os.replace(tmpfile, indexfile)
+    return indexfile
+
+
+def summary_entries(summary):
+    """
+    Yield the accession: organism name pairs from an open assembly summary file
+    :param summary: file handle of the assembly_summary_refseq.txt file
+    """
+    for line in summary:
+        # Ignore the comment and header lines
+        if line.startswith('#'):
+            continue
+        # Split the lines on tabs
+        data = line.split('\t')
+        # Strip the version from the accession e.g. GCF_001298055.1: Helicobacter pullorum becomes
+        # GCF_001298055: Helicobacter pullorum
+        yield data[0].split('.')[0], data[7]
+
+
+class RefSeqIndex(object):
+
+    def lookup(self, referenceid):
+        """
+        Find the organism name of a RefSeq assembly
+        :param referenceid: name of the reference in the RefSeq sketch e.g. GCF_000008865.1_ASM886v1_genomic.fna.gz
+        :return: organism name of the reference e.g. Escherichia coli O157:H7 str. Sakai
+        """
+        # Extract the accession from the reference name e.g. GCF_000008865.1_ASM886v1_genomic.fna.gz becomes
+        # GCF_000008865
+        accession = os.path.basename(referenceid).split('.')[0]
+        result = self.db.execute('SELECT organism FROM refseq WHERE accession = ?', (accession,)).fetchone()
+        if result is None:
+            raise KeyError(accession)
+        return result[0]
+
+    def close(self):
+        self.db.close()
+
+    def __init__(self, indexfile):
+        self.indexfile = indexfile
+        # Open the index read-only
+        self.db = sqlite3.connect('file:{}?mode=ro'.format(self.indexfile), uri=True)
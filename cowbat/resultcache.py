@@ -0,0 +1,323 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import GenObject, make_path
+from cowbat.samplerecord import Section
+from time import time
+import hashlib
+import shutil
+import json
+import os
+__author__ = 'adamkoziol'
+
+# Only files with these extensions are used to determine the version of a database. Files created from the databases
+# by the analyses (BLAST and bowtie2 indexes, combined targets, etc.) are ignored, so that the version of a database
+# does not change when it is first used
+DATABASE_EXTENSIONS = {'.tfa', '.fsa', '.fa', '.fasta', '.txt', '.csv', '.tsv', '.msh', '.json'}
+
+
+class ResultCache(object):
+    """
+    Persistent cache of the metadata created by typing stages. Entries are keyed by a hash of the input reads or
+    assembly of a sample, the name of the sample, the version of the database, the pipeline commit, and the parameters
+    of the stage. The files in the output directory of the sample that are referenced by the cached metadata, and the
+    rows of the sample in the reports of the stage, are stored with the entry, and are restored with the metadata
+    """
+
+    def keys(self, samples, stage, databases, inputs, parameters):
+        """
+        Create the cache keys of the samples for a stage
+        :param samples: list of metadata objects
+        :param stage: name of the stage
+        :param databases: list of the names of the database folders used by the stage
+        :param inputs: 'reads' or 'assembly'; the input files of the stage
+        :param parameters: list of the parameters of the stage e.g. cutoff values
+        :return: dictionary of sample name: cache key. Samples with missing input files are not cached, and have no key
+        """
+        keys = dict()
+        databaseversions = [self.database_version(database) for database in databases]
+        for sample in samples:
+            if inputs == 'assembly':
+                files = [sample.general.datastore.get('bestassemblyfile', 'NA')]
+            else:
+                files = sample.general.datastore.get('fastqfiles', list())
+                files = files if type(files) is list else [files]
+            digests = [self.file_digest(filename) for filename in files]
+            if not digests or 'NA' in digests:
+                continue
+            # The name of the sample is part of the key, as the cached metadata and report rows include the name
+            keydata = [stage,
+                       list(parameters),
+                       self.commit,
+                       databaseversions,
+                       sample.name,
+                       digests,
+                       sample.general.datastore.get('referencegenus', 'NA')]
+            keys[sample.name] = hashlib.sha256(json.dumps(keydata, sort_keys=True).encode('utf-8')).hexdigest()
+        return keys
+
+    def restore(self, samples, keys, reports=None):
+        """
+        Restore the metadata of samples with cached results
+        :param samples: list of metadata objects
+        :param keys: dictionary of sample name: cache key
+        :param reports: optional dictionary to populate with sample name: dictionary of report name: cached rows of the
+        sample in the report
+        :return: list of the samples without cached results
+        """
+        misses = list()
+        for sample in samples:
+            if sample.name not in keys:
+                misses.append(sample)
+                continue
+            entryfile = self.entry_path(keys[sample.name])
+            try:
+                with open(entryfile) as entry:
+                    cached = json.load(entry)
+                # Entries without report rows cannot recreate the reports of the stage
+                samplereports = cached['reports']
+                # Copy the output files of the entry to the output directory of the sample
+                filepath = self.files_path(keys[sample.name])
+                for relativepath in cached['files']:
+                    outputfile = os.path.join(sample.general.outputdirectory, relativepath)
+                    make_path(os.path.dirname(outputfile))
+                    shutil.copy2(os.path.join(filepath, relativepath), outputfile)
+                for relativepath in cached['directories']:
+                    make_path(os.path.join(sample.general.outputdirectory, relativepath))
+            except (IOError, OSError, ValueError, KeyError):
+                misses.append(sample)
+                continue
+            if reports is not None:
+                reports[sample.name] = samplereports
+            for attribute, values in cached['metadata'].items():
+                # Update paths in the cached data to point to the current output directory of the sample
+                values = self.relocate(values, cached['outputdirectory'], sample.general.outputdirectory)
+                if attribute in sample.datastore and isinstance(sample.datastore[attribute], (GenObject, Section)):
+                    sample[attribute].datastore.update(values)
+                else:
+                    setattr(sample, attribute, GenObject(values))
+            # Update the modification time of the entry, as the least recently used entries are evicted first
+            os.utime(entryfile)
+        return misses
+
+    @staticmethod
+    def snapshot(samples):
+        """
+        Record the metadata of samples prior to running a stage
+        :param samples: list of metadata objects
+        :return: dictionary of sample name: JSON-compatible copy of the metadata
+        """
+        return {sample.name: json.loads(json.dumps(sample.dump(), default=str)) for sample in samples}
+
+    def store(self, samples, keys, snapshots, reports=None):
+        """
+        Add the metadata created by a stage to the cache
+        :param samples: list of metadata objects
+        :param keys: dictionary of sample name: cache key
+        :param snapshots: dictionary of sample name: metadata prior to running the stage
+        :param reports: dictionary of report name: dictionary of sample name: rows of the sample in the report, as
+        created by streamreport.report_blocks. Default is that the stage creates no reports
+        """
+        reports = reports if reports else dict()
+        for sample in samples:
+            if sample.name not in keys:
+                continue
+            before = snapshots[sample.name]
+            after = json.loads(json.dumps(sample.dump(), default=str))
+            # Only the attributes added or changed by the stage are stored
+            metadata = dict()
+            for attribute, values in after.items():
+                if not isinstance(values, dict):
+                    continue
+                previous = before.get(attribute, dict())
+                previous = previous if isinstance(previous, dict) else dict()
+                changed = {key: value for key, value in values.items()
+                           if key not in previous or previous[key] != value}
+                if changed:
+                    metadata[attribute] = changed
+            entryfile = self.entry_path(keys[sample.name])
+            make_path(os.path.dirname(entryfile))
+            # Store the files in the output directory of the sample that are referenced by the cached metadata
+            files, directories = self.output_files(metadata, sample.general.outputdirectory)
+            filepath = self.files_path(keys[sample.name])
+            shutil.rmtree(filepath, ignore_errors=True)
+            for relativepath in files:
+                make_path(os.path.dirname(os.path.join(filepath, relativepath)))
+                shutil.copy2(os.path.join(sample.general.outputdirectory, relativepath),
+                             os.path.join(filepath, relativepath))
+                self.size += os.path.getsize(os.path.join(filepath, relativepath))
+            # Write to a temporary file, and rename it, so that a partially-written entry is never read
+            with open(entryfile + '.tmp', 'w') as entry:
+                json.dump({'sample': sample.name,
+                           'outputdirectory': sample.general.outputdirectory,
+                           'created': time(),
+                           'files': files,
+                           'directories': directories,
+                           'metadata': metadata,
+                           'reports': {filename: blocks[sample.name] for filename, blocks in reports.items()}},
+                          entry, sort_keys=True)
+            os.replace(entryfile + '.tmp', entryfile)
+            self.size += os.path.getsize(entryfile)
+        # Only search the cache for entries to evict once it exceeds its maximum size
+        if self.size > self.maxsize:
+            self.evict()
+
+    @staticmethod
+    def report_files(reportpath):
+        """
+        Record the reports in a folder, so that the reports created or updated by a stage can be found
+        :param reportpath: path of the reports
+        :return: dictionary of report name: size and modification time of the report
+        """
+        if not os.path.isdir(reportpath):
+            return dict()
+        signatures = dict()
+        for filename in os.listdir(reportpath):
+            stats = os.stat(os.path.join(reportpath, filename))
+            if not os.path.isdir(os.path.join(reportpath, filename)):
+                signatures[filename] = (stats.st_size, stats.st_mtime_ns)
+        return signatures
+
+    @staticmethod
+    def output_files(metadata, outputdirectory):
+        """
+        Find the files and folders in the output directory of a sample referenced by metadata
+        :param metadata: JSON-compatible metadata
+        :param outputdirectory: output directory of the sample
+        :return: sorted lists of the paths of the files, and of the folders, relative to the output directory
+        """
+        files = set()
+        directories = set()
+        values = [metadata]
+        while values:
+            value = values.pop()
+            if isinstance(value, dict):
+                values.extend(value.values())
+            elif isinstance(value, list):
+                values.extend(value)
+            elif isinstance(value, str) and value.startswith(os.path.join(outputdirectory, '')):
+                if os.path.isfile(value):
+                    files.add(os.path.relpath(value, outputdirectory))
+                elif os.path.isdir(value):
+                    directories.add(os.path.relpath(value, outputdirectory))
+        return sorted(files), sorted(directories)
+
+    def evict(self):
+        """
+        Remove the least recently used entries, and their files, until the cache is below its maximum size
+        """
+        entries = dict()
+        totalsize = 0
+        for root, dirs, files in os.walk(self.cachepath):
+            for filename in files:
+                stats = os.stat(os.path.join(root, filename))
+                # The entry of a file is the entry file (<prefix>/<key>.json), or the folder of the files of the
+                # entry (<prefix>/<key>/...)
+                key = os.path.relpath(os.path.join(root, filename), self.cachepath).split(os.sep)[1].split('.')[0]
+                mtime, size = entries.get(key, (0, 0))
+                # The modification time of the entry file determines when the entry was last used. Files without an
+                # entry file are left by interrupted stores, and are removed first
+                if filename == '{}.json'.format(key):
+                    mtime = stats.st_mtime
+                entries[key] = (mtime, size + stats.st_size)
+                totalsize += stats.st_size
+        for key, (mtime, size) in sorted(entries.items(), key=lambda entry: entry[1][0]):
+            if totalsize <= self.maxsize:
+                break
+            for entryfile in [self.entry_path(key), self.entry_path(key) + '.tmp']:
+                try:
+                    os.remove(entryfile)
+                except OSError:
+                    pass
+            shutil.rmtree(self.files_path(key), ignore_errors=True)
+            totalsize -= size
+        self.size = totalsize
+
+    def entry_path(self, key):
+        """
+        :param key: cache key
+        :return: name and path of the cache entry. Entries are split into subfolders based on the start of the key
+        """
+        return os.path.join(self.cachepath, key[:2], '{}.json'.format(key))
+
+    def files_path(self, key):
+        """
+        :param key: cache key
+        :return: path of the folder in which the output files of the entry are stored
+        """
+        return os.path.join(self.cachepath, key[:2], key)
+
+    def file_digest(self, filename):
+        """
+        Calculate the SHA-256 digest of the contents of a file. Digests are stored, so that each file is only read
+        once per run
+        :param filename: name and path of the file
+        :return: digest of the file, or 'NA' if the file does not exist
+        """
+        try:
+            stats = os.stat(filename)
+        except (OSError, TypeError):
+            return 'NA'
+        signature = (os.path.realpath(filename), stats.st_size, stats.st_mtime)
+        if signature not in self.digests:
+            digest = hashlib.sha256()
+            with open(filename, 'rb') as inputfile:
+                for chunk in iter(lambda: inputfile.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            self.digests[signature] = digest.hexdigest()
+        return self.digests[signature]
+
+    def database_version(self, database):
+        """
+        Determine the version of a database from the names, sizes, and modification times of its files
+        :param database: name of the database folder
+        :return: digest of the file listing of the database
+        """
+        if database not in self.databaseversions:
+            listing = list()
+            databasepath = os.path.join(self.reffilepath, database)
+            for root, dirs, files in os.walk(databasepath):
+                for filename in files:
+                    if os.path.splitext(filename)[1] in DATABASE_EXTENSIONS \
+                            and not filename.startswith('combinedtargets'):
+                        stats = os.stat(os.path.join(root, filename))
+                        listing.append((os.path.relpath(os.path.join(root, filename), databasepath),
+                                        stats.st_size,
+                                        int(stats.st_mtime)))
+            self.databaseversions[database] = hashlib.sha256(json.dumps(sorted(listing)).encode('utf-8')).hexdigest()
+        return self.databaseversions[database]
+
+    def relocate(self, values, previous, current):
+        """
+        Replace the previous output directory of a sample with its current output directory in cached values
+        :param values: cached value
+        :param previous: output directory of the sample when the entry was created
+        :param current: current output directory of the sample
+        :return: value with updated paths
+        """
+        if previous == current:
+            return values
+        if isinstance(values, str):
+            return current + values[len(previous):] if values.startswith(previous) else values
+        if isinstance(values, list):
+            return [self.relocate(value, previous, current) for value in values]
+        if isinstance(values, dict):
+            return {key: self.relocate(value, previous, current) for key, value in values.items()}
+        return values
+
+    def __init__(self, cachepath, maxsize, reffilepath, commit):
+        """
+        :param cachepath: path of the folder in which the cache is stored
+        :param maxsize: maximum size of the cache in bytes
+        :param reffilepath: path of the databases
+        :param commit: the pipeline commit; results from other versions of the pipeline are not used
+        """
+        self.cachepath = os.path.abspath(cachepath)
+        make_path(self.cachepath)
+        self.maxsize = maxsize
+        self.reffilepath = reffilepath
+        self.commit = commit
+        self.digests = dict()
+        self.databaseversions = dict()
+        # Size of the cache, which is updated as entries are stored. The size is determined from the cache folder
+        # when the cache is opened, and whenever entries are evicted, as other runs may share the cache
+        self.size = sum(os.path.getsize(os.path.join(root, filename))
+                        for root, dirs, files in os.walk(self.cachepath) for filename in files)
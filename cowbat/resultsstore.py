@@ -0,0 +1,283 @@
+#!/usr/bin/env python 3
+from argparse import ArgumentParser
+from datetime import datetime
+import sqlite3
+import json
+import csv
+import sys
+import os
+__author__ = 'adamkoziol'
+
+# Formats of the dates in Illumina sample sheets
+DATEFORMATS = ['%Y-%m-%d', '%m/%d/%Y', '%d/%m/%Y', '%Y%m%d', '%d-%b-%y']
+# Columns of the samples table that can be returned by queries
+COLUMNS = ['name', 'runpath', 'date', 'analysisdate', 'pipelineversion', 'genus', 'sequencetype', 'rmlst',
+           'serotype', 'serovar', 'closestrefseq', 'n50', 'numcontigs', 'genomelength']
+# Analyses that report the presence of genes: analysis, attribute containing the list of genes
+GENEANALYSES = [('genesippr', 'report_output'),
+                ('vtyper', 'profile'),
+                ('resfinder', 'pipelineresults'),
+                ('plasmidextractor', 'plasmids')]
+
+
+def attribute(sample, analysis, attr):
+    """
+    :param sample: metadata object
+    :param analysis: name of the analysis e.g. mlst
+    :param attr: name of the attribute e.g. sequencetype
+    :return: value of the attribute, or None if the analysis or attribute are missing, or the value is NA or -
+    """
+    if analysis not in sample.datastore:
+        return None
+    try:
+        value = sample[analysis].datastore.get(attr)
+    except AttributeError:
+        return None
+    if isinstance(value, (list, set, tuple)):
+        value = ';'.join(sorted(str(item) for item in value))
+    if value in [None, 'NA', '-', '', 'ND']:
+        return None
+    return str(value)
+
+
+def iso_date(date):
+    """
+    :param date: date from the sample sheet
+    :return: date in YYYY-MM-DD format, or None if the format is not recognised
+    """
+    if not date:
+        return None
+    for dateformat in DATEFORMATS:
+        try:
+            return datetime.strptime(date.strip(), dateformat).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return None
+
+
+def serotype(sample):
+    """
+    :param sample: metadata object
+    :return: E. coli serotype e.g. O157:H7 from the serotyping analyses, or None
+    """
+    if 'serosippr' not in sample.datastore:
+        return None
+    ogroups = sample.serosippr.datastore.get('o_set', list())
+    hgroups = sample.serosippr.datastore.get('h_set', list())
+    ogroup = ';'.join(group for group in ogroups if group not in ['-', 'NA'])
+    hgroup = ';'.join(group for group in hgroups if group not in ['-', 'NA'])
+    if not ogroup and not hgroup:
+        return None
+    return '{o}:{h}'.format(o=ogroup if ogroup else '-',
+                            h=hgroup if hgroup else '-')
+
+
+def genes(sample):
+    """
+    :param sample: metadata object
+    :return: set of (analysis, gene) tuples of the genes detected in the sample
+    """
+    detected = set()
+    for analysis, attr in GENEANALYSES:
+        if analysis not in sample.datastore:
+            continue
+        values = sample[analysis].datastore.get(attr)
+        if not isinstance(values, (list, set, tuple)):
+            continue
+        for gene in values:
+            gene = str(gene).strip()
+            if gene and gene not in ['NA', '-', 'ND']:
+                detected.add((analysis, gene))
+    return detected
+
+
+class ResultsStore(object):
+    """
+    SQLite database of the typing results of every sample analysed by the pipeline, across runs. The sequence type,
+    serotype, genus, and detected genes are indexed, so that queries do not have to read the reports of every run
+    """
+
+    def create(self):
+        """
+        Create the tables and indexes of the database
+        """
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS samples (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                runpath TEXT NOT NULL,
+                date TEXT,
+                analysisdate TEXT,
+                pipelineversion TEXT,
+                genus TEXT COLLATE NOCASE,
+                sequencetype TEXT,
+                rmlst TEXT,
+                serotype TEXT COLLATE NOCASE,
+                serovar TEXT COLLATE NOCASE,
+                closestrefseq TEXT,
+                n50 TEXT,
+                numcontigs TEXT,
+                genomelength TEXT,
+                metadata TEXT,
+                UNIQUE (name, runpath)
+            );
+            CREATE TABLE IF NOT EXISTS genes (
+                sample_id INTEGER NOT NULL REFERENCES samples(id) ON DELETE CASCADE,
+                analysis TEXT NOT NULL,
+                gene TEXT NOT NULL COLLATE NOCASE
+            );
+            CREATE INDEX IF NOT EXISTS samples_sequencetype ON samples (sequencetype);
+            CREATE INDEX IF NOT EXISTS samples_rmlst ON samples (rmlst);
+            CREATE INDEX IF NOT EXISTS samples_serotype ON samples (serotype);
+            CREATE INDEX IF NOT EXISTS samples_serovar ON samples (serovar);
+            CREATE INDEX IF NOT EXISTS samples_genus ON samples (genus);
+            CREATE INDEX IF NOT EXISTS samples_date ON samples (date);
+            CREATE INDEX IF NOT EXISTS genes_gene ON genes (gene);
+            CREATE INDEX IF NOT EXISTS genes_sample ON genes (sample_id);
+        ''')
+
+    def add_samples(self, samples, runpath, pipelineversion):
+        """
+        Add the results of the samples of a run to the database. The results of samples that were previously added
+        from the same run are replaced
+        :param samples: list of metadata objects
+        :param runpath: path of the run
+        :param pipelineversion: version of the pipeline
+        :return: number of samples added
+        """
+        analysisdate = datetime.now().strftime('%Y-%m-%d')
+        runpath = os.path.abspath(runpath)
+        with self.db:
+            for sample in samples:
+                self.db.execute('DELETE FROM samples WHERE name = ? AND runpath = ?', (sample.name, runpath))
+                # Use the sequencing date, or the date of the analysis if the sequencing date is not available
+                date = iso_date(attribute(sample, 'run', 'Date')) or analysisdate
+                genus = attribute(sample, 'general', 'referencegenus') or attribute(sample, 'sixteens_full', 'genus')
+                cursor = self.db.execute(
+                    'INSERT INTO samples (name, runpath, date, analysisdate, pipelineversion, genus, sequencetype, '
+                    'rmlst, serotype, serovar, closestrefseq, n50, numcontigs, genomelength, metadata) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (sample.name, runpath, date, analysisdate, pipelineversion, genus,
+                     attribute(sample, 'mlst', 'sequencetype'),
+                     attribute(sample, 'rmlst', 'sequencetype'),
+                     serotype(sample),
+                     attribute(sample, 'sistr', 'serovar'),
+                     attribute(sample, 'mash', 'closestrefseq'),
+                     attribute(sample, 'quality_features', 'n50'),
+                     attribute(sample, 'quality_features', 'num_contigs'),
+                     attribute(sample, 'quality_features', 'genome_length'),
+                     json.dumps(sample.dump(), sort_keys=True, default=str)))
+                self.db.executemany('INSERT INTO genes (sample_id, analysis, gene) VALUES (?, ?, ?)',
+                                    [(cursor.lastrowid, analysis, gene) for analysis, gene in sorted(genes(sample))])
+        return len(samples)
+
+    def query(self, sequencetype=None, rmlst=None, serotype=None, serovar=None, genus=None, genelist=None,
+              since=None, until=None, name=None):
+        """
+        Find the samples matching all the supplied criteria. Serotypes, serovars, genera, and genes are matched by
+        case-insensitive prefix e.g. the serotype O157 matches O157:H7, and the gene stx2 matches stx2a
+        :param sequencetype: MLST sequence type
+        :param rmlst: rMLST sequence type
+        :param serotype: E. coli serotype, or O-group
+        :param serovar: Salmonella serovar
+        :param genus: genus
+        :param genelist: list of genes that must all be present
+        :param since: earliest date (YYYY-MM-DD)
+        :param until: latest date (YYYY-MM-DD)
+        :param name: sample name
+        :return: list of dictionaries of the columns of the matching samples
+        """
+        conditions = list()
+        values = list()
+        for column, value in [('sequencetype', sequencetype), ('rmlst', rmlst), ('name', name)]:
+            if value:
+                conditions.append('{} = ?'.format(column))
+                values.append(str(value))
+        for column, value in [('serotype', serotype), ('serovar', serovar), ('genus', genus)]:
+            if value:
+                conditions.append('{} LIKE ?'.format(column))
+                values.append('{}%'.format(value))
+        if since:
+            conditions.append('date >= ?')
+            values.append(since)
+        if until:
+            conditions.append('date <= ?')
+            values.append(until)
+        for gene in genelist if genelist else list():
+            conditions.append('id IN (SELECT sample_id FROM genes WHERE gene LIKE ?)')
+            values.append('{}%'.format(gene))
+        statement = 'SELECT id, {columns} FROM samples{where} ORDER BY date, name'\
+            .format(columns=', '.join(COLUMNS),
+                    where=' WHERE ' + ' AND '.join(conditions) if conditions else str())
+        results = list()
+        for row in self.db.execute(statement, values).fetchall():
+            result = dict(zip(COLUMNS, row[1:]))
+            # Add the genes detected in the sample
+            genelist = self.db.execute('SELECT DISTINCT gene FROM genes WHERE sample_id = ? ORDER BY gene', (row[0],))
+            result['genes'] = ';'.join(gene[0] for gene in genelist)
+            results.append(result)
+        return results
+
+    def close(self):
+        """
+        Close the database
+        """
+        self.db.close()
+
+    def __init__(self, databasefile):
+        """
+        :param databasefile: name and path of the database. The database is created if it does not exist
+        """
+        self.databasefile = databasefile
+        directory = os.path.dirname(os.path.abspath(databasefile))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Several pipeline runs may add their results at the same time - wait for the other runs to finish writing
+        self.db = sqlite3.connect(databasefile, timeout=600)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.create()
+
+
+# If the script is called from the command line, then call the argument parser
+if __name__ == '__main__':
+    # Parser for arguments
+    parser = ArgumentParser(description='Query the typing results of all the samples added to a results database by '
+                                        'the pipeline. Results are printed in CSV format')
+    parser.add_argument('database',
+                        help='Path of the results database')
+    parser.add_argument('-st', '--sequencetype',
+                        help='MLST sequence type')
+    parser.add_argument('-rst', '--rmlst',
+                        help='rMLST sequence type')
+    parser.add_argument('-s', '--serotype',
+                        help='E. coli serotype or O-group e.g. O157 or O157:H7')
+    parser.add_argument('-sv', '--serovar',
+                        help='Salmonella serovar')
+    parser.add_argument('-g', '--genus',
+                        help='Genus')
+    parser.add_argument('-gn', '--gene',
+                        action='append',
+                        help='Gene that must be present e.g. stx2. Can be supplied more than once')
+    parser.add_argument('-n', '--name',
+                        help='Sample name')
+    parser.add_argument('--since',
+                        help='Earliest sequencing date (YYYY-MM-DD)')
+    parser.add_argument('--until',
+                        help='Latest sequencing date (YYYY-MM-DD)')
+    # Get the arguments into an object
+    arguments = parser.parse_args()
+    assert os.path.isfile(arguments.database), 'Cannot find results database {0!r:s}'.format(arguments.database)
+    store = ResultsStore(arguments.database)
+    matches = store.query(sequencetype=arguments.sequencetype,
+                          rmlst=arguments.rmlst,
+                          serotype=arguments.serotype,
+                          serovar=arguments.serovar,
+                          genus=arguments.genus,
+                          genelist=arguments.gene,
+                          since=arguments.since,
+                          until=arguments.until,
+                          name=arguments.name)
+    store.close()
+    writer = csv.DictWriter(sys.stdout, fieldnames=COLUMNS + ['genes'])
+    writer.writeheader()
+    writer.writerows(matches)
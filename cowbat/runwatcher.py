@@ -0,0 +1,215 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import filer, GenObject, MetadataObject, make_path, printtime
+from spadespipeline.basicAssembly import Basic
+from cowbat.samplerecord import compact
+import spadespipeline.fastqmover as fastqmover
+import spadespipeline.runMetadata as runMetadata
+from time import sleep, time
+from glob import glob
+import errno
+import os
+__author__ = 'adamkoziol'
+
+# Files written by the sequencer (MiSeq Reporter/bcl2fastq) once all the FASTQ files of a run have been created
+COMPLETION_FILES = ['GenerateFASTQRunStatistics.xml', 'CompletedJobInfo.xml']
+
+
+class RunWatcher(object):
+    """
+    Monitors a run folder while the sequencer is still writing it. Each sample is processed (read quality analyses and
+    assembly) as soon as all its FASTQ files are present, and have stopped changing. Run-level metadata are finalised
+    from RunInfo.xml and GenerateFASTQRunStatistics.xml once the run is complete
+    """
+
+    def main(self):
+        """
+        Watch the run folder until every sample has been processed, or the timeout is reached
+        """
+        printtime('Watching {} for sequencing data'.format(self.path), self.starttime)
+        self.expected_samples()
+        while True:
+            ready = self.ready_samples()
+            if ready:
+                self.process(ready)
+            if self.complete():
+                break
+            if time() - self.watchstart > self.timeout:
+                printtime('Timed out waiting for sequencing data. {num} samples were processed'
+                          .format(num=len(self.processed)), self.starttime)
+                break
+            sleep(self.pollinterval)
+        self.finalise()
+
+    def expected_samples(self):
+        """
+        Parse the sample sheet to determine the samples in the run. In basic assembly mode, samples are discovered
+        from the names of the FASTQ files as they appear
+        """
+        if not self.pipeline.basicassembly:
+            self.pipeline.runinfo = os.path.join(self.path, 'RunInfo.xml')
+            self.runmetadata = runMetadata.Metadata(self.pipeline)
+            # Store the metadata of the samples in compact records
+            self.runmetadata.samples = compact(self.runmetadata.samples)
+            self.pipeline.runmetadata = self.runmetadata
+            for sample in self.runmetadata.samples:
+                sample.commands = GenObject()
+                sample.commands.nohupcall = 'NA'
+                sample.commands.bclcall = 'NA'
+                self.expected[sample.name] = sample
+            self.sheetsamples = list(self.runmetadata.samples)
+        else:
+            self.runmetadata = MetadataObject()
+            self.runmetadata.samples = list()
+            self.pipeline.runmetadata = self.runmetadata
+
+    def sample_files(self):
+        """
+        Find the FASTQ files in the run folder, and record the time at which the size and modification time of each
+        file were first observed
+        :return: dictionary of sample name: list of FASTQ files
+        """
+        now = time()
+        samplefiles = dict()
+        for fastq in glob(os.path.join(self.path, '*.fastq*')):
+            try:
+                stats = os.stat(fastq)
+            except OSError:
+                continue
+            signature = (stats.st_size, stats.st_mtime)
+            if fastq not in self.filestates or self.filestates[fastq][0] != signature:
+                self.filestates[fastq] = (signature, now)
+            name = list(filer([os.path.basename(fastq)]))[0]
+            # Ignore reads that could not be assigned to a sample, and samples that are not in the sample sheet
+            if name.startswith('Undetermined') or (self.expected and name not in self.expected):
+                continue
+            samplefiles.setdefault(name, list()).append(fastq)
+        return samplefiles
+
+    def ready_samples(self):
+        """
+        Find the samples with complete sets of FASTQ files that have not changed for the stable time
+        :return: list of the names of the samples ready for processing
+        """
+        samplefiles = self.sample_files()
+        now = time()
+        ready = list()
+        for name, fastqfiles in sorted(samplefiles.items()):
+            if name in self.processed:
+                continue
+            # Wait for all the reads of the sample, and for the files to stop changing
+            if len(fastqfiles) < self.numreads:
+                continue
+            if all(now - self.filestates[fastq][1] >= self.stabletime and self.filestates[fastq][0][0] > 0
+                   for fastq in fastqfiles):
+                ready.append(name)
+        return ready
+
+    def process(self, names):
+        """
+        Create the metadata of the ready samples, and run the read processing and assembly stages on them
+        :param names: list of the names of the samples
+        """
+        printtime('Processing {num} newly completed samples: {names}'.format(num=len(names),
+                                                                             names=', '.join(names)), self.starttime)
+        if self.expected:
+            samples = [self.expected[name] for name in names]
+            # Link the FASTQ files of the samples to their folders
+            self.pipeline.runmetadata.samples = samples
+            try:
+                fastqmover.FastqMover(self.pipeline)
+            finally:
+                self.pipeline.runmetadata.samples = list(self.processed.values())
+        else:
+            samples = self.basic_samples(names)
+        for sample in samples:
+            self.processed[sample.name] = sample
+        self.pipeline.process_samples(samples)
+        self.pipeline.runmetadata.samples = list(self.processed.values())
+
+    def basic_samples(self, names):
+        """
+        Create the metadata of samples in the same way as the basic assembly of the pipeline
+        :param names: list of the names of the samples
+        :return: list of metadata objects
+        """
+        samples = list()
+        for name in names:
+            metadata = MetadataObject()
+            metadata.name = name
+            outputdir = os.path.join(self.path, name)
+            make_path(outputdir)
+            for fastq in glob(os.path.join(self.path, '{}*.fastq*'.format(name))):
+                try:
+                    os.symlink(os.path.join('..', os.path.basename(fastq)),
+                               os.path.join(outputdir, os.path.basename(fastq)))
+                except OSError as exception:
+                    if exception.errno != errno.EEXIST:
+                        raise
+            metadata.general = GenObject()
+            metadata.run = GenObject()
+            metadata.general.fastqfiles = [fastq for fastq in sorted(glob(os.path.join(outputdir,
+                                                                                       '{}*.fastq*'.format(name))))
+                                           if 'trimmed' not in fastq and 'normalised' not in fastq and
+                                           'corrected' not in fastq and 'paired' not in fastq and
+                                           'unpaired' not in fastq]
+            metadata.general.outputdirectory = outputdir
+            metadata.general.logout = os.path.join(outputdir, '{}_log_out.txt'.format(name))
+            metadata.general.logerr = os.path.join(outputdir, '{}_log_err.txt'.format(name))
+            samples.append(metadata)
+        # Determine the read lengths with the method used by the basic assembly
+        lengths = MetadataObject()
+        lengths.samples = samples
+        Basic.readlength(lengths)
+        return compact(samples)
+
+    def complete(self):
+        """
+        :return: boolean of whether all the samples of the run have been processed
+        """
+        if self.expected and all(name in self.processed for name in self.expected):
+            return True
+        # Otherwise, the run is complete once the sequencer has finished writing FASTQ files, and every sample with
+        # FASTQ files has been processed
+        finished = any(os.path.isfile(os.path.join(self.path, completion)) for completion in COMPLETION_FILES)
+        return finished and all(name in self.processed for name in self.sample_files())
+
+    def finalise(self):
+        """
+        Finalise the run metadata once the run is complete, and set the processed samples as the samples of the run
+        """
+        if self.expected:
+            # Wait for the run statistics, which are written after the FASTQ files
+            deadline = time() + self.stabletime
+            while not any(os.path.isfile(os.path.join(self.path, completion)) for completion in COMPLETION_FILES) \
+                    and time() < deadline:
+                sleep(self.pollinterval)
+            # The run statistics are matched to the samples by their position in the sample sheet
+            self.runmetadata.samples = self.sheetsamples
+            self.runmetadata.parseruninfo()
+            printtime('Finalised run metadata', self.starttime)
+            self.runmetadata.samples = [sample for sample in self.sheetsamples if sample.name in self.processed]
+        else:
+            self.runmetadata.samples = [sample for name, sample in sorted(self.processed.items())]
+        self.pipeline.runmetadata = self.runmetadata
+
+    def __init__(self, inputobject, pollinterval=30):
+        """
+        :param inputobject: RunSpades object
+        :param pollinterval: number of seconds between checks of the run folder
+        """
+        self.pipeline = inputobject
+        self.path = inputobject.path
+        self.starttime = inputobject.starttime
+        self.numreads = inputobject.numreads
+        self.stabletime = inputobject.stabletime
+        self.timeout = inputobject.watchtimeout
+        self.pollinterval = min(pollinterval, max(self.stabletime, 1))
+        self.watchstart = time()
+        self.runmetadata = MetadataObject()
+        # Dictionary of sample name: metadata object, and list of the samples in the order of the sample sheet
+        self.expected = dict()
+        self.sheetsamples = list()
+        # Dictionary of sample name: metadata object for samples that have been processed
+        self.processed = dict()
+        # Dictionary of FASTQ file: ((size, modification time), time first observed)
+        self.filestates = dict()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import GenObject, MetadataObject
+from collections.abc import MutableMapping
+import json
+__author__ = 'adamkoziol'
+
+# Sections that every sample has. They are stored in fixed slots of the SampleRecord, while the sections of the
+# analyses are created on first use
+FIELDS = ('name', 'general', 'run', 'commands')
+# Default value of SampleRecord.__setattr__, which creates an empty section
+EMPTY = object()
+
+
+class Section(object):
+    """
+    Slotted replacement for the GenObjects of a sample. The attributes are stored in the datastore dictionary, and
+    behave as they do on a GenObject, but the object itself does not carry an instance dictionary
+    """
+    __slots__ = ('datastore',)
+
+    def __getattr__(self, key):
+        # Special attributes are looked up by copy, pickle, and hasattr, and must not be treated as missing metadata
+        if key.startswith('__') and key.endswith('__'):
+            raise AttributeError(key)
+        return GenObject.__getattr__(self, key)
+
+    def __setattr__(self, key, value):
+        GenObject.__setattr__(self, key, value)
+
+    def __delattr__(self, key):
+        del self.datastore[key]
+
+    def returnattr(self, key):
+        return GenObject.returnattr(self, key)
+
+    def __reduce__(self):
+        return self.__class__, (self.datastore,)
+
+    def __init__(self, datastore=None):
+        """
+        :param datastore: optional dictionary of the attributes of the section
+        """
+        object.__setattr__(self, 'datastore', datastore if datastore else dict())
+
+
+class RecordStore(MutableMapping):
+    """
+    Dictionary view of the sections of a SampleRecord, for the code that reads and writes sample.datastore directly
+    e.g. the reporters of the external packages. Changes made through the view are made to the record
+    """
+    __slots__ = ('record',)
+
+    def __getitem__(self, key):
+        if key in FIELDS:
+            try:
+                return object.__getattribute__(self.record, key)
+            except AttributeError:
+                raise KeyError(key)
+        sections = object.__getattribute__(self.record, 'sections')
+        if sections is None:
+            raise KeyError(key)
+        return sections[key]
+
+    def __setitem__(self, key, value):
+        if key in FIELDS:
+            object.__setattr__(self.record, key, value)
+            return
+        # The dictionary of the analysis sections is only created once an analysis section is added
+        if object.__getattribute__(self.record, 'sections') is None:
+            object.__setattr__(self.record, 'sections', dict())
+        object.__getattribute__(self.record, 'sections')[key] = value
+
+    def __delitem__(self, key):
+        if key in FIELDS:
+            try:
+                object.__delattr__(self.record, key)
+            except AttributeError:
+                raise KeyError(key)
+            return
+        sections = object.__getattribute__(self.record, 'sections')
+        if sections is None:
+            raise KeyError(key)
+        del sections[key]
+
+    def __iter__(self):
+        for key in FIELDS:
+            try:
+                object.__getattribute__(self.record, key)
+            except AttributeError:
+                continue
+            yield key
+        sections = object.__getattribute__(self.record, 'sections')
+        if sections:
+            for key in list(sections):
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __init__(self, record):
+        """
+        :param record: SampleRecord
+        """
+        self.record = record
+
+
+class SampleRecord(object):
+    """
+    Compact, slotted metadata of a sample, which replaces the MetadataObject. The name and the general, run, and
+    commands sections of the sample are stored in fixed slots, and the sections of the analyses are created on first
+    use. GenObjects assigned to the record are stored as Sections. sample.datastore is a view of the sections, so the
+    record remains compatible with the code that uses the datastore of a MetadataObject
+    """
+    __slots__ = FIELDS + ('sections',)
+
+    @property
+    def datastore(self):
+        return RecordStore(self)
+
+    def __getattr__(self, key):
+        # Only called for missing attributes: fixed sections that have not been set, and the sections of the analyses
+        if key.startswith('__') and key.endswith('__'):
+            raise AttributeError(key)
+        store = RecordStore(self)
+        if key not in store:
+            store[key] = Section()
+        return store[key]
+
+    def __setattr__(self, key, value=EMPTY, **args):
+        store = RecordStore(self)
+        if args:
+            store[key].value = args
+        elif value is EMPTY:
+            store[key] = Section()
+        elif type(value) is GenObject:
+            # Share the dictionary of the GenObject, so that references to the GenObject remain valid
+            store[key] = Section(value.datastore)
+        else:
+            store[key] = value
+
+    def __delattr__(self, key):
+        del RecordStore(self)[key]
+
+    def __getitem__(self, item):
+        return RecordStore(self)[item]
+
+    def dump(self):
+        """
+        :return: dictionary of the metadata of the sample, as returned by MetadataObject.dump
+        """
+        return MetadataObject.dump(self)
+
+    def __reduce__(self):
+        return self.__class__, (dict(RecordStore(self)),)
+
+    def __init__(self, datastore=None):
+        """
+        :param datastore: optional dictionary of the sections of the sample
+        """
+        object.__setattr__(self, 'sections', None)
+        for key, value in (datastore if datastore else dict()).items():
+            self.__setattr__(key, value)
+
+
+def compact(samples):
+    """
+    Convert the metadata objects of samples to SampleRecords. The sections of the samples are not copied, so the
+    conversion is cheap, and metadata already assigned to the samples are retained
+    :param samples: list of metadata objects
+    :return: list of SampleRecords
+    """
+    records = list()
+    for sample in samples:
+        if isinstance(sample, SampleRecord):
+            records.append(sample)
+            continue
+        records.append(SampleRecord(sample.datastore))
+    return records
+
+
+def to_json(sample):
+    """
+    :param sample: metadata object
+    :return: the metadata of the sample in the format written by spadespipeline.metadataprinter
+    """
+    # Encoding the whole document in a single call is considerably faster than the incremental writes of json.dump
+    return json.dumps(sample.dump(), sort_keys=True, indent=4, separators=(',', ': '))
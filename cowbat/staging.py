@@ -0,0 +1,240 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import printtime, make_path
+from concurrent.futures import ThreadPoolExecutor, wait
+import hashlib
+import shutil
+import fcntl
+import json
+import os
+__author__ = 'adamkoziol'
+
+# Number of files copied concurrently to and from the scratch folder
+COPYTHREADS = 4
+# Name of the file in the run folder that records the samples staged to the scratch folder
+MANIFEST = 'staging.json'
+
+
+def sync(source, destination):
+    """
+    Make destination a copy of source. Only files that are missing from destination, or differ in size or modification
+    time, are copied, and files in destination that are not in source are removed. Symbolic links in source are
+    followed, while symbolic links in destination are neither replaced nor removed, so that links to the original
+    FASTQ files in the run folder are retained
+    :param source: path of the folder to copy
+    :param destination: path of the copy
+    :return: number of bytes copied
+    """
+    copied = 0
+    expected = set()
+    for root, dirs, files in os.walk(source):
+        target = os.path.normpath(os.path.join(destination, os.path.relpath(root, source)))
+        make_path(target)
+        for filename in files:
+            sourcefile = os.path.join(root, filename)
+            targetfile = os.path.join(target, filename)
+            expected.add(targetfile)
+            if os.path.islink(targetfile):
+                continue
+            try:
+                stats = os.stat(sourcefile)
+            except OSError:
+                # Broken symbolic link
+                continue
+            if os.path.isfile(targetfile):
+                targetstats = os.stat(targetfile)
+                if targetstats.st_size == stats.st_size and int(targetstats.st_mtime) == int(stats.st_mtime):
+                    continue
+            # Copy to a temporary file, and rename it, so that a partially-copied file is never used
+            temporary = targetfile + '.staging'
+            shutil.copy2(sourcefile, temporary)
+            os.replace(temporary, targetfile)
+            copied += stats.st_size
+    for root, dirs, files in os.walk(destination):
+        for filename in files:
+            filepath = os.path.join(root, filename)
+            if filepath not in expected and not os.path.islink(filepath):
+                os.remove(filepath)
+    return copied
+
+
+def relocate(values, previous, current):
+    """
+    Replace a folder with another in the paths of metadata
+    :param values: metadata value
+    :param previous: path of the previous folder
+    :param current: path of the current folder
+    :return: value with updated paths
+    """
+    if isinstance(values, str):
+        if values == previous or values.startswith(previous + os.sep):
+            return current + values[len(previous):]
+        return values
+    if isinstance(values, list):
+        return [relocate(value, previous, current) for value in values]
+    if isinstance(values, dict):
+        return {key: relocate(value, previous, current) for key, value in values.items()}
+    return values
+
+
+def relocate_sample(sample, previous, current):
+    """
+    Replace a folder with another in all the paths in the metadata of a sample
+    :param sample: metadata object
+    :param previous: path of the previous folder
+    :param current: path of the current folder
+    """
+    for section in sample.datastore.values():
+        try:
+            datastore = section.datastore
+        except AttributeError:
+            continue
+        for key, value in list(datastore.items()):
+            datastore[key] = relocate(value, previous, current)
+
+
+class Staging(object):
+    """
+    Processes samples on fast local scratch space rather than in the run folder. The folder of each sample, including
+    its FASTQ files, is copied to the scratch folder before its reads are processed, and the metadata of the sample
+    are updated to point to the copy. Once the sample has been analysed, its folder is copied back to the run folder,
+    and the scratch copy removed. Copies back start in the background as soon as groups of prioritised samples are
+    complete. The staged samples are recorded in staging.json in the run folder, so that the outputs of samples
+    staged by a run that did not finish are recovered by the next run
+    """
+
+    def stage(self, samples):
+        """
+        Copy the folders of samples that have not yet been staged to the scratch folder
+        :param samples: list of metadata objects
+        """
+        samples = [sample for sample in samples if sample.name not in self.staged]
+        if not samples:
+            return
+        printtime('Staging {num} samples to {path}'.format(num=len(samples),
+                                                            path=self.scratchpath), self.starttime)
+        # Record the samples before copying them, so that partial copies are removed after a crash
+        for sample in samples:
+            self.staged[sample.name] = {'rundirectory': sample.general.outputdirectory,
+                                        'scratchdirectory': os.path.join(self.scratchpath, sample.name),
+                                        'status': 'staging'}
+        self.write_manifest()
+        with ThreadPoolExecutor(max_workers=COPYTHREADS) as executor:
+            list(executor.map(lambda sample: sync(self.staged[sample.name]['rundirectory'],
+                                                  self.staged[sample.name]['scratchdirectory']), samples))
+        for sample in samples:
+            relocate_sample(sample, self.staged[sample.name]['rundirectory'],
+                            self.staged[sample.name]['scratchdirectory'])
+            self.staged[sample.name]['status'] = 'staged'
+        self.write_manifest()
+
+    def copy_back(self, samples):
+        """
+        Start copying the folders of samples back to the run folder in the background. The metadata of the samples
+        are not changed until the samples are unstaged
+        :param samples: list of metadata objects
+        """
+        for sample in samples:
+            if sample.name in self.staged:
+                self.pending.append(self.executor.submit(sync, self.staged[sample.name]['scratchdirectory'],
+                                                         self.staged[sample.name]['rundirectory']))
+
+    def unstage(self, samples):
+        """
+        Copy the folders of samples back to the run folder, update their metadata to point to the run folder, and
+        remove the scratch copies
+        :param samples: list of metadata objects
+        """
+        # Wait for the copies started in the background, which leave little to copy
+        wait(self.pending)
+        self.pending = list()
+        samples = [sample for sample in samples if sample.name in self.staged]
+        if not samples:
+            return
+        printtime('Copying {} samples back to the run folder'.format(len(samples)), self.starttime)
+        with ThreadPoolExecutor(max_workers=COPYTHREADS) as executor:
+            list(executor.map(lambda sample: sync(self.staged[sample.name]['scratchdirectory'],
+                                                  self.staged[sample.name]['rundirectory']), samples))
+        for sample in samples:
+            entry = self.staged.pop(sample.name)
+            relocate_sample(sample, entry['scratchdirectory'], entry['rundirectory'])
+            shutil.rmtree(entry['scratchdirectory'], ignore_errors=True)
+        self.write_manifest()
+
+    def recover(self):
+        """
+        Copy the outputs of samples staged by a previous run that did not finish back to the run folder, so that they
+        can be used by this run, and remove their scratch copies
+        """
+        manifestfile = os.path.join(self.path, MANIFEST)
+        if not os.path.isfile(manifestfile):
+            return
+        try:
+            with open(manifestfile, 'r') as manifest:
+                staged = json.load(manifest)['samples']
+        except (IOError, ValueError, KeyError):
+            staged = dict()
+        for name, entry in sorted(staged.items()):
+            if not os.path.isdir(entry['scratchdirectory']):
+                continue
+            # Samples that were only partially copied to the scratch folder are unchanged in the run folder
+            if entry['status'] == 'staged':
+                printtime('Recovering the staged outputs of {}'.format(name), self.starttime)
+                sync(entry['scratchdirectory'], entry['rundirectory'])
+            shutil.rmtree(entry['scratchdirectory'], ignore_errors=True)
+        os.remove(manifestfile)
+
+    def write_manifest(self):
+        """
+        Record the staged samples in the run folder. The manifest is removed once no samples are staged
+        """
+        manifestfile = os.path.join(self.path, MANIFEST)
+        if not self.staged:
+            if os.path.isfile(manifestfile):
+                os.remove(manifestfile)
+            # Remove the scratch folder of the run if it is empty
+            try:
+                os.rmdir(self.scratchpath)
+            except OSError:
+                pass
+            return
+        with open(manifestfile + '.tmp', 'w') as manifest:
+            json.dump({'scratchpath': self.scratchpath,
+                       'samples': self.staged}, manifest, sort_keys=True, indent=4)
+        os.replace(manifestfile + '.tmp', manifestfile)
+
+    def stage_databases(self, reffilepath):
+        """
+        Copy the databases to the scratch folder. The copy is shared by all the runs using the same scratch folder and
+        databases, and only changed files are copied by subsequent runs
+        :param reffilepath: path of the databases
+        :return: path of the copy of the databases
+        """
+        reffilepath = os.path.abspath(reffilepath)
+        destination = os.path.join(self.stagingpath, 'databases',
+                                   hashlib.sha1(reffilepath.encode('utf-8')).hexdigest()[:12])
+        make_path(destination)
+        printtime('Staging the databases to {}'.format(destination), self.starttime)
+        # Prevent concurrent runs from updating the copy at the same time
+        with open(destination + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            copied = sync(reffilepath, destination)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        printtime('Copied {:.2f} GB of databases'.format(copied / 1024 ** 3), self.starttime)
+        return destination
+
+    def __init__(self, inputobject, stagingpath):
+        """
+        :param inputobject: RunSpades object
+        :param stagingpath: path of the local scratch folder
+        """
+        self.path = inputobject.path
+        self.starttime = inputobject.starttime
+        self.stagingpath = os.path.abspath(stagingpath)
+        # Each run has its own folder in the scratch folder
+        self.scratchpath = os.path.join(self.stagingpath, 'run-{}'.format(
+            hashlib.sha1(os.path.abspath(self.path).encode('utf-8')).hexdigest()[:12]))
+        # Dictionary of sample name: run folder, scratch folder, and staging status of the sample
+        self.staged = dict()
+        self.executor = ThreadPoolExecutor(max_workers=COPYTHREADS)
+        self.pending = list()
+        self.recover()
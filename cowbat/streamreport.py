@@ -0,0 +1,257 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import printtime, make_path, MetadataObject
+from spadespipeline.reporter import Reporter
+import sqlite3
+import json
+import os
+__author__ = 'adamkoziol'
+
+# Reports created by spadespipeline.reporter with a header line followed by one row per sample
+CSVREPORTS = ['combinedMetadata.csv', 'legacy_combinedMetadata.csv']
+# Database of all the metadata created by spadespipeline.reporter
+DATABASE = 'metadatabase.sqlite'
+# Delimiters of the stage reports that can be divided by sample. JSON reports are divided if they are dictionaries of
+# sample name: results
+DELIMITERS = {'.csv': ',', '.tsv': '\t'}
+
+
+def merge_csv(rowfiles, output):
+    """
+    Merge per-sample reports into a single report. The files are read one line at a time, so only a single row is held
+    in memory regardless of the number of samples
+    :param rowfiles: list of the names and paths of the per-sample reports
+    :param output: name and path of the merged report
+    :return: number of rows written
+    """
+    header = None
+    rows = 0
+    with open(output, 'w') as merged:
+        for rowfile in rowfiles:
+            with open(rowfile, 'r') as report:
+                for number, line in enumerate(report):
+                    # Only the header of the first report is written
+                    if number == 0:
+                        if header is None:
+                            header = line.rstrip('\n')
+                            merged.write(header + '\n')
+                        continue
+                    line = line.rstrip('\n')
+                    if line:
+                        merged.write(line + '\n')
+                        rows += 1
+    return rows
+
+
+def report_blocks(reportfile, names):
+    """
+    Divide a stage report into the blocks of rows of each sample, so that the report can be recreated for any set of
+    samples. A row that starts with the name of a sample starts its block, and the following rows with an empty first
+    column (e.g. the additional sequence types of a sample) belong to the same block. The remaining rows are headers,
+    and belong to the blocks of the samples that follow them: the MLST reports repeat the header before each sample,
+    while most reports have a single header
+    :param reportfile: name and path of the report
+    :param names: set of the names of the samples in the report
+    :return: dictionary of sample name: block of the sample, or None if the report cannot be divided e.g. Excel
+    reports, or reports with rows that do not belong to a sample. Samples without rows have empty blocks
+    """
+    extension = os.path.splitext(reportfile)[1]
+    if extension == '.json':
+        try:
+            with open(reportfile, 'r') as report:
+                results = json.load(report)
+        except (IOError, ValueError):
+            return None
+        if not isinstance(results, dict) or not set(results).issubset(names):
+            return None
+        return {name: {'results': {name: results[name]} if name in results else dict()} for name in names}
+    if extension not in DELIMITERS:
+        return None
+    blocks = dict()
+    # The most recent header, and the header rows that have not yet been followed by a sample
+    header = list()
+    pending = list()
+    headers = 0
+    current = None
+    with open(reportfile, 'r') as report:
+        for line in report:
+            name = line.split(DELIMITERS[extension], 1)[0].strip().strip('"')
+            if name in names:
+                if pending:
+                    header = pending
+                    pending = list()
+                    headers += 1
+                current = name
+                blocks.setdefault(name, {'header': header, 'rows': list()})['rows'].append(line)
+            elif not name and current is not None and not pending:
+                blocks[current]['rows'].append(line)
+            else:
+                pending.append(line)
+    if not blocks:
+        # A report without samples may only consist of its header
+        if len(pending) > 1:
+            return None
+        header = pending
+    elif pending:
+        # Rows following the last sample that do not belong to it
+        return None
+    for name in names:
+        blocks.setdefault(name, {'header': header, 'rows': list()})['repeated'] = headers > 1
+    return blocks
+
+
+def write_report(blocks, output):
+    """
+    Write a stage report from the blocks of its samples
+    :param blocks: list of the blocks of the samples created by report_blocks, in the order of the samples
+    :param output: name and path of the report
+    """
+    if output.endswith('.json'):
+        results = dict()
+        for block in blocks:
+            results.update(block['results'])
+        with open(output, 'w') as report:
+            report.write(json.dumps(results, sort_keys=True, indent=4, separators=(',', ': ')))
+        return
+    # The header is written before every sample if the reports repeat it, and otherwise whenever it changes
+    repeated = any(block['repeated'] for block in blocks)
+    written = None
+    with open(output, 'w') as report:
+        for block in blocks:
+            if not block['rows']:
+                continue
+            if repeated or block['header'] != written:
+                report.writelines(block['header'])
+                written = block['header']
+            report.writelines(block['rows'])
+        if written is None and blocks:
+            report.writelines(blocks[0]['header'])
+
+
+def divide_reports(reportpath, names, reports=None):
+    """
+    Divide the stage reports in a folder by sample
+    :param reportpath: path of the reports
+    :param names: set of the names of the samples in the reports
+    :param reports: list of the names of the reports to divide. Default is every file in the folder
+    :return: dictionary of report name: dictionary of sample name: block, or None if the report cannot be divided
+    """
+    if reports is None:
+        reports = [filename for filename in os.listdir(reportpath)
+                   if os.path.isfile(os.path.join(reportpath, filename))] if os.path.isdir(reportpath) else list()
+    return {filename: report_blocks(os.path.join(reportpath, filename), names) for filename in reports}
+
+
+def merge_reports(reportpaths, groups, names, reportpath):
+    """
+    Merge the stage reports of groups of samples that were analysed separately e.g. the priority groups of a run
+    :param reportpaths: list of the report folders of the groups
+    :param groups: list of the sets of the names of the samples of each group
+    :param names: list of the names of all the samples, in the order in which they are written to the reports
+    :param reportpath: folder in which to write the merged reports
+    :return: sorted list of the names of the reports that cannot be divided by sample, which are not merged
+    """
+    divided = [divide_reports(path, group) for path, group in zip(reportpaths, groups)]
+    unmerged = list()
+    make_path(reportpath)
+    for filename in sorted(set(filename for reports in divided for filename in reports)):
+        if any(reports.get(filename, dict()) is None for reports in divided):
+            unmerged.append(filename)
+            continue
+        blocks = dict()
+        for reports in divided:
+            blocks.update(reports.get(filename, dict()))
+        write_report([blocks[name] for name in names if name in blocks], os.path.join(reportpath, filename))
+    return unmerged
+
+
+def merge_databases(databases, output):
+    """
+    Merge per-sample metadata databases into a single database. The tables of each database are copied by SQLite, and
+    columns are added to the merged tables as they are encountered
+    :param databases: list of the names and paths of the per-sample databases
+    :param output: name and path of the merged database
+    """
+    if os.path.isfile(output):
+        os.remove(output)
+    db = sqlite3.connect(output)
+    db.execute('CREATE TABLE Samples (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE, name TEXT UNIQUE)')
+    # Dictionary of table name: list of columns of the merged tables
+    columns = dict()
+    for database in databases:
+        db.execute('ATTACH DATABASE ? AS sample', (database,))
+        for name, in db.execute('SELECT name FROM sample.Samples').fetchall():
+            cursor = db.execute('INSERT OR IGNORE INTO Samples (name) VALUES (?)', (name,))
+            sampleid = cursor.lastrowid if cursor.rowcount else \
+                db.execute('SELECT id FROM Samples WHERE name = ?', (name,)).fetchone()[0]
+            tables = [table for table, in db.execute("SELECT name FROM sample.sqlite_master WHERE type = 'table' AND "
+                                                     "name NOT IN ('Samples', 'sqlite_sequence')").fetchall()]
+            for table in tables:
+                tablecolumns = [row[1] for row in db.execute('PRAGMA sample.table_info({})'.format(table))
+                                if row[1] != 'sample_id']
+                if table not in columns:
+                    db.execute('CREATE TABLE {} (sample_id INTEGER, FOREIGN KEY(sample_id) REFERENCES Samples(id))'
+                               .format(table))
+                    columns[table] = list()
+                for column in tablecolumns:
+                    if column not in columns[table]:
+                        db.execute('ALTER TABLE {} ADD COLUMN {} TEXT'.format(table, column))
+                        columns[table].append(column)
+                db.execute('INSERT INTO main.{table} (sample_id{columns}) SELECT ?{columns} FROM sample.{table}'
+                           .format(table=table,
+                                   columns=''.join(', {}'.format(column) for column in tablecolumns)), (sampleid,))
+        db.commit()
+        db.execute('DETACH DATABASE sample')
+    db.close()
+
+
+class StreamingReporter(object):
+    """
+    Creates the run reports incrementally. The report rows of each sample are written to reports/samples/<sample name>
+    as soon as the analyses of the sample are complete, and the run reports are assembled by merging these rows in a
+    single streaming pass, so that the memory required does not grow with the size of the run
+    """
+
+    def main(self):
+        """
+        Merge the per-sample rows of the samples in the run into the run reports
+        """
+        printtime('Creating summary reports', self.starttime)
+        samplepaths = list()
+        for sample in self.metadata:
+            samplepath = os.path.join(self.samplepath, sample.name)
+            if all(os.path.isfile(os.path.join(samplepath, report)) for report in CSVREPORTS + [DATABASE]):
+                samplepaths.append(samplepath)
+            else:
+                printtime('Could not find the report rows of {}'.format(sample.name), self.starttime)
+        make_path(self.reportpath)
+        for report in CSVREPORTS:
+            merge_csv([os.path.join(samplepath, report) for samplepath in samplepaths],
+                      os.path.join(self.reportpath, report))
+        merge_databases([os.path.join(samplepath, DATABASE) for samplepath in samplepaths],
+                        os.path.join(self.reportpath, DATABASE))
+
+    def add_samples(self, samples):
+        """
+        Write the report rows of samples whose analyses are complete
+        :param samples: list of metadata objects
+        """
+        for sample in samples:
+            report = MetadataObject()
+            report.runmetadata = MetadataObject()
+            report.runmetadata.samples = [sample]
+            report.commit = self.commit
+            report.starttime = self.starttime
+            report.reportpath = os.path.join(self.samplepath, sample.name)
+            make_path(report.reportpath)
+            # Reports of a single sample have the same format as the run reports, with only one row
+            Reporter(report)
+
+    def __init__(self, inputobject):
+        """
+        :param inputobject: RunSpades object
+        """
+        self.metadata = inputobject.runmetadata.samples
+        self.commit = inputobject.commit
+        self.starttime = inputobject.starttime
+        self.reportpath = inputobject.reportpath
+        self.samplepath = os.path.join(self.reportpath, 'samples')
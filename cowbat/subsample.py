@@ -0,0 +1,134 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import printtime, make_path, write_to_logfile, GenObject
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import CalledProcessError
+from biotools import bbtools, mash
+import re
+import os
+__author__ = 'adamkoziol'
+
+# Samples are only subsampled if their estimated depth exceeds the target depth by more than this factor
+TOLERANCE = 1.2
+
+
+def parse_estimates(err):
+    """
+    Extract the genome size and coverage estimated by mash sketch -r from its standard error
+    :param err: standard error of mash sketch
+    :return: estimated genome size, estimated coverage. Either value is 0 if it could not be found
+    """
+    estimates = list()
+    for pattern in [r'Estimated genome size:\s*([0-9.eE+]+)', r'Estimated coverage:\s*([0-9.eE+]+)']:
+        match = re.search(pattern, err)
+        estimates.append(float(match.group(1)) if match else 0)
+    return estimates[0], estimates[1]
+
+
+def subsample_outputs(sample):
+    """
+    Paths of the subsampled reads of a sample. The reads are written to the subsample folder, as FastqMover treats
+    every FASTQ file named after the sample in the sample folder as raw reads
+    :param sample: metadata object
+    :return: list of the paths of the subsampled forward and (if the sample is paired) reverse reads
+    """
+    return [os.path.join(sample.subsample.outputdir, '{name}_subsampled_R{read}.fastq.gz'.format(name=sample.name,
+                                                                                                 read=index + 1))
+            for index in range(len(sample.general.fastqfiles))]
+
+
+class Subsample(object):
+    """
+    Estimates the genome size and sequencing depth of each sample from a k-mer sketch of its reads, and subsamples
+    the reads of samples sequenced well beyond the target depth before they are trimmed, corrected, and assembled
+    """
+
+    def main(self):
+        """
+        Estimate the depth of the samples, and subsample the reads of deep samples
+        """
+        samples = [sample for sample in self.metadata if type(sample.general.fastqfiles) is list]
+        if not samples:
+            return
+        printtime('Estimating sequencing depth', self.starttime)
+        workers = min(len(samples), self.cpus)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(self.estimate, samples))
+        deep = [sample for sample in samples if sample.subsample.subsampled]
+        if deep:
+            printtime('Subsampling {num} samples to a depth of {depth}X'.format(num=len(deep),
+                                                                               depth=self.targetdepth),
+                      self.starttime)
+            with ThreadPoolExecutor(max_workers=min(len(deep), self.cpus)) as executor:
+                list(executor.map(self.subsample, deep))
+
+    def estimate(self, sample):
+        """
+        Sketch the forward reads of a sample with mash, which estimates the genome size and coverage from the k-mer
+        counts of the reads
+        :param sample: metadata object
+        """
+        sample.subsample = GenObject()
+        sample.subsample.targetdepth = self.targetdepth
+        sample.subsample.outputdir = os.path.join(sample.general.outputdirectory, 'subsample')
+        make_path(sample.subsample.outputdir)
+        sample.subsample.subsampled = False
+        try:
+            # Only k-mers seen at least twice are counted, which excludes most k-mers containing sequencing errors
+            out, err, cmd = mash.sketch(sorted(sample.general.fastqfiles)[0],
+                                        output_sketch=os.path.join(sample.subsample.outputdir, sample.name),
+                                        threads=self.threads,
+                                        returncmd=True,
+                                        r='',
+                                        m=2)
+            write_to_logfile(out, err, self.logfile, sample.general.logout, sample.general.logerr, None, None)
+            sample.subsample.sketchcmd = cmd
+        except CalledProcessError:
+            err = str()
+        genomesize, coverage = parse_estimates(err)
+        sample.subsample.genomesize = int(genomesize)
+        # The coverage is estimated from the forward reads; paired reverse reads contribute the same depth
+        sample.subsample.depth = round(coverage * len(sample.general.fastqfiles), 2)
+        sample.subsample.subsampled = bool(genomesize) and sample.subsample.depth > self.targetdepth * TOLERANCE
+
+    def subsample(self, sample):
+        """
+        Subsample the reads of a sample to the number of bases required to reach the target depth. The subsampled
+        reads replace the original reads in the metadata of the sample, and are used by all the subsequent stages
+        :param sample: metadata object
+        """
+        fastqfiles = sorted(sample.general.fastqfiles)
+        outputs = subsample_outputs(sample)
+        try:
+            # A fixed seed ensures that repeated analyses of a sample use the same reads
+            out, err, cmd = bbtools.subsample_reads(forward_in=fastqfiles[0],
+                                                    forward_out=outputs[0],
+                                                    num_bases=sample.subsample.genomesize * self.targetdepth,
+                                                    returncmd=True,
+                                                    reverse_in=fastqfiles[1] if len(fastqfiles) == 2 else 'NA',
+                                                    reverse_out=outputs[1] if len(fastqfiles) == 2 else 'NA',
+                                                    sampleseed=1,
+                                                    threads=self.threads)
+            write_to_logfile(out, err, self.logfile, sample.general.logout, sample.general.logerr, None, None)
+            sample.subsample.subsamplecmd = cmd
+        except CalledProcessError:
+            sample.subsample.subsampled = False
+            return
+        if all(os.path.isfile(fastq) for fastq in outputs):
+            # Keep a record of the original reads, which are used to determine whether pre-processed reads can be
+            # used by subsequent runs
+            sample.general.rawfastqfiles = sample.general.fastqfiles
+            sample.general.fastqfiles = outputs
+        else:
+            sample.subsample.subsampled = False
+
+    def __init__(self, inputobject):
+        """
+        :param inputobject: RunSpades object
+        """
+        self.metadata = inputobject.runmetadata.samples
+        self.starttime = inputobject.starttime
+        self.cpus = int(inputobject.cpus)
+        self.logfile = inputobject.logfile
+        self.targetdepth = inputobject.targetdepth
+        # Divide the threads between the samples
+        self.threads = max(int(self.cpus / len(self.metadata)), 1) if self.metadata else 1
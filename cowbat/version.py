@@ -0,0 +1,6 @@
+#!/usr/bin/env python 3
+__author__ = 'adamkoziol'
+
+# Version of the pipeline. This is also the version of the package in setup.py, so that it is available without
+# inspecting package metadata or the git history of the repository
+__version__ = '0.2.0'
@@ -1,17 +1,37 @@
 #!/usr/bin/env python 3
-from accessoryFunctions.accessoryFunctions import clear_logfile, combinetargets, MetadataObject, make_path, printtime, \
-    run_subprocess, write_to_logfile
-import get.get_rmlst as get_rmlst
-import get.get_mlst as get_mlst
+from cowbat.lazyimport import LazyCallable, LazyModule
 from argparse import ArgumentParser
 from time import time
-from glob import glob
+from glob import glob, escape as glob_escape
 import fileinput
 import tarfile
 import shutil
+import json
 import os
+
+# Modules are only imported when the databases that use them are set up, so that validating the arguments is fast
+MetadataObject = LazyCallable('accessoryFunctions.accessoryFunctions', 'MetadataObject')
+printtime = LazyCallable('accessoryFunctions.accessoryFunctions', 'printtime')
+make_path = LazyCallable('accessoryFunctions.accessoryFunctions', 'make_path')
+combinetargets = LazyCallable('accessoryFunctions.accessoryFunctions', 'combinetargets')
+CommandRunner = LazyCallable('cowbat.commandrunner', 'CommandRunner')
+tail = LazyCallable('cowbat.commandrunner', 'tail')
+GitMirror = LazyCallable('cowbat.gitmirror', 'GitMirror')
+create_refseq_index = LazyCallable('cowbat.refseqindex', 'create_refseq_index')
+create_allele_index = LazyCallable('cowbat.alleleindex', 'create_allele_index')
+create_profile_index = LazyCallable('cowbat.profileindex', 'create_profile_index')
+get_rmlst = LazyModule('get.get_rmlst')
+get_mlst = LazyModule('get.get_mlst')
 __author__ = 'adamkoziol'
 
+# Number of bytes to keep from the start and end of the output of each download and set-up call
+LOGLIMIT = 10 * 1024 * 1024
+# Default urls of the git repositories of the OLC and CGE databases. {db} is replaced with the name of the CGE database
+OLCURL = 'https://github.com/OLC-Bioinformatics/Databases.git'
+CGEURL = 'https://bitbucket.org/genomicepidemiology/{db}.git'
+# Extensions of the FASTA files of the databases
+FASTAEXTENSIONS = {'.fasta', '.fa', '.fsa', '.tfa'}
+
 
 class DatabaseSetup(object):
 
@@ -35,14 +55,18 @@ class DatabaseSetup(object):
     def olc_databases(self):
         """
         Clone the OLC-specific databases from github. This method must be performed first, as the call will only clone
-        the repository into an empty folder
+        the repository into an empty folder. When refreshing from mirrors, only the archives that changed since the
+        previous refresh are copied and extracted
         """
         printtime('Downloading OLC databases', self.start)
-        # Set the git clone system call
-        targetcall = 'git clone https://github.com/OLC-Bioinformatics/Databases.git {dbpath}'\
-            .format(dbpath=self.databasepath)
-        # Download the databases
-        self.database_download(targetcall, self.databasepath)
+        if self.mirror:
+            self.mirror.sync(self.olcurl, 'Databases', self.databasepath)
+        else:
+            # Set the git clone system call
+            targetcall = 'git clone {url} {dbpath}'.format(url=self.olcurl,
+                                                           dbpath=self.databasepath)
+            # Download the databases
+            self.database_download(targetcall, self.databasepath)
         # Extract the databases from the archives
         printtime('Extracting databases from archives', self.start)
         for gz in glob(os.path.join(self.databasepath, '*.gz')):
@@ -75,6 +99,7 @@ class DatabaseSetup(object):
         Download and set-up the CLARK database using the set_targets.sh script. Use defaults of bacteria for database
         type, and species for taxonomic level
         """
+        assert self.clarkpath, 'Could not find CLARK. Please ensure that CLARK is installed, and in the $PATH'
         # Create the folder in which the database is to be stored
         databasepath = self.create_database_folder('clark')
         # Set the call to create the database
@@ -86,7 +111,8 @@ class DatabaseSetup(object):
 
     def mash(self):
         """
-        Download the pre-computed sketch of the RefSeq database, and compress it with gzip
+        Download the pre-computed sketch of the RefSeq database, and compress it with gzip. Index the assembly summary
+        to allow for rapid lookups of the closest RefSeq genomes
         """
         # Create the folder in which the database is to be stored
         databasepath = self.create_database_folder('mash')
@@ -99,6 +125,11 @@ class DatabaseSetup(object):
             .format(os.path.join(databasepath, 'RefSeqSketchesDefaults.msh'))
         # Download the database
         self.database_download(targetcall, databasepath)
+        # Create the index of accession: organism name from the assembly summary
+        summaryfile = os.path.join(databasepath, 'assembly_summary_refseq.txt')
+        if os.path.isfile(summaryfile):
+            printtime('Indexing RefSeq assembly summary', self.start)
+            create_refseq_index(summaryfile)
 
     def rmlst(self):
         """
@@ -119,6 +150,8 @@ class DatabaseSetup(object):
             # Create and populate the complete.txt file
             with open(completefile, 'w') as complete:
                 complete.write('\n'.join(glob(os.path.join(self.databasepath, 'rMLST', '*'))))
+        # Index the alleles and profiles for exact matching of assemblies
+        self.scheme_indexes(os.path.join(self.databasepath, 'rMLST'))
 
     def mlst(self, genera={'Escherichia', 'Vibrio', 'Campylobacter', 'Listeria', 'Bacillus', 'Staphylococcus',
                            'Salmonella'}):
@@ -143,6 +176,25 @@ class DatabaseSetup(object):
                 # Create and populate the complete.txt file
                 with open(completefile, 'w') as complete:
                     complete.write('\n'.join(glob(os.path.join(args.path, '*'))))
+            # Index the alleles and profiles for exact matching of assemblies
+            self.scheme_indexes(args.path)
+
+    def scheme_indexes(self, targetpath):
+        """
+        Create the index of the alleles of a typing scheme used to type assemblies with exact allele matches, and
+        compile the profile table of the scheme into a sorted, memory-mappable index
+        :param targetpath: folder containing the alleles and profile of the scheme
+        """
+        if not os.path.isdir(targetpath):
+            return
+        printtime('Indexing alleles in {}'.format(targetpath), self.start)
+        # The allele index is only rebuilt if the allele files have changed
+        create_allele_index(targetpath, os.path.join(targetpath, 'alleles.sqlite'))
+        profiles = glob(os.path.join(targetpath, '*.txt'))
+        if profiles:
+            printtime('Indexing profiles in {}'.format(targetpath), self.start)
+            # The profile index is only rebuilt if the profile table has changed
+            create_profile_index(profiles[0])
 
     def cge_db_downloader(self, analysistype, dbname, extension_in, extension_out):
         """
@@ -157,11 +209,20 @@ class DatabaseSetup(object):
             databasepath = os.path.join(self.databasepath, analysistype, 'Escherichia')
         else:
             databasepath = os.path.join(self.databasepath, analysistype)
-        targetcall = 'git clone https://bitbucket.org/genomicepidemiology/{db}.git {atype}'\
-            .format(db=dbname,
-                    atype=databasepath)
-        # Download the database
-        self.database_download(targetcall, databasepath)
+        url = self.cgeurl.format(db=dbname)
+        if self.mirror:
+            # Only copy the files that changed since the previous refresh. The files are renamed as they are copied
+            changed, removed = self.mirror.sync(url, dbname, databasepath,
+                                                {'.' + extension_in: '.' + extension_out})
+            fastafiles = [fasta for fasta in changed + removed if fasta.endswith('.' + extension_out)]
+            if fastafiles:
+                # Remove the combined targets, and the indexes of the changed files, so that they are rebuilt
+                self.clear_indexes(databasepath, fastafiles)
+        else:
+            targetcall = 'git clone {url} {atype}'.format(url=url,
+                                                          atype=databasepath)
+            # Download the database
+            self.database_download(targetcall, databasepath)
         # Create a variable to use in creating the combined targets file
         extension = extension_in
         # If the extension_out is different than extension_in, rename the files to have the appropriate extension
@@ -183,6 +244,26 @@ class DatabaseSetup(object):
             databasefiles = glob(os.path.join(databasepath, '*.{ext}'.format(ext=extension)))
             combinetargets(databasefiles, databasepath)
 
+    @staticmethod
+    def clear_indexes(databasepath, fastafiles):
+        """
+        Remove the combined targets of a database, and the indexes (e.g. BLAST or bowtie2 indexes) created from the
+        combined targets and from changed FASTA files, so that they are rebuilt with the updated sequences
+        :param databasepath: path of the database folder
+        :param fastafiles: list of the paths of the changed FASTA files
+        """
+        combinedtargets = os.path.join(databasepath, 'combinedtargets.fasta')
+        for fasta in fastafiles + [combinedtargets]:
+            # Indexes are named after either the file (e.g. gene.tfa.fai), or the file without its extension
+            # (e.g. gene.nhr)
+            indexes = glob(glob_escape(fasta) + '.*') + glob(glob_escape(os.path.splitext(fasta)[0]) + '.*')
+            for indexfile in set(indexes):
+                # Do not remove other FASTA files with names starting with the same name e.g. gene.1.tfa
+                if os.path.splitext(indexfile)[1] not in FASTAEXTENSIONS:
+                    os.remove(indexfile)
+        if os.path.isfile(combinedtargets):
+            os.remove(combinedtargets)
+
     def notes(self):
         """
         Clean the notes.txt file that comes with the resfinder database; it contains certain definitions with commas.
@@ -224,37 +305,48 @@ class DatabaseSetup(object):
         make_path(databasepath)
         return databasepath
 
-    def database_download(self, targetcall, databasepath, complete=True):
+    def database_download(self, targetcall, databasepath, complete=True, timeout=None):
         """
-        Checks to see if the database has already been downloaded. If not, downloads the database, and writes stdout
-        and stderr to the logfile
+        Checks to see if the database has already been downloaded. If not, downloads the database. The stdout and
+        stderr of the call are streamed to log files in the <databasepath>_logs folder
         :param targetcall: system call to download, and possibly set-up the database
         :param databasepath: absolute path of the database
         :param complete: boolean variable to determine whether the complete file should be created
+        :param timeout: maximum number of seconds the call may run. Default is the timeout supplied to the script
         """
         # Create a file to store the logs; it will be used to determine if the database was downloaded and set-up
         completefile = os.path.join(databasepath, 'complete')
         # Run the system call if the database is not already downloaded
         if not os.path.isfile(completefile):
-            out, err = run_subprocess(targetcall)
-            print(out, err)
-            # Write the out and err streams to the master files
-            write_to_logfile(out, err, self.logfile, None, None, None, None)
-            if complete:
-                # Create the database completeness assessment file and populate it with the out and err streams
-                with open(completefile, 'w') as complete:
-                    complete.write(out)
-                    complete.write(err)
+            result = self.runner.run(targetcall, os.path.basename(os.path.normpath(databasepath)), timeout)
+            if result['returncode'] != 0:
+                # Do not mark failed downloads as complete, so that they are attempted again by the next set-up
+                printtime('{call} {status}:\n{err}'
+                          .format(call=targetcall,
+                                  status='timed out' if result['timedout'] else
+                                  'failed with exit status {}'.format(result['returncode']),
+                                  err=tail(result['stderr'])), self.start)
+            elif complete:
+                # Create the database completeness assessment file and populate it with the summary of the call
+                with open(completefile, 'w') as completed:
+                    completed.write(json.dumps(result, indent=4, sort_keys=True))
 
     def __init__(self, args):
         self.databasepath = os.path.join(args.databasepath)
         make_path(self.databasepath)
         self.start = args.start
         # Determine the location of the CLARK scripts
-        self.clarkpath = os.path.dirname(shutil.which('CLARK'))
-        self.logfile = os.path.join(self.databasepath, 'logfile')
-        # Delete log files form previous iterations of the script in this folder
-        clear_logfile(self.logfile)
+        clark = shutil.which('CLARK')
+        self.clarkpath = os.path.dirname(clark) if clark else None
+        # Stream the output of the download and set-up calls to log files, as the output of tools such as
+        # set_targets.sh is too large to hold in memory. The logs are kept beside the database path rather than in it,
+        # as the OLC databases can only be cloned into an empty folder
+        self.runner = CommandRunner(os.path.normpath(self.databasepath) + '_logs', args.timeout, LOGLIMIT)
+        self.olcurl = args.olcurl
+        self.cgeurl = args.cgeurl
+        # Refresh the git databases from persistent shallow mirrors if a mirror path is supplied
+        self.mirror = GitMirror(os.path.abspath(args.mirrorpath), self.runner, self.start) if args.mirrorpath \
+            else None
 
 
 # If the script is called from the command line, then call the argument parser
@@ -266,6 +358,23 @@ if __name__ == '__main__':
                         required=True,
                         help='Absolute path to location to store database files. Include any version numbers if '
                              'required.')
+    parser.add_argument('-t', '--timeout',
+                        type=float,
+                        help='Maximum number of seconds for each download and set-up call. Calls that time out are '
+                             'not marked as complete, and are attempted again by the next set-up. Default is no limit')
+    parser.add_argument('-m', '--mirrorpath',
+                        help='Path of a folder in which to keep shallow mirrors of the git repositories of the OLC '
+                             'and CGE databases. The mirrors are shared by every version of the databases. With this '
+                             'option, each repository is refreshed by fetching its latest commit into the mirror, and '
+                             'only the files that changed since the databases in the database path were set up are '
+                             'copied, and have their combined targets and indexes rebuilt')
+    parser.add_argument('-ou', '--olcurl',
+                        default=OLCURL,
+                        help='Url of the git repository of the OLC databases. Default is {}'.format(OLCURL))
+    parser.add_argument('-cu', '--cgeurl',
+                        default=CGEURL,
+                        help='Url of the git repositories of the CGE databases, in which {db} is replaced by the '
+                             'name of the database. Default is ' + CGEURL)
     # Get the arguments into an object
     arguments = parser.parse_args()
     arguments.start = time()
@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 from setuptools import setup, find_packages
+from cowbat.version import __version__
 __author__ = 'adamkoziol'
 setup(
     name="COWBAT",
-    version="0.2.0",
+    version=__version__,
     include_package_data=True,
     license='MIT',
     author='Adam Koziol',
@@ -0,0 +1,96 @@
+#!/usr/bin/env python 3
+from accessoryFunctions.accessoryFunctions import MetadataObject, GenObject, make_path
+from time import time
+import pytest
+import shutil
+import json
+import sys
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+scriptpath = os.path.join(testpath, '..')
+sys.path.append(scriptpath)
+from assembly_pipeline import RunSpades, pipeline_parser
+from cowbat.alleleindex import create_allele_index
+from cowbat.profileindex import create_profile_index
+from cowbat.samplerecord import compact
+from cowbat.staging import relocate_sample
+
+__author__ = 'adamkoziol'
+
+# Golden inputs of the stages. Each metadata file is the metadata of the golden sample at a checkpoint of the pipeline:
+# trimmed (after read processing), assembled (after assembly), and identified (after mash and rMLST)
+GOLDENPATH = os.path.join(testpath, 'testdata', 'golden')
+# Folder of the golden run in the paths of the golden metadata, which is replaced by the folder of each test
+GOLDENRUN = '/golden'
+# Reads of the golden sample, which cover the targets of the typing databases
+READPATH = os.path.join(testpath, 'testdata', 'databases', 'fastq')
+# Metadata attributes of the reads and assemblies of the golden sample
+READS = ['fastqfiles', 'trimmedfastqfiles', 'trimmedcorrectedfastqfiles']
+ASSEMBLIES = ['bestassemblyfile', 'filteredfile']
+
+
+def golden_sample(checkpoint, runpath):
+    """
+    Create the golden sample of a checkpoint in a run folder. The reads are the reads of the typing database tests,
+    and the assembly contains the alleles of ST11 (MLST) and rST2124 (rMLST), and the targets of the remaining typing
+    stages
+    :param checkpoint: name of the checkpoint: trimmed, assembled, or identified
+    :param runpath: path of the run folder
+    :return: metadata object of the sample
+    """
+    with open(os.path.join(GOLDENPATH, 'metadata', '{}.json'.format(checkpoint)), 'r') as metadatafile:
+        jsondata = json.load(metadatafile)
+    sample = MetadataObject()
+    for attr, value in jsondata.items():
+        setattr(sample, attr, GenObject(value) if isinstance(value, dict) else value)
+    sample = compact([sample])[0]
+    relocate_sample(sample, GOLDENRUN, runpath)
+    make_path(sample.general.outputdirectory)
+    for direction in range(2):
+        readfiles = [sample.general.datastore[attr][direction] for attr in READS if attr in sample.general.datastore]
+        # Concatenated gzip files are a valid gzip file
+        with open(readfiles[0], 'wb') as reads:
+            for fastq in sorted(os.listdir(READPATH)):
+                if fastq.endswith('_R{}.fastq.gz'.format(direction + 1)):
+                    with open(os.path.join(READPATH, fastq), 'rb') as fixture:
+                        shutil.copyfileobj(fixture, reads)
+        for readfile in readfiles[1:]:
+            os.link(readfiles[0], readfile)
+    for attr in ASSEMBLIES:
+        if attr in sample.general.datastore:
+            make_path(os.path.dirname(sample.general.datastore[attr]))
+            shutil.copyfile(os.path.join(GOLDENPATH, 'golden.fasta'), sample.general.datastore[attr])
+    return sample
+
+
+@pytest.fixture(scope='session')
+def golden_databases(tmpdir_factory):
+    """
+    Copy of the test databases for the golden pipelines, with the allele and profile indexes created by the database
+    setup. Each test session (and each parallel worker) has its own copy, as the stages write to the databases
+    """
+    databasepath = str(tmpdir_factory.mktemp('golden').join('databases'))
+    shutil.copytree(os.path.join(testpath, 'testdata', 'databases'), databasepath, symlinks=True)
+    for scheme, profile in [(os.path.join('MLST', 'Escherichia'), 'ecoli.txt'), ('rMLST', 'profile.txt')]:
+        create_allele_index(os.path.join(databasepath, scheme))
+        create_profile_index(os.path.join(databasepath, scheme, profile))
+    return databasepath
+
+
+@pytest.fixture()
+def golden_pipeline(tmpdir, golden_databases):
+    """
+    Create pipeline objects that start from a checkpoint, so that a single stage can be tested (or timed with
+    --durations) without running the preceding stages. Every pipeline has its own run folder
+    :return: function that creates the pipeline of a checkpoint
+    """
+    def create(checkpoint, *arguments):
+        runpath = str(tmpdir.join(checkpoint))
+        make_path(runpath)
+        args = pipeline_parser().parse_args([runpath, '-r', golden_databases, '-k', '21', '-t', '2'] +
+                                            list(arguments))
+        pipeline = RunSpades(args, b'', time(), scriptpath)
+        pipeline.runmetadata.samples = [golden_sample(checkpoint, runpath)]
+        return pipeline
+    return create
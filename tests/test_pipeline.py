@@ -1,10 +1,21 @@
 #!/usr/bin/env python 3
 from accessoryFunctions.accessoryFunctions import MetadataObject, GenObject, make_path
+from spadespipeline.fastqmover import FastqMover
 from spadespipeline import metadataReader
+from Bio import SeqIO
 from argparse import ArgumentParser
+from glob import glob
+from threading import Thread
 import multiprocessing
 from time import time
 import pytest
+import subprocess
+import tarfile
+import tracemalloc
+import sqlite3
+import pickle
+import json
+import gzip
 import shutil
 import sys
 import os
@@ -13,6 +24,27 @@ testpath = os.path.abspath(os.path.dirname(__file__))
 scriptpath = os.path.join(testpath, '..')
 sys.path.append(scriptpath)
 from assembly_pipeline import RunSpades
+from cowbat.alleleindex import create_allele_index, AlleleIndex
+from cowbat.profileindex import create_profile_index, ProfileIndex
+from cowbat.refseqindex import create_refseq_index, RefSeqIndex
+from cowbat.resultcache import ResultCache
+from cowbat.jobserver import PipelineServer
+from cowbat.runwatcher import RunWatcher
+from cowbat.intermediates import IntermediateTracker
+from cowbat.archiver import Archiver
+from cowbat.subsample import parse_estimates, subsample_outputs
+from cowbat.kmerselection import automatic_kmers, kmer_groups
+from cowbat.contigfilter import filter_contigs
+from cowbat.resultsstore import ResultsStore
+from cowbat.streamreport import merge_csv, merge_databases
+from cowbat.samplerecord import SampleRecord, Section, compact, to_json
+from cowbat.multirun import run_directories, run_rounds, split_reports
+from cowbat.staging import Staging
+from cowbat.benchmark import random_genome, simulate_reads, simulate_assembly, compare, measure
+from cowbat.commandrunner import CommandRunner
+from cowbat.clarkserver import ClarkClient
+from cowbat.gitmirror import GitMirror
+from database_setup import DatabaseSetup, CGEURL
 
 __author__ = 'adamkoziol'
 
@@ -28,6 +60,23 @@ def variables():
     v.numreads = 2
     v.kmerrange = '21'
     v.preprocess = False
+    v.batchmash = False
+    v.clarksocket = None
+    v.watch = False
+    v.stabletime = 60
+    v.watchtimeout = 86400
+    v.priority = None
+    v.scratchbudget = None
+    v.compression = 'gzip'
+    v.targetdepth = None
+    v.mincontiglength = 0
+    v.mincontigdepth = 0
+    v.resultsdatabase = None
+    v.multirun = None
+    v.stagingpath = None
+    v.stagedatabases = False
+    v.cachepath = None
+    v.cachesize = 10
     v.basicassembly = True
     v.threads = multiprocessing.cpu_count()
     return v
@@ -118,6 +167,34 @@ def test_raw_fastqc_forward():
         assert size.st_size > 0
 
 
+def test_depth_estimates():
+    err = 'Sketching sample_R1.fastq.gz...\nEstimated genome size: 4.76e+06\nEstimated coverage:    312.000\n'
+    assert parse_estimates(err) == (4760000, 312)
+    assert parse_estimates(str()) == (0, 0)
+
+
+def test_subsampled_rerun(tmpdir):
+    # The subsampled reads must not be found as raw reads when the run is analysed again
+    run = MetadataObject()
+    run.path = str(tmpdir)
+    sample = MetadataObject()
+    sample.name = 'sample'
+    sample.general = GenObject()
+    run.runmetadata = MetadataObject()
+    run.runmetadata.samples = [sample]
+    for read in [1, 2]:
+        open(str(tmpdir.join('sample_S1_L001_R{}_001.fastq.gz'.format(read))), 'w').close()
+    FastqMover(run)
+    rawfastqfiles = sample.general.fastqfiles
+    sample.subsample = GenObject()
+    sample.subsample.outputdir = str(tmpdir.join('sample', 'subsample'))
+    make_path(sample.subsample.outputdir)
+    for fastq in subsample_outputs(sample):
+        open(fastq, 'w').close()
+    FastqMover(run)
+    assert len(rawfastqfiles) == 2 and sample.general.fastqfiles == rawfastqfiles
+
+
 def test_quality_trim(variables):
     method.quality_trim()
     outfile = os.path.join(variables.path, 'NC_002695', 'NC_002695_R1_trimmed.fastq.gz')
@@ -181,6 +258,40 @@ def test_merged_fastqc():
         assert size.st_size > 0
 
 
+def test_priority_groups(variables):
+    variables.priority = 'urgent:2,expedited'
+    prioritised = method_init(variables)
+    prioritised.runmetadata.samples = list()
+    for name in ['routine', 'expedited', 'urgent']:
+        sample = MetadataObject()
+        sample.name = name
+        sample.general = GenObject()
+        sample.run = GenObject()
+        prioritised.runmetadata.samples.append(sample)
+    groups = prioritised.priority_groups()
+    assert [[sample.name for sample in group] for group in groups] == [['urgent'], ['expedited'], ['routine']]
+
+
+def test_kmer_selection():
+    assert automatic_kmers(150) == [21, 33, 55, 77]
+    assert automatic_kmers(250) == [21, 33, 55, 77, 99, 127]
+    assert automatic_kmers(250, depth=15) == [21, 33, 55]
+    samples = list()
+    for name, readlength in [('short', 150), ('long', 301), ('long2', 251)]:
+        sample = MetadataObject()
+        sample.name = name
+        sample.general = GenObject()
+        sample.run = GenObject()
+        sample.run.forwardlength = readlength
+        samples.append(sample)
+    samples[0].run.Kmers = '21;33'
+    groups = kmer_groups(samples)
+    assert sorted(groups) == ['21,33', '21,33,55,77,99,127']
+    assert samples[0].general.kmerselection == 'sample sheet'
+    assert samples[1].general.kmerselection == 'automatic'
+    assert sorted(kmer_groups(samples, '21,33,55')) == ['21,33', '21,33,55']
+
+
 def test_spades():
     method.run_spades()
     for sample in method.runmetadata.samples:
@@ -195,6 +306,19 @@ def test_qualimap():
         assert int(sample.mapping.Contigs) >= 500
 
 
+def test_contig_filter(tmpdir):
+    assembly = tmpdir.join('assembly.fasta')
+    assembly.write('>NODE_1_length_12_cov_37.1\nACGTACGTACGT\n'
+                   '>NODE_2_length_12_cov_2.5\nACGTACGTACGT\n'
+                   '>NODE_3_length_4_cov_40.0\nACGT\n')
+    summary = filter_contigs(str(assembly), str(tmpdir.join('filtered.fasta')), str(tmpdir.join('excluded.fasta')),
+                             minlength=10, mindepth=5)
+    assert summary['keptcontigs'] == 1
+    assert summary['excludedbases'] == 16
+    records = list(SeqIO.parse(str(tmpdir.join('filtered.fasta')), 'fasta'))
+    assert [record.id for record in records] == ['NODE_1_length_12_cov_37.1']
+
+
 def test_quality_features():
     method.quality_features()
     for sample in method.runmetadata.samples:
@@ -213,6 +337,13 @@ def test_mash():
         assert sample.mash.closestrefseq == 'Escherichia coli O157:H7 str. Sakai'
 
 
+def test_refseq_index(variables, tmpdir):
+    summaryfile = os.path.join(variables.referencefilepath, 'mash', 'assembly_summary_refseq.txt')
+    refseq = RefSeqIndex(create_refseq_index(summaryfile, str(tmpdir.join('refseq.sqlite'))))
+    assert refseq.lookup('GCF_000008865.1_ASM886v1_genomic.fna.gz') == 'Escherichia coli O157:H7 str. Sakai'
+    refseq.close()
+
+
 def test_rmlst():
     method.rmlst()
     for sample in method.runmetadata.samples:
@@ -267,6 +398,14 @@ def test_univec():
         assert sample.univec.blastresults
 
 
+def test_assembly_search():
+    method.assembly_search(prophagecutoff=25)
+    for sample in method.runmetadata.samples:
+        assert sample.resfinder_assembled.protseq
+        assert sample.prophages.blastresults
+        assert sample.univec.blastresults
+
+
 def test_virulence():
     method.virulence()
     for sample in method.runmetadata.samples:
@@ -279,6 +418,91 @@ def test_mlst():
         assert sample.mlst.sequencetype == '11'
 
 
+def test_allele_index(variables, tmpdir):
+    targetpath = os.path.join(variables.referencefilepath, 'MLST', 'Escherichia')
+    index = AlleleIndex(create_allele_index(targetpath, str(tmpdir.join('alleles.sqlite'))))
+    # The combined targets contain the alleles of ST11 - treat them as the contigs of an assembly
+    matches = dict()
+    for record in SeqIO.parse(os.path.join(targetpath, 'combinedtargets.fasta'), 'fasta'):
+        for locus, alleles in index.scan('ACGT' + str(record.seq.reverse_complement()) + 'ACGT').items():
+            matches.setdefault(locus, set()).update(alleles)
+    profile = ProfileIndex(create_profile_index(os.path.join(targetpath, 'ecoli.txt'),
+                                                str(tmpdir.join('profiles.npy'))))
+    index.close()
+    assert matches['adk'] == {'12'}
+    assert profile.sequencetype({locus: list(alleles)[0] for locus, alleles in matches.items()}) == '11'
+
+
+def test_allele_index_update(tmpdir):
+    alleles = ['ACGTTGCAACGTTGCAACGTTGCA', 'TTGCAACGTTGCAACGTTGCAACG']
+    allelefile = str(tmpdir.join('adk.tfa'))
+    with open(allelefile, 'w') as fasta:
+        fasta.write('>adk_1\n{}\n'.format(alleles[0]))
+    indexfile = create_allele_index(str(tmpdir))
+    modified = os.stat(indexfile).st_mtime
+    # The index is only rebuilt once the alleles change
+    assert create_allele_index(str(tmpdir)) == indexfile and os.stat(indexfile).st_mtime == modified
+    with open(allelefile, 'a') as fasta:
+        fasta.write('>adk_2\n{}\n'.format(alleles[1]))
+    os.utime(allelefile, (modified + 10, modified + 10))
+    index = AlleleIndex(create_allele_index(str(tmpdir)))
+    assert index.scan(alleles[1]) == {'adk': {'2'}}
+    index.close()
+
+
+def test_profile_index(variables, tmpdir):
+    profilefile = os.path.join(variables.referencefilepath, 'rMLST', 'profile.txt')
+    profile = ProfileIndex(create_profile_index(profilefile, str(tmpdir.join('profiles.npy'))))
+    assert len(profile.loci) == 53
+    with open(profilefile) as profiletable:
+        header, row = [line.rstrip('\n').split('\t') for line in profiletable][:2]
+    alleles = dict(zip(header, row))
+    # Alleles of 'N' in the profile match any allele
+    alleles['BACT000060'] = '1'
+    assert profile.sequencetype(alleles) == '2124'
+    # A novel allele is a single mismatch to the closest profile
+    alleles['BACT000001'] = '100000'
+    assert profile.sequencetype(alleles) is None
+    assert profile.closest(alleles) == (['2124'], 1)
+
+
+def test_result_cache_files(tmpdir):
+    reads = str(tmpdir.join('reads.fastq.gz'))
+    with gzip.open(reads, 'wt') as fastq:
+        fastq.write('@read\nACGT\n+\nIIII\n')
+
+    def cache_sample(outputdirectory):
+        sample = MetadataObject()
+        sample.name = 'sample'
+        sample.general = GenObject()
+        sample.general.outputdirectory = outputdirectory
+        sample.general.fastqfiles = [reads]
+        make_path(outputdirectory)
+        return sample
+    cache = ResultCache(str(tmpdir.join('cache')), 1024 ** 2, str(tmpdir), 'commit')
+    sample = cache_sample(str(tmpdir.join('run1', 'sample')))
+    keys = cache.keys([sample], 'stage', list(), 'reads', list())
+    snapshots = cache.snapshot([sample])
+    # Create the outputs of the stage
+    sample.stage = GenObject()
+    sample.stage.outputdir = os.path.join(sample.general.outputdirectory, 'stage')
+    sample.stage.report = os.path.join(sample.stage.outputdir, 'report.csv')
+    make_path(sample.stage.outputdir)
+    with open(sample.stage.report, 'w') as report:
+        report.write('result\n')
+    cache.store([sample], keys, snapshots)
+    # A sample with the same reads in another run has the outputs restored
+    restored = cache_sample(str(tmpdir.join('run2', 'sample')))
+    assert cache.restore([restored], cache.keys([restored], 'stage', list(), 'reads', list())) == list()
+    assert restored.stage.report == str(tmpdir.join('run2', 'sample', 'stage', 'report.csv'))
+    with open(restored.stage.report, 'r') as report:
+        assert report.read() == 'result\n'
+    # Entries are evicted, with their files, once the cache exceeds its maximum size
+    cache.maxsize = 0
+    cache.store([sample], keys, snapshots)
+    assert cache.size == 0 and not os.listdir(str(tmpdir.join('cache', list(keys.values())[0][:2])))
+
+
 def test_serosippr():
     method.serosippr()
     for sample in method.runmetadata.samples:
@@ -297,6 +521,647 @@ def test_coregenome():
         assert sample.coregenome.coreresults == '1/1'
 
 
+def test_job_server(variables, tmpdir):
+    args = ArgumentParser()
+    args.socket = str(tmpdir.join('pipeline.sock'))
+    args.referencefilepath = variables.referencefilepath
+    args.threads = 2
+    args.workers = 1
+    args.warm = str()
+    args.cachepath = None
+    args.cachesize = 10
+    args.start = time()
+    server = PipelineServer(args)
+    processed = list()
+
+    def run(pipelineargs):
+        # Record the order in which the runs are processed rather than running the pipeline. The stages of the
+        # pipeline call quit() on errors
+        processed.append(pipelineargs.path)
+        if pipelineargs.path.endswith('quit'):
+            quit()
+        return {'status': 'complete'}
+    server.run = run
+    low = server.submit(str(tmpdir.join('low')), list(), 0)
+    high = server.submit(str(tmpdir.join('high')), ['-bm'], 10)
+    exited = server.submit(str(tmpdir.join('quit')), list(), 5)
+    cancelled = server.submit(str(tmpdir.join('cancelled')), list(), 10)
+    server.cancel(cancelled['run'])
+    worker = Thread(target=server.worker, args=())
+    worker.setDaemon(True)
+    worker.start()
+    server.queue.join()
+    assert processed == [high['path'], exited['path'], low['path']]
+    assert server.status(cancelled['run'])['status'] == 'cancelled'
+    assert server.status(exited['run'])['status'] == 'failed'
+    assert server.status(low['run'])['status'] == 'complete'
+
+
+def test_run_watcher(tmpdir):
+    args = ArgumentParser()
+    args.path = str(tmpdir)
+    args.starttime = time()
+    args.numreads = 2
+    args.stabletime = 0
+    args.watchtimeout = 60
+    args.basicassembly = True
+    batches = list()
+    # Record the samples passed to the pipeline rather than processing them
+    args.process_samples = lambda samples: batches.append(sorted(sample.name for sample in samples))
+    watcher = RunWatcher(args)
+    watcher.expected_samples()
+    # The reverse reads of the sample have not been written yet
+    with gzip.open(str(tmpdir.join('sample_S1_L001_R1_001.fastq.gz')), 'wt') as fastq:
+        fastq.write('@read1\nACGTACGTAC\n+\nIIIIIIIIII\n')
+    assert not watcher.ready_samples()
+    with gzip.open(str(tmpdir.join('sample_S1_L001_R2_001.fastq.gz')), 'wt') as fastq:
+        fastq.write('@read1\nGTACGTACGT\n+\nIIIIIIIIII\n')
+    watcher.process(watcher.ready_samples())
+    assert not watcher.complete()
+    # The run is complete once the run statistics are written
+    tmpdir.join('GenerateFASTQRunStatistics.xml').write('')
+    assert watcher.complete()
+    watcher.finalise()
+    assert batches == [['sample']]
+    assert args.runmetadata.samples[0].run.forwardlength == 10
+
+
+def test_intermediates(tmpdir):
+    args = ArgumentParser()
+    args.path = str(tmpdir)
+    args.starttime = time()
+    args.scratchbudget = 0
+    sample = MetadataObject()
+    sample.name = 'sample'
+    sample.general = GenObject()
+    sample.general.fastqfiles = [str(tmpdir.join('sample_R1.fastq.gz'))]
+    sample.general.trimmedfastqfiles = [str(tmpdir.join('sample_R1_trimmed.fastq.gz'))]
+    sample.general.trimmedcorrectedfastqfiles = [str(tmpdir.join('sample_R1_trimmed_corrected.fastq.gz'))]
+    # The trimmed reads are used in place of the normalised reads when normalisation fails
+    sample.general.normalisedreads = sample.general.trimmedfastqfiles
+    sample.general.mergedreads = str(tmpdir.join('sample_paired.fastq.gz'))
+    for fastq in sample.general.fastqfiles + sample.general.trimmedfastqfiles + \
+            sample.general.trimmedcorrectedfastqfiles + [sample.general.mergedreads]:
+        with open(fastq, 'w') as reads:
+            reads.write('@read1\nACGT\n+\nIIII\n')
+    args.runmetadata = MetadataObject()
+    args.runmetadata.samples = [sample]
+    tracker = IntermediateTracker(args)
+    # The trimmed reads are kept until the reads are merged
+    tracker.release('merge_reads')
+    assert not os.path.isfile(sample.general.trimmedfastqfiles[0])
+    assert os.path.isfile(sample.general.mergedreads)
+    assert all(os.path.isfile(fastq) for fastq in sample.general.fastqfiles + sample.general.trimmedcorrectedfastqfiles)
+    tracker.release('run_spades')
+    assert not os.path.isfile(sample.general.mergedreads)
+    # Without a budget, all the samples are processed together
+    assert list(tracker.batches([sample, sample])) == [[sample, sample]]
+    tracker.budget = 1
+    assert list(tracker.batches([sample, sample])) == [[sample], [sample]]
+    # Staged samples use the space of the scratch folder
+    args.staging = MetadataObject()
+    args.staging.scratchpath = str(tmpdir.join('scratch', 'run'))
+    tracker.budget = 10000
+    assert tracker.available() == 10000
+    make_path(args.staging.scratchpath)
+    with open(os.path.join(args.staging.scratchpath, 'reads.fastq'), 'w') as reads:
+        reads.write('A' * 1000)
+    assert tracker.available() == 9000
+
+
+def test_archiver(tmpdir):
+    args = ArgumentParser()
+    args.starttime = time()
+    args.cpus = 2
+    args.reportpath = str(tmpdir.join('reports'))
+    sample = MetadataObject()
+    sample.name = 'sample'
+    sample.general = GenObject()
+    sample.general.outputdirectory = str(tmpdir.join('sample'))
+    sample.general.bestassemblyfile = str(tmpdir.join('sample', 'sample.fasta'))
+    make_path(sample.general.outputdirectory)
+    for filename in ['classification.csv', 'sample.fasta']:
+        with open(str(tmpdir.join('sample', filename)), 'w') as outfile:
+            outfile.write('sample,ACGT\n' * 1000)
+    args.runmetadata = MetadataObject()
+    args.runmetadata.samples = [sample]
+    archive = Archiver(args, 'gzip', minsize=0)
+    archive.main()
+    # The assembly is not compressed
+    assert os.path.isfile(sample.general.bestassemblyfile)
+    assert not os.path.isfile(str(tmpdir.join('sample', 'classification.csv')))
+    with gzip.open(str(tmpdir.join('sample', 'classification.csv.gz')), 'rt') as compressed:
+        assert compressed.read() == 'sample,ACGT\n' * 1000
+    assert archive.saved > 0
+    assert os.path.isfile(os.path.join(args.reportpath, 'compression.csv'))
+
+
+def test_results_store(tmpdir):
+    samples = list()
+    for name, sequencetype, ogroup, genelist, date in [('2018-SEQ-0001', '11', 'O157', ['stx2a', 'eae'], '4/11/2018'),
+                                                        ('2018-SEQ-0002', '11', 'O26', ['stx1a'], '2018-05-01'),
+                                                        ('2017-SEQ-0003', '21', 'O157', ['stx2c'], '2017-05-01')]:
+        sample = MetadataObject()
+        sample.name = name
+        sample.run = GenObject()
+        sample.run.Date = date
+        sample.mlst = GenObject()
+        sample.mlst.sequencetype = sequencetype
+        sample.serosippr = GenObject()
+        sample.serosippr.o_set = [ogroup]
+        sample.serosippr.h_set = ['H7']
+        sample.genesippr = GenObject()
+        sample.genesippr.report_output = genelist
+        samples.append(sample)
+    store = ResultsStore(str(tmpdir.join('results.sqlite')))
+    store.add_samples(samples, str(tmpdir), '0.2.0')
+    # Adding the results of the same run again replaces the previous results
+    store.add_samples(samples[:1], str(tmpdir), '0.2.0')
+    assert len(store.query(sequencetype=11)) == 2
+    assert [match['name'] for match in store.query(serotype='o157')] == ['2017-SEQ-0003', '2018-SEQ-0001']
+    matches = store.query(serotype='O157', genelist=['stx2'], since='2018-01-01')
+    assert [match['name'] for match in matches] == ['2018-SEQ-0001']
+    assert matches[0]['genes'] == 'eae;stx2a'
+    store.close()
+
+
+def test_stream_report(tmpdir):
+    rowfiles = list()
+    databases = list()
+    for name, n50 in [('2018-SEQ-0001', '845'), ('2018-SEQ-0002', '1024')]:
+        rowfile = tmpdir.join('{}.csv'.format(name))
+        rowfile.write('SeqID,N50\n{name},{n50}\n'.format(name=name,
+                                                         n50=n50))
+        rowfiles.append(str(rowfile))
+        database = str(tmpdir.join('{}.sqlite'.format(name)))
+        db = sqlite3.connect(database)
+        db.execute('CREATE TABLE Samples (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE, name TEXT UNIQUE)')
+        db.execute('INSERT INTO Samples (name) VALUES (?)', (name,))
+        db.execute('CREATE TABLE quality_features (sample_id INTEGER, n50 TEXT)')
+        db.execute('INSERT INTO quality_features (sample_id, n50) VALUES (1, ?)', (n50,))
+        db.commit()
+        db.close()
+        databases.append(database)
+    assert merge_csv(rowfiles, str(tmpdir.join('combinedMetadata.csv'))) == 2
+    assert tmpdir.join('combinedMetadata.csv').read() == 'SeqID,N50\n2018-SEQ-0001,845\n2018-SEQ-0002,1024\n'
+    merge_databases(databases, str(tmpdir.join('metadatabase.sqlite')))
+    db = sqlite3.connect(str(tmpdir.join('metadatabase.sqlite')))
+    assert db.execute('SELECT Samples.name, n50 FROM Samples JOIN quality_features ON Samples.id = sample_id '
+                      'ORDER BY Samples.id').fetchall() == [('2018-SEQ-0001', '845'), ('2018-SEQ-0002', '1024')]
+    db.close()
+
+
+def test_sample_record():
+    sample = MetadataObject()
+    sample.name = '2018-SEQ-0001'
+    sample.general = GenObject()
+    sample.general.bestassemblyfile = 'NA'
+    record = compact([sample])[0]
+    assert isinstance(record, SampleRecord)
+    assert isinstance(record.general, Section)
+    assert not hasattr(record, '__dict__') and not hasattr(record.general, '__dict__')
+    # The record shares the metadata of the original sample
+    record.general.bestassemblyfile = '2018-SEQ-0001.fasta'
+    assert sample.general.bestassemblyfile == '2018-SEQ-0001.fasta'
+    # Missing sections are created on first use, and are not shared between sections
+    record.mlst.sequencetype = '11'
+    assert record.rmlst is not record.mlst
+    assert to_json(record) == json.dumps(record.dump(), sort_keys=True, indent=4, separators=(',', ': '))
+    restored = pickle.loads(pickle.dumps(record))
+    assert restored.mlst.sequencetype == '11'
+    assert json.loads(to_json(restored)) == json.loads(to_json(record))
+    # The fixed and analysis sections are both available through the datastore
+    assert list(record.datastore) == ['name', 'general', 'mlst', 'rmlst']
+    del record.datastore['rmlst']
+    assert 'rmlst' not in record.datastore and 'run' not in record.datastore
+
+
+def test_sample_record_memory():
+    def create(metadataclass):
+        samples = list()
+        for number in range(5000):
+            sample = metadataclass()
+            sample.name = '2018-SEQ-{:04d}'.format(number)
+            for section in ['general', 'run', 'commands', 'mlst', 'rmlst', 'mash', 'quality', 'resfinder']:
+                setattr(sample, section, GenObject())
+                getattr(sample, section).datastore['status'] = 'NA'
+            samples.append(sample)
+        return samples
+    sizes = list()
+    for metadataclass in [MetadataObject, SampleRecord]:
+        tracemalloc.start()
+        samples = create(metadataclass)
+        sizes.append(tracemalloc.get_traced_memory()[0])
+        tracemalloc.stop()
+        del samples
+    # Neither the records nor their sections carry an instance dictionary
+    assert sizes[1] < 0.9 * sizes[0]
+
+
+def test_multirun(tmpdir):
+    for run in ['run1', 'run2', 'run3']:
+        tmpdir.mkdir(run)
+    manifest = tmpdir.join('runs.txt')
+    manifest.write('# Runs to reprocess\nrun2\n\n{}\n'.format(str(tmpdir.join('run3'))))
+    runs = run_directories([str(tmpdir.join('run1')), str(manifest), str(tmpdir.join('run2'))])
+    assert runs == [str(tmpdir.join(run)) for run in ['run1', 'run2', 'run3']]
+    pipelines = list()
+    for names in [['2018-SEQ-0001', '2018-SEQ-0002'], ['2018-SEQ-0003'], ['2018-SEQ-0002']]:
+        pipeline = MetadataObject()
+        pipeline.runmetadata = MetadataObject()
+        pipeline.runmetadata.samples = list()
+        for name in names:
+            sample = MetadataObject()
+            sample.name = name
+            pipeline.runmetadata.samples.append(sample)
+        pipelines.append(pipeline)
+    # Runs sharing sample names are typed in separate groups
+    assert run_rounds(pipelines) == [pipelines[:2], pipelines[2:]]
+
+
+def test_split_reports(tmpdir):
+    reportpath = str(tmpdir.join('batch'))
+    make_path(reportpath)
+    with open(os.path.join(reportpath, 'resfinder.csv'), 'w') as report:
+        report.write('Strain,Gene\nsample1,blaTEM\n,aac\nsample2,tetA\nsample3,NA\n')
+    # The MLST reports repeat the header, which depends on the genus, before each sample
+    with open(os.path.join(reportpath, 'MLST.csv'), 'w') as report:
+        report.write('Strain,Genus,SequenceType,adk\nsample1,Escherichia,11,6\n'
+                     'Strain,Genus,SequenceType,abcZ\nsample2,Listeria,1,3\n'
+                     'Strain,Genus,SequenceType,adk\nsample3,Escherichia,10,10\n,,11,6\n')
+    with open(os.path.join(reportpath, 'abundance.xlsx'), 'w') as report:
+        report.write('workbook')
+    runs = [(['sample1', 'sample3'], str(tmpdir.join('run1'))), (['sample2'], str(tmpdir.join('run2')))]
+    assert split_reports(reportpath, runs) == ['abundance.xlsx']
+    with open(str(tmpdir.join('run1', 'resfinder.csv')), 'r') as report:
+        assert report.read() == 'Strain,Gene\nsample1,blaTEM\n,aac\nsample3,NA\n'
+    with open(str(tmpdir.join('run1', 'MLST.csv')), 'r') as report:
+        assert report.read() == 'Strain,Genus,SequenceType,adk\nsample1,Escherichia,11,6\n' \
+                                'Strain,Genus,SequenceType,adk\nsample3,Escherichia,10,10\n,,11,6\n'
+    with open(str(tmpdir.join('run2', 'MLST.csv')), 'r') as report:
+        assert report.read() == 'Strain,Genus,SequenceType,abcZ\nsample2,Listeria,1,3\n'
+    # Reports that cannot be divided by sample are only kept in the reports of the batch
+    assert not os.path.isfile(str(tmpdir.join('run1', 'abundance.xlsx')))
+
+
+def test_staging(tmpdir):
+    run = tmpdir.mkdir('run')
+    run.join('2018-SEQ-0001_R1.fastq.gz').write('reads')
+    sampledir = run.mkdir('2018-SEQ-0001')
+    sampledir.join('2018-SEQ-0001_R1.fastq.gz').mksymlinkto(os.path.join('..', '2018-SEQ-0001_R1.fastq.gz'))
+    sampledir.join('previous.txt').write('previous')
+    inputobject = MetadataObject()
+    inputobject.path = str(run)
+    inputobject.starttime = time()
+    sample = MetadataObject()
+    sample.name = '2018-SEQ-0001'
+    sample.general = GenObject()
+    sample.general.outputdirectory = str(sampledir)
+    sample.general.fastqfiles = [str(sampledir.join('2018-SEQ-0001_R1.fastq.gz'))]
+    staging = Staging(inputobject, str(tmpdir.join('scratch')))
+    staging.stage([sample])
+    assert sample.general.outputdirectory.startswith(str(tmpdir.join('scratch')))
+    assert open(sample.general.fastqfiles[0]).read() == 'reads'
+    assert run.join('staging.json').check()
+    # Outputs created on the scratch space are copied back, and the paths in the metadata restored
+    with open(os.path.join(sample.general.outputdirectory, 'assembly.fasta'), 'w') as assembly:
+        assembly.write('>contig\nACGT\n')
+    os.remove(os.path.join(sample.general.outputdirectory, 'previous.txt'))
+    staging.unstage([sample])
+    assert sample.general.outputdirectory == str(sampledir)
+    assert sampledir.join('assembly.fasta').check()
+    assert not sampledir.join('previous.txt').check()
+    assert sampledir.join('2018-SEQ-0001_R1.fastq.gz').islink()
+    assert not run.join('staging.json').check()
+    # The outputs of a run that did not finish are recovered by the next run
+    staging.stage([sample])
+    with open(os.path.join(sample.general.outputdirectory, 'contigs.fasta'), 'w') as contigs:
+        contigs.write('>contig\nACGT\n')
+    Staging(inputobject, str(tmpdir.join('scratch')))
+    assert sampledir.join('contigs.fasta').check()
+    assert not run.join('staging.json').check()
+
+
+def test_benchmark(tmpdir):
+    genome = random_genome(5000, 1, ['ACGTTGCA' * 10])
+    assert len(genome) == 5000
+    assert 'ACGTTGCA' * 10 in genome.tobytes().decode('ascii')
+    forward = str(tmpdir.join('sample_S1_L001_R1_001.fastq.gz'))
+    reverse = str(tmpdir.join('sample_S1_L001_R2_001.fastq.gz'))
+    bases = simulate_reads(genome, 30, forward, reverse, 'sample', 1, errorrate=0)
+    with gzip.open(forward, 'rt') as fastq:
+        forwardreads = list(SeqIO.parse(fastq, 'fastq'))
+    with gzip.open(reverse, 'rt') as fastq:
+        reversereads = list(SeqIO.parse(fastq, 'fastq'))
+    assert len(forwardreads) == len(reversereads) == 500
+    assert bases == 150000
+    assert str(forwardreads[0].seq) in genome.tobytes().decode('ascii')
+    assert str(reversereads[0].seq.reverse_complement()) in genome.tobytes().decode('ascii')
+    simulate_assembly(genome, str(tmpdir.join('contigs.fasta')), 30, 1, contiglength=1000)
+    contigs = list(SeqIO.parse(str(tmpdir.join('contigs.fasta')), 'fasta'))
+    assert sum(len(contig) for contig in contigs) == 5000
+    assert contigs[0].id.startswith('NODE_1_length_{}_cov_'.format(len(contigs[0])))
+    baseline = {'mash': {'status': 'complete', 'walltime': 10.0, 'maxrss': 2 ** 30},
+                'rmlst': {'status': 'complete', 'walltime': 10.0},
+                'clark': {'status': 'failed', 'walltime': 1.0}}
+    results = {'mash': {'status': 'complete', 'walltime': 20.0, 'maxrss': 2 ** 30 + 1024},
+               'rmlst': {'status': 'failed', 'error': 'AssertionError: no alleles', 'walltime': 1.0},
+               'clark': {'status': 'complete', 'walltime': 60.0}}
+    assert compare(results, baseline, 0.25) == ['mash: walltime increased from 10.00 to 20.00',
+                                                'rmlst: AssertionError: no alleles']
+    # The peak memory allocated by Python is measured for each stage
+    assert measure(lambda: b'A' * 32 * 1024 ** 2)['pythonpeak'] >= 32 * 1024 ** 2
+    assert measure(lambda: None)['pythonpeak'] < 1024 ** 2
+
+
+def test_golden_checkpoints(golden_pipeline):
+    pipeline = golden_pipeline('identified')
+    for sample in pipeline.runmetadata.samples:
+        assert sample.general.outputdirectory == os.path.join(pipeline.path, 'golden')
+        for inputfile in sample.general.trimmedcorrectedfastqfiles + [sample.general.bestassemblyfile]:
+            assert os.path.isfile(inputfile)
+        assert sample.general.referencegenus == 'Escherichia'
+
+
+def test_golden_allele_typing(golden_pipeline):
+    pipeline = golden_pipeline('identified')
+    for sample in pipeline.runmetadata.samples:
+        del sample.datastore['rmlst']
+    # The golden assembly contains exact matches to every allele of both schemes
+    pipeline.mlst()
+    pipeline.rmlst()
+    for sample in pipeline.runmetadata.samples:
+        assert sample.mlst.sequencetype == '11'
+        assert sample.rmlst.sequencetype == '2124'
+        assert sample.rmlst.typingmethod == 'allele_hash'
+
+
+def test_golden_contig_filter(golden_pipeline):
+    pipeline = golden_pipeline('assembled', '-ml', '1000')
+    pipeline.contig_filter()
+    for sample in pipeline.runmetadata.samples:
+        contigs = list(SeqIO.parse(sample.general.bestassemblyfile, 'fasta'))
+        assert len(contigs) == sample.contigfilter.keptcontigs
+        assert min(len(contig) for contig in contigs) >= 1000
+        assert os.path.isfile(os.path.join(sample.general.outputdirectory, 'contigfilter', 'golden_excluded.fasta'))
+
+
+def test_golden_preprocess_resume(golden_pipeline):
+    pipeline = golden_pipeline('trimmed')
+    pipeline.preprocess_checkpoint()
+
+    def resume():
+        # Samples as populated by the helper of a new invocation of the pipeline
+        resumed = RunSpades(pipeline.args, b'', time(), scriptpath)
+        resumed.runmetadata.samples = list()
+        for golden in pipeline.runmetadata.samples:
+            sample = MetadataObject()
+            sample.name = golden.name
+            sample.general = GenObject({attr: golden.general.datastore[attr]
+                                        for attr in ['fastqfiles', 'outputdirectory', 'logout', 'logerr']})
+            sample.run = GenObject(dict(golden.run.datastore))
+            resumed.runmetadata.samples.append(sample)
+        return resumed
+    resumed = resume()
+    assert not resumed.restore_preprocessed()
+    for sample in resumed.runmetadata.samples:
+        assert sample.general.trimmedcorrectedfastqfiles == pipeline.runmetadata.samples[0].general.\
+            trimmedcorrectedfastqfiles
+    # Reads replaced with files of the same name are processed again
+    resumed = resume()
+    fastq = resumed.runmetadata.samples[0].general.fastqfiles[0]
+    stats = os.stat(fastq)
+    os.utime(fastq, ns=(stats.st_atime_ns, stats.st_mtime_ns + 10 ** 10))
+    assert resumed.restore_preprocessed() == resumed.runmetadata.samples[:1]
+
+
+def test_golden_batch_mash(golden_pipeline):
+    pipeline = golden_pipeline('trimmed', '-bm')
+    pipeline.mash()
+    for sample in pipeline.runmetadata.samples:
+        assert sample.mash.closestrefseq == 'Escherichia coli O157:H7 str. Sakai'
+
+
+def test_golden_result_cache(golden_pipeline, tmpdir):
+    pipeline = golden_pipeline('identified', '-cp', str(tmpdir.join('cache')))
+    # Populate the cache
+    pipeline.mlst()
+    with open(os.path.join(pipeline.reportpath, 'mlst.csv'), 'r') as report:
+        mlstreport = report.read()
+    for sample in pipeline.runmetadata.samples:
+        del sample.datastore['mlst']
+    os.remove(os.path.join(pipeline.reportpath, 'mlst.csv'))
+    # Restore the results, and the report, from the cache
+    pipeline.mlst()
+    for sample in pipeline.runmetadata.samples:
+        assert sample.mlst.sequencetype == '11'
+    with open(os.path.join(pipeline.reportpath, 'mlst.csv'), 'r') as report:
+        assert report.read() == mlstreport
+
+
+def test_golden_cached_reports(golden_pipeline, tmpdir):
+    pipeline = golden_pipeline('identified', '-cp', str(tmpdir.join('cache')))
+    second = MetadataObject()
+    second.name = 'second'
+    second.general = GenObject()
+    second.general.outputdirectory = os.path.join(pipeline.path, 'second')
+    second.general.bestassemblyfile = os.path.join(second.general.outputdirectory, 'second.fasta')
+    make_path(second.general.outputdirectory)
+    with open(second.general.bestassemblyfile, 'w') as assembly:
+        assembly.write('>contig\nACGT\n')
+    pipeline.runmetadata.samples = compact(pipeline.runmetadata.samples + [second])
+    analysed = list()
+
+    def stage():
+        analysed.append([sample.name for sample in pipeline.runmetadata.samples])
+        make_path(pipeline.reportpath)
+        with open(os.path.join(pipeline.reportpath, 'stage.csv'), 'w') as report, \
+                open(os.path.join(pipeline.reportpath, 'summary.csv'), 'w') as summary:
+            summary.write('Strain,Result\n')
+            for sample in pipeline.runmetadata.samples:
+                sample.stage.result = sample.name.upper()
+                # The header is repeated before each sample, and additional rows have an empty first column
+                report.write('Strain,Genus,SequenceType\n{},Escherichia,1\n,,2\n'.format(sample.name))
+                summary.write('{},{}\n'.format(sample.name, sample.stage.result))
+    pipeline.run_cached('stage', stage, list(), 'assembly')
+    reports = dict()
+    for filename in ['stage.csv', 'summary.csv']:
+        with open(os.path.join(pipeline.reportpath, filename), 'r') as report:
+            reports[filename] = report.read()
+    assert reports['summary.csv'] == 'Strain,Result\ngolden,GOLDEN\nsecond,SECOND\n'
+    # Only the sample with a new assembly is analysed, and the reports include the cached rows of the other sample
+    with open(second.general.bestassemblyfile, 'a') as assembly:
+        assembly.write('>contig2\nACGT\n')
+    pipeline.run_cached('stage', stage, list(), 'assembly')
+    for filename in reports:
+        with open(os.path.join(pipeline.reportpath, filename), 'r') as report:
+            assert report.read() == reports[filename]
+    # Reports are recreated from the cache if every sample has cached results
+    for filename in reports:
+        os.remove(os.path.join(pipeline.reportpath, filename))
+    pipeline.runmetadata.samples[0].stage.result = 'NA'
+    pipeline.run_cached('stage', stage, list(), 'assembly')
+    assert analysed == [['golden', 'second'], ['second']]
+    assert pipeline.runmetadata.samples[0].stage.result == 'GOLDEN'
+    for filename in reports:
+        with open(os.path.join(pipeline.reportpath, filename), 'r') as report:
+            assert report.read() == reports[filename]
+    # Stages with reports that cannot be divided by sample are not cached
+    del analysed[:]
+
+    def excel():
+        analysed.append([sample.name for sample in pipeline.runmetadata.samples])
+        with open(os.path.join(pipeline.reportpath, 'stage.xlsx'), 'wb') as report:
+            report.write(b'PK')
+    pipeline.run_cached('excel', excel, list(), 'assembly')
+    pipeline.run_cached('excel', excel, list(), 'assembly')
+    assert analysed == [['golden', 'second']] * 2
+    # Samples without their input files are not cached
+    second.general.bestassemblyfile = 'NA'
+    assert list(pipeline.resultcache.keys([second], 'stage', list(), 'assembly', list())) == list()
+
+
+def test_golden_priority_reports(golden_pipeline):
+    pipeline = golden_pipeline('identified', '-pr', 'urgent')
+    for name in ['urgent', 'routine']:
+        sample = MetadataObject()
+        sample.name = name
+        sample.general = GenObject()
+        sample.run = GenObject()
+        pipeline.runmetadata.samples.append(sample)
+    reportpaths = list()
+
+    def analyse():
+        # Stage reports with a single header, and with an Excel report that cannot be merged
+        reportpaths.append(pipeline.reportpath)
+        make_path(pipeline.reportpath)
+        with open(os.path.join(pipeline.reportpath, 'stage.csv'), 'w') as report:
+            report.write('Strain,Result\n')
+            for sample in pipeline.runmetadata.samples:
+                report.write('{},{}\n'.format(sample.name, sample.name.upper()))
+        with open(os.path.join(pipeline.reportpath, 'stage.xlsx'), 'wb') as report:
+            report.write(b'PK')
+    pipeline.helper = lambda: None
+    pipeline.analyse = analyse
+    pipeline.sample_reports = lambda: None
+    pipeline.finish = lambda: None
+    pipeline.main()
+    assert reportpaths == [os.path.join(pipeline.reportpath, group) for group in ['group1', 'group2']]
+    # The stage reports include the samples of every priority group
+    with open(os.path.join(pipeline.reportpath, 'stage.csv'), 'r') as report:
+        assert report.read() == 'Strain,Result\ngolden,GOLDEN\nurgent,URGENT\nroutine,ROUTINE\n'
+    assert not os.path.isfile(os.path.join(pipeline.reportpath, 'stage.xlsx'))
+    assert all(os.path.isfile(os.path.join(reportpath, 'stage.xlsx')) for reportpath in reportpaths)
+
+
+def test_golden_clark_prepare(golden_pipeline):
+    # The thread count of the -t argument is a string
+    pipeline = golden_pipeline('trimmed', '-t', '2')
+    client = ClarkClient(pipeline)
+    client.runmetadata.extension = 'fastq'
+    client.prepare()
+    for sample in pipeline.runmetadata.samples:
+        assert os.path.getsize(sample.general.combined) > 0
+
+
+def test_command_runner(tmpdir):
+    runner = CommandRunner(str(tmpdir.join('logs')), limit=1000)
+    result = first = runner.run('echo out; echo err >&2; exit 3', 'exit')
+    assert result['returncode'] == 3 and not result['timedout']
+    with open(result['stdout'], 'r') as out, open(result['stderr'], 'r') as err:
+        assert (out.read(), err.read()) == ('out\n', 'err\n')
+    # Only the start and end of verbose output are kept
+    result = runner.run('seq 1 100000', 'exit')
+    assert result['name'] == 'exit_2' and result['returncode'] == 0
+    with open(result['stdout'], 'r') as out:
+        output = out.read()
+    assert output.startswith('1\n2\n') and output.endswith('99999\n100000\n')
+    assert 'bytes of output omitted' in output and len(output) < 2100
+    result = runner.run('sleep 30', 'sleep', timeout=1)
+    assert result['timedout'] and result['returncode'] == -15 and result['walltime'] < 15
+    results = runner.run_all([('echo {}'.format(number), 'echo') for number in range(4)], 4)
+    assert [result['returncode'] for result in results] == [0] * 4
+    with open(str(tmpdir.join('logs', 'commands.jsonl')), 'r') as record:
+        commands = [json.loads(line) for line in record]
+    assert len(commands) == 7 and len(set(command['name'] for command in commands)) == 7
+    assert all(command['maxrss'] > 0 for command in commands)
+    # A later runner sharing the log folder does not overwrite the logs of earlier commands
+    assert CommandRunner(str(tmpdir.join('logs'))).run('echo again', 'exit')['stdout'] != first['stdout']
+    with open(first['stdout'], 'r') as out:
+        assert out.read() == 'out\n'
+
+
+def commit_repository(source, origin, files, removed=()):
+    """
+    Commit FASTA files to a local repository, and push them to a bare repository standing in for a database repository
+    :param source: path of the local repository, which is created if required
+    :param origin: path of the bare repository, which is created if required
+    :param files: dictionary of the names and sequences of the FASTA files to write
+    :param removed: names of the files to remove
+    """
+    if not os.path.isdir(origin):
+        make_path(source)
+        subprocess.check_call(['git', 'init', '-q', source])
+        subprocess.check_call(['git', 'init', '-q', '--bare', origin])
+    for filename, sequence in files.items():
+        with open(os.path.join(source, filename), 'w') as fasta:
+            fasta.write('>{}\n{}\n'.format(filename.split('.')[0], sequence))
+    for filename in removed:
+        os.remove(os.path.join(source, filename))
+    subprocess.check_call(['git', '-C', source, 'add', '-A'])
+    subprocess.check_call(['git', '-C', source, '-c', 'user.name=cowbat', '-c', 'user.email=cowbat@example.com',
+                           'commit', '-q', '-m', 'update'])
+    subprocess.check_call(['git', '-C', source, 'push', '-q', origin, 'HEAD'])
+
+
+def test_git_mirror(tmpdir):
+    source = str(tmpdir.join('source'))
+    origin = str(tmpdir.join('origin.git'))
+    commit_repository(source, origin, {'aac.fsa': 'ACGT', 'bla.fsa': 'GGCC'})
+    mirror = GitMirror(str(tmpdir.join('mirrors')), CommandRunner(str(tmpdir.join('logs'))), time())
+    databasepath = str(tmpdir.join('resfinder'))
+    url = 'file://{}'.format(origin)
+    changed, removed = mirror.sync(url, 'resfinder_db', databasepath, {'.fsa': '.tfa'})
+    assert sorted(os.path.basename(fasta) for fasta in changed) == ['aac.tfa', 'bla.tfa'] and not removed
+    assert subprocess.check_output(['git', '-C', str(tmpdir.join('mirrors', 'resfinder_db')), 'rev-parse',
+                                    '--is-shallow-repository']).strip() == b'true'
+    # Only the changed files are copied after an update
+    for index in ['aac.nhr', 'bla.nhr', 'combinedtargets.fasta', 'combinedtargets.fasta.fai']:
+        open(os.path.join(databasepath, index), 'w').close()
+    commit_repository(source, origin, {'aac.fsa': 'ACGTT', 'cat.fsa': 'TTTT'}, ['bla.fsa'])
+    changed, removed = mirror.sync(url, 'resfinder_db', databasepath, {'.fsa': '.tfa'})
+    assert sorted(os.path.basename(fasta) for fasta in changed) == ['aac.tfa', 'cat.tfa']
+    assert [os.path.basename(fasta) for fasta in removed] == ['bla.tfa']
+    with open(os.path.join(databasepath, 'aac.tfa'), 'r') as fasta:
+        assert fasta.read() == '>aac\nACGTT\n'
+    DatabaseSetup.clear_indexes(databasepath, changed + removed)
+    assert sorted(os.listdir(databasepath)) == ['aac.tfa', 'cat.tfa', 'complete']
+    assert mirror.sync(url, 'resfinder_db', databasepath, {'.fsa': '.tfa'}) == ([], [])
+
+
+def test_olc_databases(tmpdir):
+    # The OLC databases repository contains archives of the databases, which are extracted after cloning
+    source = str(tmpdir.join('source'))
+    origin = str(tmpdir.join('Databases.git'))
+    commit_repository(source, origin, {'genesippr.fasta': 'ACGT'})
+    with tarfile.open(os.path.join(source, 'sixteenS.tar.gz'), 'w:gz') as archive:
+        archive.add(os.path.join(source, 'genesippr.fasta'), os.path.join('sixteenS', 'sixteenS.fasta'))
+    commit_repository(source, origin, dict())
+    arguments = MetadataObject()
+    arguments.databasepath = str(tmpdir.join('databases'))
+    arguments.start = time()
+    arguments.timeout = None
+    arguments.mirrorpath = None
+    arguments.olcurl = 'file://{}'.format(origin)
+    arguments.cgeurl = CGEURL
+    DatabaseSetup(arguments).olc_databases()
+    assert os.path.isfile(os.path.join(arguments.databasepath, 'sixteenS', 'sixteenS.fasta'))
+    assert os.path.isfile(os.path.join(arguments.databasepath, 'complete'))
+    assert not glob(os.path.join(arguments.databasepath, '*.gz'))
+    with open(str(tmpdir.join('databases_logs', 'commands.jsonl')), 'r') as record:
+        assert json.loads(record.readline())['returncode'] == 0
+
+
 def test_clear_results(variables):
     shutil.rmtree(os.path.join(variables.path, 'NC_002695'))
 
@@ -305,6 +1170,15 @@ def test_clear_sistr(variables):
     shutil.rmtree(os.path.join(variables.path, 'NC_003198'))
 
 
+def test_clear_preprocess(variables):
+    os.remove(os.path.join(variables.path, 'preprocessed.json'))
+
+
+def test_clear_mash(variables):
+    shutil.rmtree(os.path.join(variables.path, 'mash'))
+    os.remove(os.path.join(variables.referencefilepath, 'mash', 'assembly_summary_refseq.sqlite'))
+
+
 def test_clear_confindr(variables):
     shutil.rmtree(os.path.join(variables.path, 'confindr'))
 
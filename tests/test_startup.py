@@ -0,0 +1,45 @@
+#!/usr/bin/env python 3
+from time import time
+import subprocess
+import sys
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+scriptpath = os.path.join(testpath, '..')
+
+__author__ = 'adamkoziol'
+
+# Packages that must only be imported once the stages that use them are run
+HEAVY_MODULES = ['Bio', 'numpy', 'accessoryFunctions', 'spadespipeline', 'genesippr', 'MLSTsippr', 'metagenomefilter',
+                 'coreGenome', 'MASHsippr', 'sixteenS', 'psutil']
+# Maximum time in seconds to start the scripts and print the version/help
+MAX_STARTUP = 2
+
+
+def startup_time(*arguments):
+    """
+    :param arguments: arguments to pass to the Python interpreter
+    :return: wall time of the call, output of the call
+    """
+    start = time()
+    output = subprocess.check_output([sys.executable] + list(arguments), cwd=scriptpath)
+    return time() - start, output.decode('utf-8')
+
+
+def test_import_modules():
+    elapsed, output = startup_time('-c', 'import sys, assembly_pipeline, database_setup; '
+                                         'print(",".join(sorted(sys.modules)))')
+    imported = {module.split('.')[0] for module in output.strip().split(',')}
+    assert not imported.intersection(HEAVY_MODULES)
+
+
+def test_pipeline_version():
+    elapsed, output = startup_time(os.path.join(scriptpath, 'assembly_pipeline.py'), '--version')
+    assert 'commit' in output
+    assert elapsed < MAX_STARTUP
+
+
+def test_database_setup_help():
+    elapsed, output = startup_time(os.path.join(scriptpath, 'database_setup.py'), '--help')
+    assert '--databasepath' in output
+    assert elapsed < MAX_STARTUP